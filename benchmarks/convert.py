@@ -0,0 +1,210 @@
+# Time each stage of the converter on synthetic graphs (see `synthetic.py`)
+# of increasing size, and keep a history of the results so that slowdowns
+# between runs, and throughput that drops as graphs grow, are caught.
+#
+# For every model and scale, the best of `--repeats` conversions is
+# reported as nodes/sec (for the whole conversion and for the stages that
+# walk the graph) and bytes/sec (graph bytes parsed, output bytes written).
+# Results are appended to a JSON lines history file, and compared against
+# the best previous run of the same configuration.
+#
+# usage: python benchmarks/convert.py [--models resnet,inception]
+#            [--scales 1,2,4] [--repeats 3] [--check]
+
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+from pathlib import Path
+
+repo_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repo_root))
+
+import synthetic
+import import_tf
+import tf_profile
+
+# stages whose cost should grow with the number of nodes
+node_stages = ['parse', 'decode', 'link', 'match', 'assemble']
+
+# --------------------------------------------------------------------
+#                                                             running
+# --------------------------------------------------------------------
+
+def generate(model, scale, width, out_dir):
+    """
+    write the synthetic graph of `model` at `scale` (which multiplies the
+    depth of resnet, the number of inception blocks and the filter width
+    of yolo) and return `(graph_path, meta_path, num_nodes)`
+    """
+    if model == 'yolo':
+        writer, meta = synthetic.yolo_graph(repo_root / 'cfg' / 'yolo-voc.cfg',
+                                            width=width * scale)
+    elif model == 'resnet':
+        writer, meta = synthetic.resnet_graph(depth=50 * scale, width=width)
+    else:
+        writer, meta = synthetic.inception_graph(blocks=9 * scale, width=width)
+    name = '{}-x{}'.format(model, scale)
+    graph_path, meta_path = synthetic.write_graph(writer, meta, out_dir, name)
+    return graph_path, meta_path, len(writer.nodes)
+
+def time_conversion(graph_path, meta_path, out_path, mat_version):
+    profile = tf_profile.Profiler()
+    with contextlib.redirect_stdout(io.StringIO()):
+        with profile:
+            import_tf.convert(graph_path, meta_path, out_path,
+                              mat_version=mat_version, profile=profile)
+    stages = {stage.name: stage.wall for stage in profile.stages.values()}
+    return profile.wall, stages
+
+def benchmark(model, scale, args, work_dir):
+    graph_path, meta_path, num_nodes = generate(model, scale, args.width,
+                                                work_dir)
+    out_path = Path(work_dir) / (graph_path.stem + '.mat')
+    runs = [time_conversion(graph_path, meta_path, out_path, args.mat_version)
+            for _ in range(args.repeats)]
+    wall = min(run[0] for run in runs)
+    stages = {name: min(run[1].get(name, 0.0) for run in runs)
+              for name in runs[0][1]}
+
+    graph_bytes = graph_path.stat().st_size
+    out_bytes = out_path.stat().st_size
+    return {'model': model, 'scale': scale, 'width': args.width,
+            'mat_version': args.mat_version,
+            'nodes': num_nodes, 'graph_bytes': graph_bytes,
+            'out_bytes': out_bytes, 'wall_seconds': wall,
+            'stages': stages,
+            'nodes_per_sec': rate(num_nodes, wall),
+            'stage_nodes_per_sec': {name: rate(num_nodes, stages[name])
+                                    for name in node_stages if name in stages},
+            'bytes_per_sec': {'parse': rate(graph_bytes, stages.get('parse')),
+                              'write': rate(out_bytes, stages.get('write'))}}
+
+def rate(amount, seconds):
+    return amount / seconds if seconds else None
+
+# --------------------------------------------------------------------
+#                                                    history + checks
+# --------------------------------------------------------------------
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=str(repo_root),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def config_key(result):
+    return (result['model'], result['scale'], result['width'],
+            result['mat_version'])
+
+def read_history(path):
+    if not Path(path).exists():
+        return []
+    with open(str(path), 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def regressions(result, history, tolerance):
+    """
+    compare a result with the best previous run of the same configuration,
+    returning a description of each rate that dropped by over `tolerance`
+    """
+    previous = [old for old in history if config_key(old) == config_key(result)]
+    if not previous:
+        return []
+    found = []
+    rates = [('total', lambda r: r['nodes_per_sec'])]
+    rates += [(name, lambda r, name=name: r['stage_nodes_per_sec'].get(name))
+              for name in node_stages]
+    for name, get in rates:
+        best = max((get(old) or 0) for old in previous)
+        new = get(result)
+        if best and new is not None and new < best * (1 - tolerance):
+            found.append('{} {}x{}: {} {:.0f} nodes/s, best was {:.0f}'.format(
+                         result['model'], result['scale'], result['width'],
+                         name, new, best))
+    return found
+
+def scaling_regressions(results, tolerance):
+    """
+    throughput should not fall as graphs grow: flag models whose nodes/sec
+    at their largest scale is below that at the smallest by over
+    `tolerance` (a sign of work that is superlinear in the graph size)
+    """
+    found = []
+    for model in sorted(set(result['model'] for result in results)):
+        runs = sorted((r for r in results if r['model'] == model),
+                      key=lambda r: r['scale'])
+        if len(runs) < 2:
+            continue
+        for name in node_stages:
+            small = runs[0]['stage_nodes_per_sec'].get(name)
+            large = runs[-1]['stage_nodes_per_sec'].get(name)
+            if small and large and large < small * (1 - tolerance):
+                found.append('{} {}: {:.0f} nodes/s at x{}, {:.0f} at x{}'.format(
+                             model, name, small, runs[0]['scale'],
+                             large, runs[-1]['scale']))
+    return found
+
+def print_result(result):
+    stages = '  '.join('{} {:.3f}s'.format(name, seconds)
+                       for name, seconds in result['stages'].items())
+    print('{model:>10} x{scale:<3} {nodes:7d} nodes {mb:8.1f} MB  '
+          '{wall_seconds:7.3f}s  {nodes_per_sec:9.0f} nodes/s  '
+          '{parse_mb:7.1f} MB/s parsed'.format(
+          mb=result['graph_bytes'] / 2 ** 20,
+          parse_mb=(result['bytes_per_sec']['parse'] or 0) / 2 ** 20,
+          **result))
+    print('{:>16}{}'.format('', stages))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the converter stage by stage on synthetic graphs')
+    parser.add_argument('--models', default='yolo,resnet,inception')
+    parser.add_argument('--scales', default='1,2,4',
+                        help='graph size multipliers to run at')
+    parser.add_argument('--width', type=float, default=0.25,
+                        help='multiplier on the number of filters')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--mat-version', default='7.3', choices=['5', '7.3'])
+    parser.add_argument('--history',
+                        default=str(repo_root / 'benchmarks' / 'history.jsonl'),
+                        help='JSON lines file that results are appended to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fractional drop in throughput reported as a '
+                        'regression')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with status 1 if a regression is found')
+    args = parser.parse_args()
+
+    history = read_history(args.history)
+    stamp = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(),
+             'python': platform.python_version()}
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for model in args.models.split(','):
+            for scale in [int(x) for x in args.scales.split(',')]:
+                result = dict(stamp, **benchmark(model, scale, args, work_dir))
+                print_result(result)
+                results.append(result)
+
+    found = []
+    for result in results:
+        found += regressions(result, history, args.tolerance)
+    found += scaling_regressions(results, args.tolerance)
+    for line in found:
+        print('regression: {}'.format(line))
+
+    with open(args.history, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+    return 1 if found and args.check else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
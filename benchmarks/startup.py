@@ -0,0 +1,76 @@
+# Measure the time from interpreter start to the first decoded node of a
+# frozen graph, using either the built-in wire-format reader (`tf_proto`)
+# or TensorFlow's protobuf classes, and through the `import_tf` entry point
+# that conversions are run from (which imports the whole converter). Each
+# measurement runs in a fresh interpreter so that import costs are
+# included.
+#
+# usage: python benchmarks/startup.py graph.pb [--repeats N]
+
+import sys
+import argparse
+import subprocess
+from pathlib import Path
+
+repo_root = Path(__file__).resolve().parent.parent
+
+readers = {
+    'tf_proto': '''
+import time
+start = time.perf_counter()
+import mmap, tf_proto
+with open(path, 'rb') as f:
+    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+node = next(tf_proto.iter_nodes(buf))
+print(time.perf_counter() - start, node.name)
+''',
+    'import_tf': '''
+import time
+start = time.perf_counter()
+import import_tf, tf_proto
+buf = import_tf.load_graph(path)
+node = next(tf_proto.iter_nodes(buf))
+print(time.perf_counter() - start, node.name)
+''',
+    'tensorflow': '''
+import time
+start = time.perf_counter()
+from tensorflow.core.framework import graph_pb2
+graph_def = graph_pb2.GraphDef()
+with open(path, 'rb') as f:
+    graph_def.ParseFromString(f.read())
+node = graph_def.node[0]
+print(time.perf_counter() - start, node.name)
+''',
+}
+
+def time_reader(reader, path):
+    """
+    return the import-to-first-node time (in seconds) of a fresh interpreter
+    using `reader`, or None if the reader is not available
+    """
+    code = 'path = {!r}\n'.format(str(path)) + readers[reader]
+    proc = subprocess.run([sys.executable, '-c', code], cwd=str(repo_root),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    if proc.returncode != 0:
+        return None
+    return float(proc.stdout.split()[0])
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time interpreter start to first graph node, per reader')
+    parser.add_argument('graph', help='path to a frozen GraphDef (.pb)')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    for reader in readers:
+        times = [time_reader(reader, args.graph) for _ in range(args.repeats)]
+        if None in times:
+            print('{:>12s}: not available'.format(reader))
+            continue
+        print('{:>12s}: best {:.3f}s, mean {:.3f}s to first node'.format(
+              reader, min(times), sum(times) / len(times)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+# Generate synthetic frozen GraphDefs for benchmarking the converter. The
+# graphs are written directly in the protobuf wire format, so TensorFlow
+# is not needed, and use the same op patterns as darkflow's graphs (see
+# `tf_patterns`), so that every node takes part in the conversion:
+#
+#   yolo       - the network described by a darknet cfg (e.g. cfg/yolo-voc.cfg)
+#   resnet     - a deep chain of bottleneck blocks
+#   inception  - blocks with a wide fan-out of parallel branches
+#
+# usage: python benchmarks/synthetic.py resnet out/ --depth 50 [--width 0.5]
+
+import json
+import argparse
+import numpy as np
+from pathlib import Path
+
+# --------------------------------------------------------------------
+#                                                    wire format encoder
+# --------------------------------------------------------------------
+
+WIRE_VARINT = 0
+WIRE_LEN = 2
+
+DT_FLOAT = 1
+DT_INT32 = 3
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def field_varint(field, value):
+    if value < 0:
+        value += 1 << 64 # negative ints are sign extended to 64 bits
+    return varint(field << 3 | WIRE_VARINT) + varint(value)
+
+def field_bytes(field, data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return varint(field << 3 | WIRE_LEN) + varint(len(data)) + data
+
+def tensor_shape(shape):
+    return b''.join(field_bytes(2, field_varint(1, size)) for size in shape)
+
+def tensor_proto(value):
+    """
+    encode an array as a `TensorProto`. float arrays are packed into
+    `tensor_content`, as TensorFlow does for all but the smallest tensors;
+    int32 values go in the typed `int_val` field
+    """
+    value = np.asarray(value)
+    if value.dtype == np.int32:
+        return (field_varint(1, DT_INT32) + field_bytes(2, tensor_shape(value.shape))
+                + b''.join(field_varint(7, int(x)) for x in value.reshape(-1)))
+    value = value.astype('<f4')
+    return (field_varint(1, DT_FLOAT) + field_bytes(2, tensor_shape(value.shape))
+            + field_bytes(4, value.tobytes()))
+
+# `AttrValue` encoders
+def attr_s(text):
+    return field_bytes(2, text)
+
+def attr_i(value):
+    return field_varint(3, value)
+
+def attr_type(dtype):
+    return field_varint(6, dtype)
+
+def attr_ints(values):
+    return field_bytes(1, field_bytes(3, b''.join(varint(x) for x in values)))
+
+def attr_tensor(value):
+    return field_bytes(8, tensor_proto(value))
+
+def node_def(name, op, inputs=(), attrs=None):
+    data = field_bytes(1, name) + field_bytes(2, op)
+    for input_name in inputs:
+        data += field_bytes(3, input_name)
+    for key, value in sorted((attrs or {}).items()):
+        data += field_bytes(5, field_bytes(1, key) + field_bytes(2, value))
+    return data
+
+# --------------------------------------------------------------------
+#                                                        graph builder
+# --------------------------------------------------------------------
+
+class GraphWriter(object):
+    """
+    Build a GraphDef node by node, in the op patterns that darkflow emits.
+    Each method returns the name of the node it adds. Tensors are NHWC,
+    and `channels` tracks the depth of each output by name
+    """
+
+    def __init__(self, seed=0):
+        self.nodes = []
+        self.counts = {}
+        self.channels = {}
+        self.rng = np.random.RandomState(seed)
+
+    def add(self, op, inputs=(), attrs=None):
+        self.counts[op] = self.counts.get(op, 0) + 1
+        name = '{}_{}'.format(op, self.counts[op])
+        self.nodes.append(node_def(name, op, inputs, attrs))
+        return name
+
+    def const(self, value):
+        value = np.asarray(value)
+        dtype = DT_INT32 if value.dtype == np.int32 else DT_FLOAT
+        return self.add('Const', attrs={'dtype': attr_type(dtype),
+                                        'value': attr_tensor(value)})
+
+    def weights(self, *shape, scale=1.0):
+        value = self.rng.standard_normal(shape) * scale
+        return self.const(value.astype(np.float32))
+
+    def uniform(self, low, high, size):
+        return self.const(self.rng.uniform(low, high, size).astype(np.float32))
+
+    def placeholder(self, height, width, channels):
+        name = self.add('Placeholder', attrs={'dtype': attr_type(DT_FLOAT)})
+        self.channels[name] = channels
+        return name
+
+    def conv(self, x, filters, size=3, stride=1, batch_norm=True, leaky=True):
+        """
+        pad -> conv -> [(x - mean) / var * gain] -> bias -> [max(0.1x, x)]
+        """
+        float_t = {'T': attr_type(DT_FLOAT)} # of the elementwise ops
+        pad = size // 2
+        paddings = self.const(np.array([[0, 0], [pad, pad], [pad, pad], [0, 0]],
+                                       dtype=np.int32))
+        padded = self.add('Pad', [x, paddings], {
+            'T': attr_type(DT_FLOAT), 'Tpaddings': attr_type(DT_INT32)})
+        # He initialization, so that activations keep their scale with depth
+        fan_in = size * size * self.channels[x]
+        filters_ = self.weights(size, size, self.channels[x], filters,
+                                scale=np.sqrt(2.0 / fan_in))
+        y = self.add('Conv2D', [padded, filters_], {
+            'T': attr_type(DT_FLOAT),
+            'data_format': attr_s('NHWC'),
+            'padding': attr_s('VALID'),
+            'strides': attr_ints([1, stride, stride, 1])})
+        if batch_norm:
+            y = self.add('Sub', [y, self.weights(filters, scale=0.1)], float_t)
+            y = self.add('RealDiv', [y, self.uniform(0.5, 1.5, filters)],
+                         float_t)
+            y = self.add('Mul', [y, self.uniform(0.5, 1.5, filters)], float_t)
+        y = self.add('BiasAdd', [y, self.weights(filters, scale=0.1)],
+                     {'T': attr_type(DT_FLOAT), 'data_format': attr_s('NHWC')})
+        if leaky:
+            leak = self.add('Mul', [self.const(np.float32(0.1)), y], float_t)
+            y = self.add('Maximum', [leak, y], float_t)
+        self.channels[y] = filters
+        return y
+
+    def max_pool(self, x, size=2, stride=2):
+        y = self.add('MaxPool', [x], {
+            'T': attr_type(DT_FLOAT),
+            'data_format': attr_s('NHWC'),
+            'ksize': attr_ints([1, size, size, 1]),
+            'padding': attr_s('SAME'),
+            'strides': attr_ints([1, stride, stride, 1])})
+        self.channels[y] = self.channels[x]
+        return y
+
+    def reorg(self, x, stride=2):
+        y = self.add('ExtractImagePatches', [x], {
+            'T': attr_type(DT_FLOAT),
+            'ksizes': attr_ints([1, stride, stride, 1]),
+            'padding': attr_s('VALID'),
+            'rates': attr_ints([1, 1, 1, 1]),
+            'strides': attr_ints([1, stride, stride, 1])})
+        self.channels[y] = self.channels[x] * stride * stride
+        return y
+
+    def concat(self, xs):
+        """
+        concatenate along channels. The converter handles two inputs per
+        concat, so wider fan-ins are concatenated pairwise
+        """
+        y = xs[0]
+        for x in xs[1:]:
+            axis = self.const(np.array(3, dtype=np.int32))
+            channels = self.channels[y] + self.channels[x]
+            y = self.add('ConcatV2', [y, x, axis], {
+                'N': attr_i(2), 'T': attr_type(DT_FLOAT),
+                'Tidx': attr_type(DT_INT32)})
+            self.channels[y] = channels
+        return y
+
+    def output(self, x):
+        self.nodes.append(node_def('output', 'Identity', [x],
+                                   {'T': attr_type(DT_FLOAT)}))
+        return 'output'
+
+    def serialize(self):
+        return b''.join(field_bytes(1, node) for node in self.nodes)
+
+# --------------------------------------------------------------------
+#                                                           generators
+# --------------------------------------------------------------------
+
+def read_cfg(path):
+    """
+    parse a darknet cfg into a list of `(section, options)` pairs
+    """
+    sections = []
+    with open(str(path), 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            if line.startswith('['):
+                sections.append((line.strip('[]'), {}))
+            else:
+                key, value = line.split('=', 1)
+                sections[-1][1][key.strip()] = value.strip()
+    return sections
+
+def yolo_graph(cfg_path, width=1.0, size=None, seed=0):
+    """
+    the network of a darknet cfg, as converted by darkflow. `width`
+    scales the number of filters of every hidden layer
+    """
+    sections = read_cfg(cfg_path)
+    net = sections[0][1]
+    size = size or int(net['height'])
+    writer = GraphWriter(seed)
+    x = writer.placeholder(size, size, int(net['channels']))
+    last_conv = max(idx for idx, (section, _) in enumerate(sections)
+                    if section == 'convolutional')
+    outputs = []
+    for idx, (section, options) in enumerate(sections):
+        if section == 'convolutional':
+            filters = int(options['filters'])
+            if idx != last_conv: # keep the size of the predictions
+                filters = max(1, int(filters * width))
+            x = writer.conv(x, filters, size=int(options['size']),
+                            stride=int(options['stride']),
+                            batch_norm=bool(int(options.get('batch_normalize', 0))),
+                            leaky=options['activation'] == 'leaky')
+        elif section == 'maxpool':
+            x = writer.max_pool(x, int(options['size']), int(options['stride']))
+        elif section == 'reorg':
+            x = writer.reorg(x, int(options['stride']))
+        elif section == 'route':
+            layers = [int(idx) for idx in options['layers'].split(',')]
+            x = writer.concat([outputs[idx] for idx in layers])
+        else:
+            continue # [net], [region]
+        outputs.append(x)
+    writer.output(x)
+    meta = {'net': {'height': size, 'width': size,
+                    'channels': int(net['channels'])},
+            'labels': ['class{}'.format(ii) for ii in range(
+                       int(sections[-1][1].get('classes', 1)))],
+            'thresh': float(sections[-1][1].get('thresh', 0.5)),
+            'anchors': [float(a) for a in sections[-1][1].get(
+                        'anchors', '').split(',') if a.strip()]}
+    return writer, meta
+
+def resnet_graph(depth=50, width=1.0, size=224, seed=0):
+    """
+    a ResNet-style stack of `depth` conv layers in 1x1-3x3-1x1 bottleneck
+    blocks, with a stride 2 stage transition every few blocks. The
+    residual additions are left out - the converter has no `Add` layer
+    """
+    writer = GraphWriter(seed)
+    x = writer.placeholder(size, size, 3)
+    x = writer.conv(x, int(64 * width), size=7, stride=2)
+    x = writer.max_pool(x)
+    num_blocks = max(1, (depth - 2) // 3)
+    prev_stage = 0
+    for block in range(num_blocks):
+        stage = block * 4 // num_blocks
+        stride = 2 if stage != prev_stage else 1
+        prev_stage = stage
+        planes = max(1, int(64 * 2 ** stage * width))
+        x = writer.conv(x, planes, size=1)
+        x = writer.conv(x, planes, size=3, stride=stride)
+        x = writer.conv(x, planes * 4, size=1)
+    x = writer.conv(x, 1000, size=1, batch_norm=False, leaky=False)
+    writer.output(x)
+    return writer, classifier_meta(size, 1000)
+
+def inception_graph(blocks=9, branches=4, width=1.0, size=224, seed=0):
+    """
+    `blocks` inception-style modules, each fanning out into `branches`
+    parallel conv towers (of increasing depth) that are concatenated
+    """
+    writer = GraphWriter(seed)
+    x = writer.placeholder(size, size, 3)
+    x = writer.conv(x, int(64 * width), size=7, stride=2)
+    x = writer.max_pool(x)
+    for block in range(blocks):
+        planes = max(1, int(32 * width * (1 + block // 3)))
+        towers = []
+        for branch in range(branches):
+            y = writer.conv(x, planes, size=1)
+            for _ in range(branch):
+                y = writer.conv(y, planes, size=3)
+            towers.append(y)
+        x = writer.concat(towers)
+        if block % 3 == 2:
+            x = writer.max_pool(x)
+    x = writer.conv(x, 1000, size=1, batch_norm=False, leaky=False)
+    writer.output(x)
+    return writer, classifier_meta(size, 1000)
+
+def classifier_meta(size, num_classes):
+    return {'net': {'height': size, 'width': size, 'channels': 3},
+            'labels': ['class{}'.format(ii) for ii in range(num_classes)],
+            'thresh': 0.5, 'anchors': []}
+
+generators = {'yolo': yolo_graph, 'resnet': resnet_graph,
+              'inception': inception_graph}
+
+def write_graph(writer, meta, out_dir, name):
+    """
+    write `<name>.pb` and `<name>.meta` to `out_dir`, returning their paths
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    graph_path = out_dir / (name + '.pb')
+    meta_path = out_dir / (name + '.meta')
+    with open(str(graph_path), 'wb') as f:
+        f.write(writer.serialize())
+    with open(str(meta_path), 'w') as f:
+        json.dump(meta, f)
+    return graph_path, meta_path
+
+def build(model, args):
+    kwargs = {'width': args.width}
+    if args.size:
+        kwargs['size'] = args.size
+    if model == 'yolo':
+        return yolo_graph(args.cfg, **kwargs)
+    if model == 'resnet':
+        return resnet_graph(args.depth, **kwargs)
+    return inception_graph(args.blocks, args.branches, **kwargs)
+
+def main():
+    repo_root = Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic frozen graph (and .meta) for benchmarks')
+    parser.add_argument('model', choices=sorted(generators))
+    parser.add_argument('out_dir')
+    parser.add_argument('--cfg', default=str(repo_root / 'cfg' / 'yolo-voc.cfg'),
+                        help='darknet cfg of the yolo model')
+    parser.add_argument('--depth', type=int, default=50, help='resnet depth')
+    parser.add_argument('--blocks', type=int, default=9, help='inception blocks')
+    parser.add_argument('--branches', type=int, default=4,
+                        help='inception fan-out')
+    parser.add_argument('--width', type=float, default=1.0,
+                        help='multiplier on the number of filters')
+    parser.add_argument('--size', type=int, default=None, help='input size')
+    args = parser.parse_args()
+
+    writer, meta = build(args.model, args)
+    graph_path, _ = write_graph(writer, meta, args.out_dir, args.model)
+    print('{}: {} nodes, {:.1f} MB'.format(graph_path, len(writer.nodes),
+          graph_path.stat().st_size / 2 ** 20))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+# A direct importer for darknet networks: the layers described by a `.cfg`
+# file, with the weights of a `.weights` file, converted into a MatConvNet
+# DagNN without going through darkflow, TensorFlow or a frozen graph. The
+# cfg is translated into the nodes that darkflow would build for it (see
+# `tf_patterns`), whose weights are views onto a memory map of the
+# `.weights` file at the offset of each layer, and these are converted as
+# the nodes of a frozen graph would be. The layers (and the exported
+# network) are the same as those of the darknet -> darkflow -> `.pb` route,
+# and can be validated in the same way.
+#
+# usage: python import_darknet.py cfg/yolo-voc.cfg yolo-voc.weights yolo.mat
+
+import argparse
+from pathlib import Path
+import numpy as np
+import tf_mcn
+import tf_patterns
+import tf_profile
+import tf_optimize
+import tf_layout
+import mcn_exec
+import mcn_shapes
+import mcn_quantize
+import import_tf
+
+# darkflow's batch norm divides by `sqrt(var) + eps`
+BATCH_NORM_EPS = 1e-5
+LEAK = 0.1
+
+# --------------------------------------------------------------------
+#                                                                 cfg
+# --------------------------------------------------------------------
+
+def read_cfg(path):
+    """
+    parse a darknet cfg into a list of `(section, options)` pairs
+    """
+    sections = []
+    with open(str(path), 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            if line.startswith('['):
+                sections.append((line.strip('[]'), {}))
+            else:
+                key, value = line.split('=', 1)
+                sections[-1][1][key.strip()] = value.strip()
+    if not sections or sections[0][0] not in ['net', 'network']:
+        raise ValueError('{} does not start with a [net] section'.format(path))
+    return sections
+
+def darknet_meta(sections, labels=None):
+    """
+    the darkflow style meta information of a cfg, with the class names in
+    `labels` (a list, by default `class<k>`)
+    """
+    net = sections[0][1]
+    region = sections[-1][1] if sections[-1][0] == 'region' else {}
+    if labels is None:
+        labels = ['class{}'.format(ii)
+                  for ii in range(int(region.get('classes', 1)))]
+    return {'net': {x: int(net[x]) for x in ['height', 'width', 'channels']},
+            'labels': labels,
+            'thresh': float(region.get('thresh', 0.5)),
+            'anchors': [float(a) for a in region.get('anchors', '').split(',')
+                        if a.strip()]}
+
+# --------------------------------------------------------------------
+#                                                             weights
+# --------------------------------------------------------------------
+
+def read_header(path):
+    """
+    the `(major, minor, revision, seen)` header of a `.weights` file, and its
+    size in bytes. Darknet counts the images seen in 64 bits since 0.2
+    """
+    with open(str(path), 'rb') as f:
+        major, minor, revision = [int(x) for x in np.fromfile(f, '<i4', 3)]
+        wide = major * 10 + minor >= 2 and major < 1000 and minor < 1000
+        seen = int(np.fromfile(f, '<i8' if wide else '<i4', 1)[0])
+    return (major, minor, revision, seen), 20 if wide else 16
+
+class WeightReader(object):
+    """
+    The float32 values of a `.weights` file, read in order as views onto a
+    read-only memory map of the file
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self.version, header_bytes = read_header(path)
+        count = (Path(path).stat().st_size - header_bytes) // 4
+        self.data = np.memmap(self.path, dtype='<f4', mode='r',
+                              offset=header_bytes, shape=(count,))
+        self.pos = 0
+
+    def read(self, count, name):
+        if self.pos + count > self.data.size:
+            raise ValueError('{} holds {} values, but {} needs values {} to '
+                             '{}'.format(self.path, self.data.size, name,
+                                         self.pos, self.pos + count))
+        value = self.data[self.pos:self.pos + count]
+        self.pos += count
+        return value
+
+    def check_end(self):
+        if self.pos != self.data.size:
+            raise ValueError('{} holds {} values, the cfg only uses {}'.format(
+                             self.path, self.data.size, self.pos))
+
+# --------------------------------------------------------------------
+#                                                               nodes
+# --------------------------------------------------------------------
+
+NHWC = tf_layout.data_format('NHWC') # darkflow's layout
+
+class NodeBuilder(object):
+    """
+    Build linked `TFNode`s in the form of darkflow's graphs, naming them
+    after the index and type of the darknet layer they belong to
+    """
+    def __init__(self):
+        self.nodes = []
+        self.scope = 'input'
+
+    def add(self, op, inputs=(), name=None, **kwargs):
+        name = name or '{}/{}_{}'.format(self.scope, op, len(self.nodes))
+        node = tf_mcn.TFNode(name, [x.name for x in inputs], op, **kwargs)
+        node.inputs = list(inputs)
+        self.nodes.append(node)
+        return node
+
+    def const(self, value):
+        return self.add('Const', shape=list(value.shape), value=value)
+
+    def conv(self, x, in_channels, options, weights):
+        filters = int(options['filters'])
+        size = int(options['size'])
+        stride = int(options.get('stride', 1))
+        pad = int(options.get('padding', 0))
+        if int(options.get('pad', 0)):
+            pad = size // 2
+        if int(options.get('groups', 1)) != 1:
+            raise NotImplementedError('grouped convolutions are not supported')
+
+        # darknet stores the biases, the batch norm scales, means and
+        # variances, then the filters (as OIHW)
+        biases = weights.read(filters, self.scope)
+        batch_norm = bool(int(options.get('batch_normalize', 0)))
+        if batch_norm:
+            gain, mean, var = [weights.read(filters, self.scope)
+                               for _ in range(3)]
+        kernel = weights.read(filters * in_channels * size * size, self.scope)
+        kernel = tf_layout.mcn_filters(
+            kernel.reshape(filters, in_channels, size, size), 'OIHW')
+
+        y = self.add('Conv2D', [x, self.const(kernel)],
+                     data_format=NHWC, stride=[1, stride, stride, 1],
+                     pad_type='EXPLICIT', explicit_pad=[pad] * 4)
+        if batch_norm:
+            divisor = np.sqrt(var) + np.float32(BATCH_NORM_EPS)
+            y = self.add('Sub', [y, self.const(mean)])
+            y = self.add('RealDiv', [y, self.const(divisor)])
+            y = self.add('Mul', [y, self.const(gain)])
+        y = self.add('BiasAdd', [y, self.const(biases)], data_format=NHWC)
+
+        activation = options.get('activation', 'logistic')
+        if activation == 'leaky':
+            leak = self.add('Mul', [self.const(np.float32(LEAK)), y])
+            y = self.add('Maximum', [leak, y])
+        elif activation != 'linear':
+            raise NotImplementedError('{} activations are not supported'
+                                      .format(activation))
+        return y, filters
+
+    def max_pool(self, x, options):
+        size = int(options['size'])
+        stride = int(options.get('stride', 1))
+        return self.add('MaxPool', [x], data_format=NHWC,
+                        ksize=[1, size, size, 1], stride=[1, stride, stride, 1],
+                        pad_type='SAME')
+
+    def reorg(self, x, options):
+        stride = int(options['stride'])
+        window = [1, stride, stride, 1]
+        return self.add('ExtractImagePatches', [x], data_format=NHWC,
+                        ksize=window, stride=window, rate=[1, 1, 1, 1],
+                        pad_type='VALID')
+
+    def concat(self, xs):
+        """
+        concatenate along channels, pairwise (as concat layers take two
+        inputs)
+        """
+        y = xs[0]
+        for x in xs[1:]:
+            axis = self.const(np.array(3, dtype=np.int32))
+            y = self.add('ConcatV2', [y, x, axis])
+        return y
+
+def build_graph(sections, weights):
+    """
+    the nodes of the network of a cfg, with weights read from `weights` (a
+    `WeightReader`), as a `TFGraph` and its output nodes
+    """
+    builder = NodeBuilder()
+    net = sections[0][1]
+    x = builder.add('Placeholder', name='input')
+    channels = int(net['channels'])
+    outputs = [] # the output node and number of channels of each layer
+    for idx, (section, options) in enumerate(sections[1:]):
+        builder.scope = '{}-{}'.format(idx, section)
+        if section == 'convolutional':
+            x, channels = builder.conv(x, channels, options, weights)
+        elif section == 'maxpool':
+            x = builder.max_pool(x, options)
+        elif section == 'reorg':
+            channels *= int(options['stride']) ** 2
+            x = builder.reorg(x, options)
+        elif section == 'route':
+            routes = [outputs[int(k) + (idx if int(k) < 0 else 0)]
+                      for k in options['layers'].split(',')]
+            x = builder.concat([node for node, _ in routes])
+            channels = sum(c for _, c in routes)
+        elif section in ['region', 'detection', 'cost', 'softmax']:
+            pass # the loss (and decoding) of the outputs is left to the user
+        else:
+            raise NotImplementedError('darknet [{}] layers are not '
+                                      'supported'.format(section))
+        outputs.append((x, channels))
+    head = builder.add('Identity', [x], name='output')
+    return tf_mcn.TFGraph(builder.nodes), [head]
+
+# --------------------------------------------------------------------
+#                                                          Conversion
+# --------------------------------------------------------------------
+
+def convert(cfg_path, weights_path, out_path, labels=None, mat_version='5',
+            fold_batch_norm=False, validate=False, param_format='float32',
+            batch_sizes=(1,), profile=tf_profile.NULL):
+    """
+    convert the darknet network of `cfg_path` with the weights at
+    `weights_path` into a MatConvNet DagNN saved at `out_path`, and return a
+    summary of the result. `labels` is a file with one class name per line.
+    The other options are those of `import_tf.convert`
+    """
+    sections = read_cfg(cfg_path)
+    if labels is not None:
+        with open(str(labels), 'r') as f:
+            labels = [line.strip() for line in f if line.strip()]
+    meta_dict = import_tf.build_meta(darknet_meta(sections, labels))
+
+    weights = WeightReader(weights_path)
+    with profile.stage('build'):
+        tf_graph, heads = build_graph(sections, weights)
+        weights.check_end()
+    patterns = tf_patterns.PatternSet()
+    tf_model = import_tf.build_model(tf_graph, heads, patterns, profile)
+
+    with profile.stage('shapes'):
+        sizes = mcn_shapes.infer_shapes(tf_model, meta_dict['inputs'])
+    folded = []
+    if fold_batch_norm:
+        with profile.stage('fold'):
+            folded = tf_optimize.fold_batch_norm(tf_model)
+    memory = [mcn_shapes.activation_memory(tf_model, sizes, batch_size)
+              for batch_size in batch_sizes]
+
+    num_bytes = sum(param.value.nbytes for param in tf_model.params.values())
+    summary = {'graph': str(cfg_path),
+               'weights': str(weights_path),
+               'version': '.'.join(str(x) for x in weights.version[:3]),
+               'out': None,
+               'nodes': len(tf_graph),
+               'layers': len(tf_model.layers),
+               'params': len(tf_model.params),
+               'param_bytes': num_bytes,
+               'patterns': patterns.stats,
+               'folded': folded,
+               'param_format': param_format,
+               'quantized': [],
+               'sizes': sizes,
+               'memory': memory}
+    if validate:
+        with profile.stage('validate'):
+            summary['validation'] = mcn_exec.validate(
+                tf_graph, tf_model, heads, meta_dict['inputs'])
+    with profile.stage('quantize'):
+        quantization, summary['quantized'] = mcn_quantize.quantize_model(
+            tf_model, param_format)
+    if quantization:
+        meta_dict['quantization'] = quantization
+    import_tf.save_model(out_path, tf_model, meta_dict, mat_version, profile)
+    summary['out'] = str(out_path)
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert a darknet network into a MatConvNet DagNN')
+    parser.add_argument('cfg', help='darknet network description (.cfg)')
+    parser.add_argument('weights', help='darknet weights (.weights)')
+    parser.add_argument('out', help='path of the converted network (.mat)')
+    parser.add_argument('--labels',
+                        help='class names, one per line (default: class<k>)')
+    parser.add_argument('--mat-version', default='5', choices=['5', '7.3'],
+                        help='MAT file format of the output (7.3 files are '
+                        'compressed, which is much slower to write)')
+    parser.add_argument('--fold-batch-norm', action='store_true',
+                        help='fold batch norm layers into the preceding '
+                        'convolutions')
+    parser.add_argument('--validate', action='store_true',
+                        help='check the converted layers against darkflow\'s '
+                        'ops on a random batch, layer by layer (in NumPy)')
+    parser.add_argument('--param-format', default='float32',
+                        choices=mcn_quantize.formats,
+                        help='storage format of the conv filters')
+    parser.add_argument('--batch-sizes', default='1',
+                        help='comma separated batch sizes to estimate the '
+                        'peak activation memory of the network for')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='write a JSON report of the time and memory '
+                        'spent in each stage')
+    args = parser.parse_args(argv)
+
+    profile = tf_profile.NULL
+    if args.profile:
+        profile = tf_profile.Profiler()
+        profile.info.update(graph=args.cfg, mat_version=args.mat_version)
+        profile.start()
+
+    summary = convert(args.cfg, args.weights, args.out, labels=args.labels,
+                      mat_version=args.mat_version,
+                      fold_batch_norm=args.fold_batch_norm,
+                      validate=args.validate,
+                      param_format=args.param_format,
+                      batch_sizes=[int(x) for x in args.batch_sizes.split(',')],
+                      profile=profile)
+
+    if profile is not tf_profile.NULL:
+        profile.stop()
+        print(profile.summary_str())
+        profile.write(args.profile)
+    print('{layers} layers, {params} params ({mb:.1f} MB of weights) from '
+          'darknet {version} weights'.format(
+          mb=summary['param_bytes'] / 2 ** 20, **summary))
+    for estimate in summary['memory']:
+        print('activation memory at batch size {batch_size}: peak {peak:.1f} '
+              'MB at {peak_layer} ({total:.1f} MB if nothing is freed)'.format(
+              peak=estimate['peak_bytes'] / 2 ** 20,
+              total=estimate['total_bytes'] / 2 ** 20, **estimate))
+    if summary['folded']:
+        print('folded {} batch norm layers (max error {:.2e}, relative {:.2e})'
+              .format(len(summary['folded']),
+                      max(x['max_abs_error'] for x in summary['folded']),
+                      max(x['max_rel_error'] for x in summary['folded'])))
+    if summary['quantized']:
+        import_tf.print_quantization(summary['quantized'])
+    if 'validation' in summary:
+        import_tf.print_validation(summary['validation'])
+
+if __name__ == '__main__':
+    main()
@@ -1,349 +1,709 @@
-import sys
 import os
+import gc
+import mmap
+import contextlib
 import argparse
-import importlib
-import code
-import re
-import numpy as np
-from math import floor, ceil
-import scipy.io
-import scipy.misc
-import google.protobuf.text_format import ipdb
-import tensorflow as tf
 from pathlib import Path
 import json
-from tensorflow.python.lib.io import file_io
-from tensorflow.core.framework import graph_pb2
-from tensorflow.core.protobuf import meta_graph_pb2
-from google.protobuf import text_format
+from collections import OrderedDict
 import tf_mcn
+import tf_tensor
+import tf_proto
+import tf_checkpoint
+import tf_patterns
+import tf_cache
+import tf_profile
+import tf_optimize
+import tf_plan
+import tf_store
+import tf_spill
+import tf_layout
+import mcn_exec
+import mcn_shapes
+import mcn_export
+import mcn_quantize
 
 verbose = 0 
-# --------------------------------------------------------------------
-#                                                   conversion helpers
-# --------------------------------------------------------------------
-
-# convert tf data types into numpy data types
-tf2np_dtype = {
-    1: np.float32, 
-    3: np.int32, 
-}
-
-# convert data format enumerations into a canonical array ordering
-# matching the mcn convention of (H,W,C,N)
-tf2mcn_order = {
-    'NHWC': [1,2,3,0], 
-}
 
 # --------------------------------------------------------------------
 #                                                       Load layers 
 # --------------------------------------------------------------------
 
-# Unlike caffe, Tensorflow stores the network structure in a single file
-base = Path.home() / 'coding/libs/darkflow/built_graph'
-path = base / 'yolo-voc-v2.pb'
-meta_path = base / 'yolo-voc-v2.meta'
-out_path = Path.home() / 'coding/libs/matconvnets/contrib-matconvnet/contrib/mcnYOLO/models/yolo-voc-mcn.mat'
-
-# import the graph definition from TF
-graph_def = graph_pb2.GraphDef() 
+def load_graph(path, check_tf=False):
+    """
+    Unlike caffe, Tensorflow stores the network structure in a single file.
+    It is read from a read-only mapping of the file, which is kept open so
+    that Const values can be left in place and read lazily on export.
+    Nodes are decoded one at a time by `tf_proto`, which does not need
+    TensorFlow
+    """
+    with open(str(path), "rb") as f:
+      graph_buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if check_tf:
+        diffs = tf_proto.cross_check(graph_buf)
+        for diff in diffs:
+            print('TF cross-check: {}'.format(diff))
+        if diffs:
+            raise ValueError('graph reader disagrees with TensorFlow')
+    return graph_buf
+
+def load_meta(meta_path):
+    """
+    parse the meta info as json, since the protobuf appears to have issues
+    """
+    with open(str(meta_path), "rb") as f:
+        return json.loads(f.read().decode('utf-8'))
 
-# parse the data
-with open(str(path), "rb") as f:
-  graph_def.ParseFromString(f.read())
+# --------------------------------------------------------------------
+#                                                   Reachability pruning
+# --------------------------------------------------------------------
 
-# parse the meta info as json, since the protobuf appears to have issues
-meta_raw = file_io.FileIO(str(meta_path), "rb").read().decode('utf-8')
-meta = json.loads(meta_raw)
+def find_reachable(graph_buf, outputs):
+    """
+    return the serialized nodes (`tf_proto.NodeDef`s, in graph order) that
+    the `outputs` tensors depend on through data edges, and the total
+    number of nodes. Only the names and inputs of nodes are read, so the
+    attributes of training ops, summaries and other unreachable subgraphs
+    are never decoded
+    """
+    nodes = OrderedDict()
+    num_nodes = 0
+    for node in tf_proto.iter_nodes(graph_buf):
+        nodes.setdefault(node.name, node) # first wins, as in TFGraph
+        num_nodes += 1
+
+    reachable = set()
+    stack = []
+    for output in outputs:
+        name, _, _ = tf_mcn.parse_input_name(output)
+        if name not in nodes:
+            raise KeyError('output {} is not in the graph'.format(output))
+        stack.append(name)
+    while stack:
+        name = stack.pop()
+        if name in reachable:
+            continue
+        reachable.add(name)
+        for input_name in nodes[name].input:
+            in_name, _, is_control = tf_mcn.parse_input_name(input_name)
+            if is_control or in_name in reachable:
+                continue
+            if in_name not in nodes:
+                raise KeyError('no node named {} in graph'.format(in_name))
+            stack.append(in_name)
+
+    return ([node for name, node in nodes.items() if name in reachable],
+            num_nodes)
 
 # --------------------------------------------------------------------
 #                                        Read ops into TF node objects
 # --------------------------------------------------------------------
 
-node_list = []
+def read_nodes(graph_buf, nodes=None, checkpoint=None,
+               profile=tf_profile.NULL):
+    """
+    wrap each of the `tf_proto.NodeDef`s read from the serialized graph
+    (all of them by default, or only those that are needed, see
+    `find_reachable`) in a `TFNode`, keeping the attributes needed by the
+    mcn layers. Variables are read from `checkpoint` (a
+    `tf_checkpoint.Checkpoint`) and become `Const` nodes, as they would in
+    a frozen graph
+    """
+    node_list = []
 
-for idx, node in enumerate(graph_def.node):
+    if nodes is None:
+        nodes = tf_proto.iter_nodes(graph_buf)
+    nodes = profile.iterate('parse', nodes)
+    for idx, node in enumerate(nodes):
 
-    # process each node according to its op
-    op = node.op
-    name = node.name 
-    inputs = node.input
-    kwargs = {}
+        # process each node according to its op
+        op = node.op
+        name = node.name 
+        inputs = node.input
+        attr = node.attr
+        kwargs = {}
 
-    if verbose:
-        print('-------------------')
-        print('Node: {:3d} Added op \'{}\' ({})'.format(idx, op, name))
-
-    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    if op in ['Placeholder', 'NoOp', 'Pad', 'Sub', 'RealDiv', 
-                               'Mul', 'Maximum', 'Identity']:
-        pass
-
-    elif op in ['Const']:
-        tensor = node.attr['value'].tensor
-        shape = [x.size for x in tensor.tensor_shape.dim]
-        np_dtype = tf2np_dtype[node.attr['dtype'].type]
-
-        # handle differnt forms of data storage
-        if len(tensor.float_val) > 0:
-            value = tensor.float_val
-        elif len(tensor.int_val) > 0:
-            value = tensor.int_val
-        elif len(tensor.tensor_content) > 0:
-            raw = np.fromstring(tensor.tensor_content, dtype=np_dtype)
-            value = np.reshape(raw, shape)
+        if verbose:
+            print('-------------------')
+            print('Node: {:3d} Added op \'{}\' ({})'.format(idx, op, name))
+
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        if op in ['Placeholder', 'NoOp', 'Pad', 'Sub', 'RealDiv', 
+                                   'Mul', 'Maximum', 'Identity', 'ReadVariableOp']:
+            pass
+
+        elif op in ['Add', 'AddV2', 'Sqrt', 'Rsqrt']:
+            # only found in constant expressions (such as `var + eps`), which
+            # are folded by `tf_optimize.simplify_graph`
+            pass
+
+        elif op in ['VariableV2', 'VarHandleOp']:
+            # name-based checkpoints (`tf.train.Saver`) key each value by the
+            # name of its variable op
+            if checkpoint is None:
+                raise ValueError('variable {} can only be read from a '
+                                 'checkpoint'.format(name))
+            with profile.stage('decode'):
+                value = checkpoint.tensor(name)
+            kwargs['shape'] = list(value.shape)
+            kwargs['value'] = value
+            kwargs['variable'] = name
+            op = 'Const'
+
+        elif op in ['Const']:
+            # packed values are left in the mapped file behind a lazy handle,
+            # the (small) remainder are decoded into read-only arrays
+            with profile.stage('decode'):
+                tensor = attr['value'].tensor
+                if tensor.content_span is not None:
+                    offset, length = tensor.content_span
+                    value = tf_tensor.TensorHandle(graph_buf, offset, length,
+                                                   tensor.dtype,
+                                                   tf_tensor.tensor_shape(tensor))
+                else:
+                    value = tf_tensor.decode_tensor(tensor)
+            kwargs['shape'] = list(value.shape)
+            kwargs['value'] = value
+
+
+        elif op in ['MaxPool', 'AvgPool']:
+            kwargs['data_format'] = tf_layout.data_format(attr['data_format'].s.decode('utf-8'))
+            kwargs['ksize'] = attr['ksize'].list.i
+            kwargs['stride'] = attr['strides'].list.i
+            kwargs['pad_type'] = attr['padding'].s.decode('utf-8')
+
+        elif op in ['BiasAdd']:
+            kwargs['data_format'] = tf_layout.data_format(attr['data_format'].s.decode('utf-8'))
+
+        elif op in ['Conv2D']:
+            kwargs['data_format'] = tf_layout.data_format(attr['data_format'].s.decode('utf-8'))
+            kwargs['stride'] = attr['strides'].list.i
+            kwargs['pad_type'] = attr['padding'].s.decode('utf-8')
+            if kwargs['pad_type'] == 'EXPLICIT':
+                pairs = attr['explicit_paddings'].list.i
+                kwargs['explicit_pad'] = [pairs[2 * dim + side] for dim in
+                                          kwargs['data_format'][:2]
+                                          for side in (0, 1)]
+
+        elif op in ['ExtractImagePatches']:
+            kwargs['data_format'] = tf_layout.data_format('NHWC') # always
+            kwargs['stride'] = attr['strides'].list.i
+            kwargs['ksize'] = attr['ksizes'].list.i
+            kwargs['rate'] = attr['rates'].list.i
+            kwargs['pad_type'] = attr['padding'].s.decode('utf-8')
+
+        elif op in ['SpaceToDepth']:
+            kwargs['data_format'] = tf_layout.data_format(attr['data_format'].s.decode('utf-8'))
+            kwargs['block_size'] = attr['block_size'].i
+
+        elif op in ['ConcatV2']:
+            pass # the axis is an input, in the layout of the activations
         else:
-            raise ValueError('Unrecognised tensor values')
-
-        kwargs['shape'] = shape
-        kwargs['value'] = value
-
-
-    elif op in ['MaxPool']:
-        kwargs['data_format'] = tf2mcn_order[node.attr['data_format'].s.decode('utf-8')]
-        kwargs['ksize'] = node.attr['ksize'].list.i
-        kwargs['stride'] = node.attr['strides'].list.i
-        kwargs['pad_type'] = node.attr['padding'].s.decode('utf-8')
+            raise ValueError('Unrecognised op: {}'.format(op))
 
-    elif op in ['BiasAdd']:
-        kwargs['data_format'] = tf2mcn_order[node.attr['data_format'].s.decode('utf-8')]
-
-    elif op in ['Conv2D']:
-        kwargs['data_format'] = tf2mcn_order[node.attr['data_format'].s.decode('utf-8')]
-        kwargs['stride'] = node.attr['strides'].list.i
-        kwargs['pad_type'] = node.attr['padding'].s.decode('utf-8')
-
-    elif op in ['ExtractImagePatches']:
-        kwargs['stride'] = node.attr['strides'].list.i
-        kwargs['ksize'] = node.attr['ksize'].list.i
-        kwargs['rate'] = node.attr['rates'].list.i
-        kwargs['pad_type'] = node.attr['padding'].s.decode('utf-8')
-
-    elif op in ['ConcatV2']:
-        kwargs['axis'] = node.attr['N'].i
-    else:
-        raise ValueError('Unrecognised op: {}'.format(op))
-
-    tf_node = tf_mcn.TFNode(name, inputs, op, **kwargs)
-    node_list.append(tf_node)
+        tf_node = tf_mcn.TFNode(name, inputs, op, **kwargs)
+        node_list.append(tf_node)
+        profile.count_op(node.op, node.span[1],
+                         kwargs['value'].nbytes if 'value' in kwargs else 0)
+    return resolve_variable_reads(node_list)
 
+def resolve_variable_reads(node_list):
+    """
+    replace the ops that read a variable (`Identity` for reference
+    variables, as in `w/read`, and `ReadVariableOp` for resource variables)
+    with copies of its `Const`, so that the layer patterns see the weights
+    as they would be in a frozen graph
+    """
+    variables = {node.name: node for node in node_list
+                 if getattr(node, 'variable', None)}
+    if not variables:
+        return node_list
+    for idx, node in enumerate(node_list):
+        if node.op not in ['Identity', 'ReadVariableOp']:
+            continue
+        src_name, _, _ = tf_mcn.parse_input_name(node.input_names[0])
+        src = variables.get(src_name)
+        if src is not None:
+            node_list[idx] = tf_mcn.TFNode(node.name, [], 'Const',
+                                           shape=src.shape, value=src.value,
+                                           variable=src.variable)
+    return node_list
 
 # --------------------------------------------------------------------
 #                                        construct computational graph
 # --------------------------------------------------------------------
 
-# graph construction is done in reverse order, using input_names
-# to set references to previous nodes in the graph
-node_list = list(reversed(node_list))
-node_names = [node.name for node in node_list]
-
-for idx, node in enumerate(node_list):
-    if len(node.input_names) == 0:
-        if verbose:
-            print('Parameter node {}, skipping'.format(node.name))
-    else:
-        for input_name in node.input_names:
-            input_node = node_list[node_names.index(input_name)]
-            node.inputs.append(input_node)
-    if verbose:
-        print('processing node {}/{}'.format(idx, len(node_list)))
-
-tf_graph = tf_mcn.TFGraph(node_list)
-
-# build layers from root
-head = tf_graph.nodes[node_names.index('output')]
-layers = []
-layerNames = [] # ensure unique names for each new layer
-
-def tf2mcn(node):
+def build_graph(node_list, profile=tf_profile.NULL):
     """
-    Overlay a graph of mcn nodes over the tf computation graph. A TF
-    node is considered to have been visited once its `mcn` attribute
-    has been set.
+    graph construction is done in reverse order, using input_names
+    to set references to previous nodes in the graph (resolved through
+    the name index held by the graph)
     """
-
-    # ----------------------------------
-    # Base cases - input nodes for graph
-    # ----------------------------------
-    if not node.inputs:
-        if node.op == 'Placeholder':
-            value = []
-        elif node.op == 'Const':
-            value = node.value
-        else:
-            error('unrecognised input {}'.format(type(node)))
-        node.mcn = tf_mcn.McnNode(name=node.name, value=value, op=node.op) 
-        return node
-
-    # post-order traversal - gather expression inputs for each op
-    mcnIns = []
-    for in_node in node.inputs:
-        if not hasattr(in_node, 'mcn'):
-            in_node = tf2mcn(in_node)
-        mcnIns.append(in_node.mcn)
-
-    # ----------------------------------
-    # Expression resolution
-    # ----------------------------------
-    # Matconvnet works at the 'layer' abstraction, while TensorFlow works at
-    # the `op` level of abstraction. To reconcile this difference, the graph
-    # of tf nodes is converted into a set of mcn nodes by pattern matching 
-    # common operations and clustering them into layers.
-
-    node_candidates = ['Sub', 'RealDiv', 'Mul', 'Pad', 'Identity']
-    layer_candidates = ['Conv2D', 'MaxPool', 'ConcatV2', 'ExtractImagePatches']
-    special_cases =  ['BiasAdd', 'Maximum']
-
-    # tf nodes -> mcn nodes
-    if node.op in node_candidates:
-        if node.op in ['Sub', 'RealDiv', 'Mul']:
-            name = node.name
-            value = []
-        elif node.op == 'Identity':
-            src_node, = tf_mcn.parse_inputs(mcnIns, ['Any'])
-            name = src_node.name
-            value = []
-        elif node.op == 'Pad':
-            [pad_node, src_node] = tf_mcn.parse_inputs(mcnIns, ['Const', 'Any'])
-            name = src_node.name
-            value = pad_node.value
-        node.mcn = tf_mcn.McnNode(name=name, value=value, op=node.op, input_nodes=mcnIns) 
-
-    # tf nodes -> mcn layers
-    elif node.op in layer_candidates:
-        name = tf_mcn.buildMcnLayerName(node.op, layerNames)
-
-        if node.op == 'Conv2D':
-            layerType = tf_mcn.McnConv
-        elif node.op == 'MaxPool':
-            layerType = lambda x,y,z: tf_mcn.McnPooling(x,y,z,'max')
-        elif node.op == 'AvgPool':
-            layerType = lambda x,y,z: tf_mcn.McnPooling(x,y,z,'avg')
-        elif node.op == 'ConcatV2':
-            layerType = tf_mcn.McnConcat
-        elif node.op == 'ExtractImagePatches':
-            layerType = tf_mcn.McnExtractImagePatches
-
-        mcnLayer = layerType(name, node, mcnIns) 
-        layers.append(mcnLayer)
-        layerNames.append(name)
-        node.mcn = mcnLayer
-
-    elif node.op in special_cases:
-        if node.op == 'BiasAdd':
-            # while the bias add op is a generic operation, we perform
-            # pattern matching here to check for the presence of a batch norm layer
-            is_bn_layer = tf_mcn.McnBatchNorm.is_batch_norm_expression(node, mcnIns)
-
-            # ----------------------------------------------------------
-            if not is_bn_layer:
-
-                # if batch norm is not used, then we merge the bias with
-                # the preceeding convolutional layer (if one exists)
-                for node in mcnIns:
-                    if node.op == 'Conv2D':
-                        conv_node = node
-                    elif node.op == 'Const':
-                        bias_node = node
-                    else:
-                        ipdb.set_trace()
-                        raise NotImplementedError('no support for solo biases yet')
-
-                if 'conv_node' not in locals():
-                    raise NotImplementedError('no support for solo biases yet')
-
-                conv_node.bias_term = 1 # bias is now used
-                bias_name = conv_node.name + '_bias'
-                conv_node.params.append(bias_name)
-                conv_node.param_values[bias_name] = bias_node.value
-                value = []
-                node.mcn = tf_mcn.McnNode(node.name, value, node.op, mcnIns) 
-            # ----------------------------------------------------------
-            else:
-                # construct matconvnet layer name
-                name = tf_mcn.buildMcnLayerName(node.op, layerNames)
-                mcnLayer = tf_mcn.McnBatchNorm(name, node, mcnIns) 
-                layers.append(mcnLayer)
-                layerNames.append(name)
-                node.mcn = mcnLayer
-            # ----------------------------------------------------------
-
-        elif node.op == 'Maximum':
-            # similarly as above, the elementwise max is a generic operation, but 
-            # we perform pattern matching here to check for the presence of a relu
-            is_leaky_relu_layer = tf_mcn.McnReLU.is_leaky_relu_expression(node, mcnIns)
-
-            # ----------------------------------------------------------
-            if not is_leaky_relu_layer:
-                print('not handled yet')
-                ipdb.set_trace()
-            # ----------------------------------------------------------
-            # construct matconvnet layer name
-            name = tf_mcn.buildMcnLayerName(node.op, layerNames)
-            mcnLayer = tf_mcn.McnReLU(name, node, mcnIns) 
-            layers.append(mcnLayer)
-            layerNames.append(name)
-            node.mcn = mcnLayer
-
-    else:
-        raise ValueError('node op {} not recognised'.format(node.op))
+    with profile.stage('link'):
+        node_list = list(reversed(node_list))
+        tf_graph = tf_mcn.TFGraph(node_list)
+        tf_graph.link()
 
     if verbose:
-        print('processed: {}'.format(node.name))
-    return node
-
-# magic
-tf2mcn(head)
+        print('linked {} nodes'.format(len(tf_graph)))
+    return tf_graph
 
-tf_model = tf_mcn.TFModel()
-for layer in layers:
-    tf_model.addLayer(layer)
+def build_model(tf_graph, heads, patterns=None, profile=tf_profile.NULL):
+    """
+    convert the part of the graph that `heads` depend on into a `TFModel`,
+    by overlaying a graph of mcn nodes and layers matched by `patterns`
+    (see `tf_patterns`) on the tf computation graph
+    """
+    if patterns is None:
+        patterns = tf_patterns.PatternSet()
+    overlay = tf_patterns.Overlay()
+
+    # magic - an explicit-stack walk rather than recursion, so that
+    # arbitrarily deep graphs do not run into the interpreter recursion limit.
+    # Every input of a node has been converted by the time it is reached
+    with profile.stage('match'):
+        tf_layout.assign_formats(tf_graph, heads)
+        for node in tf_graph.post_order(heads):
+            patterns.convert(node, overlay)
+            if verbose:
+                print('processed: {}'.format(node.name))
+
+    with profile.stage('assemble'):
+        tf_model = tf_mcn.TFModel()
+        for layer in overlay.layers:
+            tf_model.addLayer(layer)
+    return tf_model
+
+def refresh_model(plan, graph_buf, spans, checkpoint=None,
+                  budget=tf_spill.NO_BUDGET, profile=tf_profile.NULL):
+    """
+    rebuild the model of an earlier conversion of the same network (see
+    `tf_plan`) with the weights of the graph at `spans`, decoding only the
+    nodes that hold them. Returns the model and the number of nodes read
+    """
+    with profile.stage('check'):
+        source_spans = tf_plan.check_graph(plan, graph_buf, spans)
+    nodes = read_nodes(graph_buf, tf_proto.iter_nodes(graph_buf, source_spans),
+                       checkpoint, profile)
+    with profile.stage('assemble'):
+        tf_model = tf_plan.build_model(plan, {node.name: node.value
+                                              for node in nodes}, budget)
+    return tf_model, len(nodes)
 
 # --------------------------------------------------------------------
 #                                            extract meta information
 # --------------------------------------------------------------------
 
-anchors = meta['anchors']
-net_meta = meta['net']
+def build_meta(meta):
+    """
+    gather the darkflow meta information into the contents of `net.meta`
+    """
+    net_meta = meta['net']
+    in_size = [net_meta[x] for x in ['height', 'width', 'channels']]
 
-in_size = [net_meta[x] for x in ['height', 'width', 'channels']]
-out_size = meta['out_size']
+    mnormalization = {}
+    mnormalization['imageSize'] = in_size
 
-classes = meta['labels']
-mnormalization = {}
-mnormalization['imageSize'] = in_size
+    meta_dict = {'inputs': in_size,
+                 'normalization': mnormalization, 
+                 'classes': meta['labels'],
+                 'thresh': meta['thresh'],
+                 'anchors': meta['anchors'],
+                 }
+    return meta_dict
 
 # --------------------------------------------------------------------
-#                                                    Convert to MATLAB
+#                                                          Save output
 # --------------------------------------------------------------------
 
-# net.meta
-meta_dict = {'inputs': in_size,
-             'normalization': mnormalization, 
-             'classes': meta['labels'],
-             'thresh': meta['thresh'],
-             'anchors': meta['anchors'],
-             }
-
-mmeta = tf_mcn.dictToMatlabStruct(meta_dict)
-
-mnet = {'layers': np.empty(shape=[0,], dtype=tf_mcn.mlayerdt),
-        'params': np.empty(shape=[0,], dtype=tf_mcn.mparamdt),
-        'meta': mmeta}
-
-for layer in tf_model.layers.values():
-    mnet['layers'] = np.append(mnet['layers'], layer.toMatlab(), axis=0)
-
-for param in tf_model.params.values():
-    mnet['params'] = np.append(mnet['params'], param.toMatlab(), axis=0)
-
-# # to row
-mnet['layers'] = mnet['layers'].reshape(1,-1)
-mnet['params'] = mnet['params'].reshape(1,-1)
+def save_model(out_path, tf_model, meta_dict, mat_version='7.3',
+               profile=tf_profile.NULL):
+    """
+    layers and params are converted by `toMatlab` one at a time as they
+    are written, rather than being gathered into a single in-memory struct
+    """
+    print('Saving network to {}'.format(str(out_path)))
+    if mat_version == '7.3':
+        mcn_export.save_mat_v73(out_path, tf_model, meta_dict, profile=profile)
+    else:
+        mmeta = tf_mcn.dictToMatlabStruct(meta_dict)
+        mcn_export.save_mat_v5(out_path, tf_model, mmeta, profile=profile)
 
 # --------------------------------------------------------------------
-#                                                          Save output
+#                                                          Conversion
 # --------------------------------------------------------------------
 
-print('Saving network to {}'.format(str(out_path)))
-scipy.io.savemat(str(out_path), mnet, oned_as='column')
+@contextlib.contextmanager
+def collector_paused():
+    """
+    pause Python's cyclic garbage collector. A conversion builds millions
+    of long-lived objects (nodes, messages, layers) and leaves little
+    cyclic garbage, but every full collection rescans all of them, which
+    made collection the largest single cost on graphs of a few hundred
+    thousand nodes
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+@collector_paused()
+def convert(path, meta_path, out_path, mat_version='7.3', topology_only=False,
+            check_tf=False, cache_dir=None, cache_size=None,
+            fold_batch_norm=False, outputs=None, validate=False,
+            param_format='float32', weight_store=None, checkpoint=None,
+            param_blob=False, save_plan=None, plan=None, batch_sizes=(1,),
+            simplify=True, memory_budget=None, scratch_dir=None,
+            profile=tf_profile.NULL):
+    """
+    convert the frozen graph at `path` (with darkflow meta info at
+    `meta_path`) into a MatConvNet DagNN saved at `out_path`, computing the
+    `outputs` tensors (default: `output`), and return a summary of it.
+
+    mat_version     MAT file version of the output
+    topology_only   convert the layers without reading weights or writing
+    check_tf        cross-check the graph reader with TF (see `tf_proto`)
+    cache_dir       reuse earlier conversions, up to `cache_size` bytes of
+                    them (see `tf_cache`)
+    fold_batch_norm fold batch norms into convs (see `tf_optimize`)
+    validate        run the layers against the graph (see `mcn_exec`)
+    param_format    precision of the conv filters (see `mcn_quantize`)
+    weight_store    write params to a store in that directory (`tf_store`)
+    checkpoint      read variables from that bundle (see `tf_checkpoint`)
+    param_blob      write params to a `.bin` file (`mcn_export`), uncached
+    save_plan, plan save, or convert from, a layer plan (see `tf_plan`)
+    batch_sizes     estimate activation memory for these (see `mcn_shapes`)
+    simplify        simplify the graph first (see `tf_optimize`)
+    memory_budget   spill arrays beyond it to `scratch_dir` (see `tf_spill`)
+    profile         records the cost of each stage (see `tf_profile`)
+    """
+    if param_blob and weight_store is not None:
+        raise ValueError('params go either to a blob or to a weight store')
+    if plan is not None:
+        plan = tf_plan.load_plan(plan)
+        if outputs and list(outputs) != plan.outputs:
+            raise ValueError('the plan was made for outputs {}'.format(
+                             plan.outputs))
+        if validate:
+            raise ValueError('validation needs the graph to be converted '
+                             'without a plan')
+        outputs = plan.outputs
+    cache = None
+    if (cache_dir is not None and not topology_only and not param_blob
+            and save_plan is None):
+        cache = tf_cache.ConversionCache(cache_dir,
+                                         cache_size or tf_cache.DEFAULT_MAX_BYTES)
+        inputs = [path, meta_path]
+        if checkpoint is not None:
+            inputs += tf_checkpoint.bundle_files(checkpoint)
+        key = cache.key(*inputs, mat_version=mat_version,
+                        fold_batch_norm=fold_batch_norm, outputs=outputs,
+                        validate=validate, param_format=param_format,
+                        simplify=simplify, batch_sizes=list(batch_sizes),
+                        weight_store=weight_store and os.path.abspath(weight_store))
+        summary = cache.get(key, out_path)
+        if summary is not None:
+            summary.update(graph=str(path), out=str(out_path), cached=True)
+            return summary
+
+    graph_buf = load_graph(path, check_tf=check_tf)
+    meta = load_meta(meta_path)
+    budget = tf_spill.NO_BUDGET
+    if memory_budget is not None:
+        budget = tf_spill.SpillBudget(memory_budget, scratch_dir)
+
+    outputs = outputs or ['output']
+    with profile.stage('prune'):
+        nodes, num_nodes = find_reachable(graph_buf, outputs)
+    spans = [node.span for node in nodes]
+
+    if checkpoint is not None:
+        checkpoint = tf_checkpoint.Checkpoint(checkpoint)
+    patterns = tf_patterns.PatternSet()
+    simplified = None
+    if plan is not None:
+        tf_model, num_read = refresh_model(plan, graph_buf, spans, checkpoint,
+                                           budget, profile)
+    else:
+        tf_graph = build_graph(read_nodes(graph_buf, nodes, checkpoint, profile),
+                               profile)
+        del nodes # everything needed has been read into the graph
+        heads = [tf_graph[output] for output in outputs]
+        num_read = len(tf_graph)
+
+        # the plan binds weights to the nodes as read from the graph, and to
+        # the constants folded from them
+        tf_nodes = tf_graph.nodes
+        if simplify:
+            with profile.stage('simplify'):
+                tf_graph, simplified = tf_optimize.simplify_graph(
+                    tf_graph, heads, budget)
+            heads = [tf_graph[output] for output in outputs]
+            tf_nodes = tf_nodes + tf_graph.nodes
+        tf_model = build_model(tf_graph, heads, patterns, profile)
+        if save_plan is not None:
+            with profile.stage('plan'):
+                tf_plan.save_plan(tf_plan.make_plan(tf_model, tf_nodes,
+                                                    outputs, graph_buf, spans),
+                                  save_plan)
+
+    with profile.stage('shapes'):
+        sizes = mcn_shapes.infer_shapes(tf_model, build_meta(meta)['inputs'])
+
+    folded = []
+    if fold_batch_norm and not topology_only:
+        with profile.stage('fold'):
+            folded = tf_optimize.fold_batch_norm(tf_model, budget=budget)
+    memory = [mcn_shapes.activation_memory(tf_model, sizes, batch_size)
+              for batch_size in batch_sizes]
+
+    num_bytes = sum(param.value.nbytes for param in tf_model.params.values())
+    summary = {'graph': str(path),
+               'out': None,
+               'outputs': outputs,
+               'nodes': num_read,
+               'graph_nodes': num_nodes,
+               'layers': len(tf_model.layers),
+               'params': len(tf_model.params),
+               'param_bytes': num_bytes,
+               'patterns': patterns.stats,
+               'folded': folded,
+               'param_format': param_format,
+               'quantized': [],
+               'sizes': sizes,
+               'memory': memory,
+               'simplified': simplified,
+               'planned': plan is not None,
+               'cached': False}
+    if validate and not topology_only:
+        with profile.stage('validate'):
+            summary['validation'] = mcn_exec.validate(
+                tf_graph, tf_model, heads, build_meta(meta)['inputs'])
+    if not topology_only:
+        meta_dict = build_meta(meta)
+        with profile.stage('quantize'):
+            quantization, summary['quantized'] = mcn_quantize.quantize_model(
+                tf_model, param_format, budget=budget)
+        if quantization:
+            meta_dict['quantization'] = quantization
+        if weight_store is not None:
+            store = tf_store.WeightStore(weight_store)
+            with profile.stage('store'):
+                meta_dict['weights'] = tf_store.store_params(tf_model, store)
+            summary['store'] = dict(store.stats, root=str(weight_store))
+        if param_blob:
+            blob_path = Path(out_path).with_suffix('.bin')
+            table = mcn_export.write_param_blob(blob_path, tf_model,
+                                                profile=profile)
+            meta_dict['blob'] = OrderedDict([('file', blob_path.name),
+                                             ('params', table)])
+            mcn_export.clear_param_values(tf_model)
+            summary['blob'] = str(blob_path)
+        save_model(out_path, tf_model, meta_dict, mat_version, profile)
+        summary['out'] = str(out_path)
+    if memory_budget is not None:
+        summary['spill'] = dict(budget.stats, budget=int(memory_budget))
+    budget.close()
+    if cache is not None:
+        cache.put(key, out_path, summary)
+    return summary
+
+def print_validation(validation):
+    for record in validation['layers']:
+        if record['max_rel_error'] is None:
+            detail = record.get('error') or 'shape {} != {}'.format(
+                     record['shape'], record['expected_shape'])
+        else:
+            detail = 'max error {:.2e} (relative {:.2e})'.format(
+                     record['max_abs_error'], record['max_rel_error'])
+        print('  {:<4} {:<24} {}'.format('ok' if record['ok'] else 'FAIL',
+                                          record['layer'], detail))
+    print('validation {}'.format('passed' if validation['ok'] else 'FAILED'))
+
+def print_quantization(quantized):
+    for record in quantized:
+        print('  {:<24} {:>8.2f} MB -> {:>6.2f} MB  max error {:.2e} '
+              '(relative {:.2e})'.format(record['param'],
+              record['bytes'] / 2 ** 20, record['stored_bytes'] / 2 ** 20,
+              record['max_abs_error'], record['max_rel_error']))
+    before = sum(record['bytes'] for record in quantized)
+    after = sum(record['stored_bytes'] for record in quantized)
+    print('stored {} filters as {} ({:.1f} MB -> {:.1f} MB)'.format(
+          len(quantized), quantized[0]['format'], before / 2 ** 20,
+          after / 2 ** 20))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert a frozen TensorFlow graph into a MatConvNet DagNN')
+    parser.add_argument('graph', help='frozen GraphDef (.pb)')
+    parser.add_argument('meta', help='darkflow meta information (.meta, JSON)')
+    parser.add_argument('out', help='path of the converted network (.mat)')
+    parser.add_argument('--mat-version', default='7.3', choices=['5', '7.3'],
+                        help='MAT file format of the output. v7.3 files are '
+                        'written incrementally (requires h5py) and are not '
+                        'limited to 2GB')
+    parser.add_argument('--topology-only', action='store_true',
+                        help='convert the network structure and report its '
+                        'size without reading the weights or writing any output')
+    parser.add_argument('--check-tf', action='store_true',
+                        help='cross-check the graph reader against '
+                        'TensorFlow\'s own protobuf parser (requires tensorflow)')
+    parser.add_argument('--cache', nargs='?', metavar='DIR', default=None,
+                        const=str(tf_cache.default_cache_dir()),
+                        help='reuse the output of a previous conversion of '
+                        'the same graph and meta info, from a cache in DIR '
+                        '(default: $MCN_TF_CACHE or ~/.cache/mcnTensorflow)')
+    parser.add_argument('--output', action='append', dest='outputs',
+                        metavar='TENSOR',
+                        help='output tensor to convert (repeat for several '
+                        'heads, default: output). Only the nodes needed to '
+                        'compute the outputs are read')
+    parser.add_argument('--fold-batch-norm', action='store_true',
+                        help='fold batch norm layers into the preceding '
+                        'convolutions, so that the exported network runs '
+                        'faster')
+    parser.add_argument('--validate', action='store_true',
+                        help='check the converted layers against the graph '
+                        'on a random batch, layer by layer (in NumPy)')
+    parser.add_argument('--param-format', default='float32',
+                        choices=mcn_quantize.formats,
+                        help='storage format of the conv filters: float16, or '
+                        'int8 with a scale and zero point per output channel. '
+                        'Load reduced precision networks with '
+                        'dequantizeParams (see matlab/)')
+    parser.add_argument('--checkpoint', metavar='PREFIX',
+                        help='read the variables of a training graph from '
+                        'the TensorFlow checkpoint at PREFIX (PREFIX.index '
+                        'and PREFIX.data-*), instead of converting a frozen '
+                        'graph')
+    parser.add_argument('--weight-store', metavar='DIR',
+                        help='write the weights to a content-addressed store '
+                        'in DIR shared with other networks, storing each '
+                        'distinct chunk once, and reference them from the '
+                        'output. Load such networks with loadWeights (see '
+                        'matlab/)')
+    parser.add_argument('--param-blob', action='store_true',
+                        help='write the weights to a raw binary file next to '
+                        'the output (OUT with a .bin suffix), referenced by '
+                        'offset, so that they can be read sequentially or '
+                        'memory-mapped. Load such networks with '
+                        'loadParamBlob (see matlab/)')
+    parser.add_argument('--save-plan', metavar='PLAN',
+                        help='save the layer plan of the conversion to PLAN, '
+                        'for converting later snapshots of the network with '
+                        '--plan')
+    parser.add_argument('--plan', metavar='PLAN',
+                        help='convert a snapshot of a network converted '
+                        'before with --save-plan, reading only its weights. '
+                        'The conversion fails if the graph structure has '
+                        'changed')
+    parser.add_argument('--batch-sizes', default='1',
+                        help='comma separated batch sizes to estimate the '
+                        'peak activation memory of the network for '
+                        '(default: 1)')
+    parser.add_argument('--no-simplify', action='store_false', dest='simplify',
+                        help='match the layers on the graph as read, without '
+                        'folding constants, bypassing identities or merging '
+                        'pads into convolutions first')
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        metavar='GB',
+                        help='keep at most this many GB of the arrays '
+                        'computed during the conversion (folded and '
+                        'quantized weights) in memory, spilling the rest to '
+                        'memory-mapped files until they are exported')
+    parser.add_argument('--scratch-dir', metavar='DIR',
+                        help='directory for spilled arrays (default: the '
+                        'system temporary directory)')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='write a JSON report of the time and memory '
+                        'spent in each stage, and of the nodes of each op')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='include tracemalloc peaks in the profile '
+                        '(slows the conversion down)')
+    parser.add_argument('--cprofile', metavar='STATS',
+                        help='dump cProfile stats of the conversion to STATS')
+    args = parser.parse_args(argv)
+
+    profile = tf_profile.NULL
+    if args.profile or args.cprofile:
+        profile = tf_profile.Profiler(trace_memory=args.trace_memory,
+                                      cprofile_path=args.cprofile)
+        profile.info.update(graph=args.graph, mat_version=args.mat_version)
+        profile.start()
+
+    summary = convert(args.graph, args.meta, args.out,
+                      mat_version=args.mat_version,
+                      topology_only=args.topology_only,
+                      check_tf=args.check_tf,
+                      cache_dir=args.cache,
+                      fold_batch_norm=args.fold_batch_norm,
+                      outputs=args.outputs,
+                      validate=args.validate,
+                      param_format=args.param_format,
+                      weight_store=args.weight_store,
+                      checkpoint=args.checkpoint,
+                      param_blob=args.param_blob,
+                      save_plan=args.save_plan,
+                      plan=args.plan,
+                      batch_sizes=[int(x) for x in args.batch_sizes.split(',')],
+                      simplify=args.simplify,
+                      memory_budget=(None if args.memory_budget is None
+                                     else int(args.memory_budget * 2 ** 30)),
+                      scratch_dir=args.scratch_dir,
+                      profile=profile)
+
+    if profile is not tf_profile.NULL:
+        profile.stop()
+        print(profile.summary_str())
+        if args.profile:
+            profile.write(args.profile)
+    if summary['cached']:
+        print('Copied cached network to {}'.format(args.out))
+    if summary.get('planned'):
+        print('Refreshed the weights of the network planned in {}'.format(
+              args.plan))
+    print('{layers} layers, {params} params ({mb:.1f} MB of weights) from '
+          '{nodes} of {graph_nodes} nodes'.format(
+          mb=summary['param_bytes'] / 2 ** 20, **summary))
+    if summary.get('simplified'):
+        print('simplified the graph from {nodes} to {simplified_nodes} nodes '
+              '({folded} folded, {identities} identities bypassed, {pads} '
+              'pads merged)'.format(**summary['simplified']))
+    for estimate in summary.get('memory', []):
+        print('activation memory at batch size {batch_size}: peak {peak:.1f} '
+              'MB at {peak_layer} ({total:.1f} MB if nothing is freed)'.format(
+              peak=estimate['peak_bytes'] / 2 ** 20,
+              total=estimate['total_bytes'] / 2 ** 20, **estimate))
+    if summary['folded']:
+        print('folded {} batch norm layers (max error {:.2e}, relative {:.2e})'
+              .format(len(summary['folded']),
+                      max(x['max_abs_error'] for x in summary['folded']),
+                      max(x['max_rel_error'] for x in summary['folded'])))
+    if summary.get('quantized'):
+        print_quantization(summary['quantized'])
+    if 'blob' in summary:
+        print('wrote weights to {}'.format(summary['blob']))
+    if 'spill' in summary:
+        print('kept {kept_mb:.1f} MB of computed arrays in memory, spilled '
+              '{spilled_mb:.1f} MB ({spilled} arrays) to disk'.format(
+              kept_mb=summary['spill']['kept_bytes'] / 2 ** 20,
+              spilled_mb=summary['spill']['spilled_bytes'] / 2 ** 20,
+              **summary['spill']))
+    if 'store' in summary:
+        print('stored weights in {root}: {new_mb:.1f} of {mb:.1f} MB new '
+              '({new_chunks} of {chunks} chunks)'.format(
+              new_mb=summary['store']['new_bytes'] / 2 ** 20,
+              mb=summary['store']['bytes'] / 2 ** 20, **summary['store']))
+    if 'validation' in summary:
+        print_validation(summary['validation'])
+    for name, stats in summary['patterns'].items():
+        if stats['tried']:
+            print('  pattern {:<24} {matched:4d} matched / {tried:4d} tried'
+                  .format(name, **stats))
+
+if __name__ == '__main__':
+    main()
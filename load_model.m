@@ -1,4 +1,5 @@
 % try out an example tf model after conversion
 modelPath = fullfile(vl_rootnn, 'contrib/mcnYOLO/models/yolo-voc-mcn.mat')
 x = load(modelPath)
+x = dequantizeParams(x) % only needed for float16/int8 exports
 net = dagnn.DagNN.loadobj(x)
@@ -0,0 +1,66 @@
+classdef SpaceToDepth < dagnn.Layer
+%SPACETODEPTH Moves blocks of pixels into channels
+%   Each BLOCKSIZE(1) x BLOCKSIZE(2) block of the input is moved into the
+%   channels of one output position, in (block row, block column, channel)
+%   order, as TensorFlow's space_to_depth (and YOLOv2's reorg layer, as
+%   exported by darkflow) do. Rows and columns beyond the last full block
+%   are dropped.
+%
+%   The rearrangement is a single gather through INDEX, which gives the
+%   input element (1-based, column-major, within one sample) copied to
+%   each output element. The converter precomputes it for inputs of size
+%   INPUTSIZE; it is rebuilt for inputs of any other size.
+
+  properties
+    blockSize = [2 2]
+    inputSize = [0 0 0]
+    index = []
+  end
+
+  methods
+    function outputs = forward(obj, inputs, params)
+      x = inputs{1} ;
+      [index, outSize] = obj.gatherIndex(size(x)) ;
+      n = size(x, 4) ;
+      x = reshape(x, [], n) ;
+      outputs{1} = reshape(x(index, :), [outSize n]) ;
+    end
+
+    function [derInputs, derParams] = backward(obj, inputs, params, derOutputs)
+      x = inputs{1} ;
+      index = obj.gatherIndex(size(x)) ;
+      n = size(x, 4) ;
+      dx = zeros(numel(x) / n, n, 'like', x) ;
+      dx(index, :) = reshape(derOutputs{1}, [], n) ;
+      derInputs{1} = reshape(dx, size(x)) ;
+      derParams = {} ;
+    end
+
+    function outputSizes = getOutputSizes(obj, inputSizes)
+      sz = inputSizes{1} ;
+      outputSizes{1} = [floor(sz(1:2) ./ obj.blockSize), ...
+                        sz(3) * prod(obj.blockSize), sz(4)] ;
+    end
+
+    function [index, outSize] = gatherIndex(obj, inSize)
+      inSize(end+1:3) = 1 ;
+      inSize = inSize(1:3) ;
+      b = obj.blockSize ;
+      outSize = [floor(inSize(1:2) ./ b), inSize(3) * prod(b)] ;
+      if ~isequal(obj.inputSize(:)', inSize)
+        [oh, ow, oc] = ndgrid(0:outSize(1)-1, 0:outSize(2)-1, 0:outSize(3)-1) ;
+        by = floor(oc / (b(2) * inSize(3))) ;
+        bx = mod(floor(oc / inSize(3)), b(2)) ;
+        c = mod(oc, inSize(3)) ;
+        src = (oh * b(1) + by) + inSize(1) * ((ow * b(2) + bx) + inSize(2) * c) ;
+        obj.index = uint32(src(:) + 1) ;
+        obj.inputSize = inSize ;
+      end
+      index = obj.index ;
+    end
+
+    function obj = SpaceToDepth(varargin)
+      obj.load(varargin{:}) ;
+    end
+  end
+end
@@ -0,0 +1,49 @@
+function net = dequantizeParams(net)
+%DEQUANTIZEPARAMS Restores single precision params in a converted network
+%   NET = DEQUANTIZEPARAMS(NET) takes the struct loaded from a network
+%   exported with a reduced precision `--param-format`, and converts the
+%   params listed in NET.META.QUANTIZATION back to single precision, so
+%   that NET can be passed to `dagnn.DagNN.loadobj`:
+%
+%     float16 params are stored as their uint16 bit patterns.
+%     int8 params are stored with a SCALE and ZEROPOINT per slice along
+%       dimension DIM, and restored as (value - zeroPoint) * scale.
+
+  if ~isfield(net.meta, 'quantization'), return ; end
+  q = net.meta.quantization ;
+  for ii = 1:numel(net.params)
+    name = net.params(ii).name ;
+    if ~isfield(q, name), continue ; end
+    info = q.(name) ;
+    value = net.params(ii).value ;
+    switch info.format
+      case 'float16'
+        value = halfToSingle(value) ;
+      case 'int8'
+        shape = ones(1, max(ndims(value), info.dim)) ;
+        shape(info.dim) = numel(info.scale) ;
+        zeroPoint = reshape(single(info.zeroPoint), shape) ;
+        scale = reshape(single(info.scale), shape) ;
+        value = (single(value) - zeroPoint) .* scale ;
+      otherwise
+        error('unknown param format %s', info.format) ;
+    end
+    net.params(ii).value = value ;
+  end
+  net.meta = rmfield(net.meta, 'quantization') ;
+
+% ------------------------------------
+function y = halfToSingle(h)
+% ------------------------------------
+  bits = uint32(h) ;
+  sgn = bitshift(bitand(bits, 32768), 16) ;
+  expo = bitand(bitshift(bits, -10), 31) ;
+  mant = bitand(bits, 1023) ;
+  % normal numbers: rebias the exponent from 15 to 127
+  out = bitor(sgn, bitor(bitshift(expo + 112, 23), bitshift(mant, 13))) ;
+  special = (expo == 31) ; % inf and nan
+  out(special) = bitor(sgn(special), ...
+                       bitor(uint32(255 * 2^23), bitshift(mant(special), 13))) ;
+  y = reshape(typecast(out(:), 'single'), size(h)) ;
+  sub = (expo == 0) ; % zeros and subnormals
+  y(sub) = single(mant(sub)) * 2^-24 .* (1 - 2 * single(sgn(sub) > 0)) ;
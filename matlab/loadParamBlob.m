@@ -0,0 +1,44 @@
+function net = loadParamBlob(net, blobPath, varargin)
+%LOADPARAMBLOB Reads the params of a converted network from a binary blob
+%   NET = LOADPARAMBLOB(NET, BLOBPATH) takes the struct loaded from a
+%   network exported with `--param-blob`, and fills in the value of each
+%   param listed in NET.META.BLOB.PARAMS from the blob file at BLOBPATH (by
+%   default written next to the .mat file, as NET.META.BLOB.FILE), so that
+%   NET can be passed to `dagnn.DagNN.loadobj`. Values are stored in
+%   column-major, little-endian order, each at a 64 byte aligned OFFSET.
+%
+%   The whole blob is read with a single sequential `fread`, unless
+%   LOADPARAMBLOB(..., 'memmap', true) is given, in which case each value
+%   is mapped with `memmapfile` and only read as it is accessed.
+
+  opts.memmap = false ;
+  opts = vl_argparse(opts, varargin) ;
+
+  if ~isfield(net.meta, 'blob'), return ; end
+  table = net.meta.blob.params ;
+  if ~opts.memmap
+    f = fopen(blobPath, 'r', 'ieee-le') ;
+    if f < 0, error('could not open param blob %s', blobPath) ; end
+    bytes = fread(f, Inf, '*uint8') ;
+    fclose(f) ;
+  end
+
+  for ii = 1:numel(net.params)
+    name = net.params(ii).name ;
+    if ~isfield(table, name), continue ; end
+    entry = table.(name) ;
+    shape = entry.shape(:)' ;
+    if prod(shape) == 0
+      value = zeros(shape, entry.dataType) ;
+    elseif opts.memmap
+      m = memmapfile(blobPath, 'Offset', entry.offset, 'Repeat', 1, ...
+                     'Format', {entry.dataType, shape, 'value'}) ;
+      value = m.Data.value ;
+    else
+      count = prod(shape) * numel(typecast(zeros(1, entry.dataType), 'uint8')) ;
+      value = typecast(bytes(entry.offset + (1:count)), entry.dataType) ;
+      value = reshape(value, shape) ;
+    end
+    net.params(ii).value = value ;
+  end
+  net.meta = rmfield(net.meta, 'blob') ;
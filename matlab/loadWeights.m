@@ -0,0 +1,33 @@
+function net = loadWeights(net, storeDir)
+%LOADWEIGHTS Reads the params of a converted network from a weight store
+%   NET = LOADWEIGHTS(NET, STOREDIR) takes the struct loaded from a network
+%   exported with `--weight-store STOREDIR`, and reads the value of each
+%   param listed in NET.META.WEIGHTS from the chunks it was stored in, so
+%   that NET can be passed to `dagnn.DagNN.loadobj`. Values are stored as
+%   raw bytes in column-major order, split into chunks named by the sha256
+%   of their contents, under STOREDIR/chunks/<first two characters>/.
+
+  if ~isfield(net.meta, 'weights'), return ; end
+  w = net.meta.weights ;
+  for ii = 1:numel(net.params)
+    name = net.params(ii).name ;
+    if ~isfield(w, name), continue ; end
+    info = w.(name) ;
+    chunks = cellstr(info.chunks) ;
+    bytes = cell(numel(chunks), 1) ;
+    for jj = 1:numel(chunks)
+      path = fullfile(storeDir, 'chunks', chunks{jj}(1:2), chunks{jj}) ;
+      f = fopen(path, 'r') ;
+      if f < 0, error('missing chunk %s of %s', path, name) ; end
+      bytes{jj} = fread(f, Inf, '*uint8') ;
+      fclose(f) ;
+    end
+    bytes = vertcat(bytes{:}, zeros(0, 1, 'uint8')) ;
+    if strcmp(info.dataType, 'logical')
+      value = logical(bytes) ;
+    else
+      value = typecast(bytes, info.dataType) ;
+    end
+    net.params(ii).value = reshape(value, info.shape(:)') ;
+  end
+  net.meta = rmfield(net.meta, 'weights') ;
@@ -0,0 +1,323 @@
+# A NumPy executor for converted networks, used to check conversions
+# numerically without MATLAB. It runs the mcn layers of a `TFModel` on a
+# batch of inputs, and (as a reference) the ops of the frozen graph they
+# were converted from, and compares the activations layer by layer.
+#
+# Both executors share the same kernels, which compute in NHWC order; the
+# nodes of NCHW graphs are run on NHWC views of their inputs (see
+# `tf_layout`), and their outputs compared as such. The mcn layers store
+# their filters as HWIO, as MatConvNet does. Note that layers are run
+# with the values and settings held by the converted layer objects, which
+# is what the check is about - not with the MATLAB implementation of
+# each `dagnn` layer.
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import tf_mcn
+import tf_tensor
+import tf_layout
+import mcn_shapes
+
+# mcn arrays are (H,W,C,N), executor arrays (N,H,W,C)
+mcn2nhwc_axis = [1, 2, 3, 0]
+
+# --------------------------------------------------------------------
+#                                                              kernels
+# --------------------------------------------------------------------
+
+def pad_nhwc(x, pad, value=0):
+    """
+    pad the spatial dims of `x` by `[top bottom left right]`
+    """
+    top, bottom, left, right = [int(p) for p in pad]
+    if not (top or bottom or left or right):
+        return x
+    return np.pad(x, ((0, 0), (top, bottom), (left, right), (0, 0)),
+                  mode='constant', constant_values=value)
+
+def windows(x, size, stride, rate=(1, 1)):
+    """
+    a strided view of the `size` windows of `x` (N,H,W,C), with shape
+    (N, H', W', C, kh, kw)
+    """
+    (kh, kw), (sh, sw), (rh, rw) = size, stride, rate
+    span = ((kh - 1) * rh + 1, (kw - 1) * rw + 1)
+    view = sliding_window_view(x, span, axis=(1, 2))
+    return view[:, ::sh, ::sw, :, ::rh, ::rw]
+
+def conv2d(x, filters, bias=None, pad=(0, 0, 0, 0), stride=(1, 1),
+           chunk_bytes=64 * 2 ** 20):
+    """
+    convolution as a GEMM over im2col patches. Patches are gathered for a
+    block of output rows at a time, so that at most `chunk_bytes` of them
+    are materialized at once
+    """
+    x = pad_nhwc(x, pad)
+    kh, kw, cin, cout = filters.shape
+    weights = np.ascontiguousarray(filters).reshape(-1, cout)
+    if (kh, kw) == (1, 1) and tuple(stride) == (1, 1):
+        out = (x.reshape(-1, cin) @ weights).reshape(x.shape[:3] + (cout,))
+    else:
+        view = windows(x, (kh, kw), stride)
+        num, out_h, out_w = view.shape[:3]
+        out = np.empty((num, out_h, out_w, cout), dtype=np.result_type(x, filters))
+        row_bytes = out_w * kh * kw * cin * x.itemsize
+        rows = max(1, chunk_bytes // max(1, row_bytes))
+        for n in range(num):
+            for r0 in range(0, out_h, rows):
+                block = view[n, r0:r0 + rows]
+                patches = block.transpose(0, 1, 3, 4, 2).reshape(-1, kh * kw * cin)
+                out[n, r0:r0 + rows] = (patches @ weights).reshape(
+                                            block.shape[:2] + (cout,))
+    if bias is not None:
+        out += bias.reshape(-1)
+    return out
+
+def max_pool(x, size, stride, pad=(0, 0, 0, 0)):
+    x = pad_nhwc(x, pad, value=-np.inf)
+    return windows(x, size, stride).max(axis=(-2, -1))
+
+def avg_pool(x, size, stride, pad=(0, 0, 0, 0)):
+    """
+    the mean of each window over the elements of `x` it covers, leaving
+    the padding out (as TF's `AvgPool` and MatConvNet do): the sums are
+    divided by those of a padded mask of ones
+    """
+    sums = windows(pad_nhwc(x, pad), size, stride).sum(axis=(-2, -1))
+    ones = np.ones((1,) + x.shape[1:3] + (1,), dtype=x.dtype)
+    counts = windows(pad_nhwc(ones, pad), size, stride).sum(axis=(-2, -1))
+    return sums / counts
+
+def extract_patches(x, size, stride, rate=(1, 1), pad=(0, 0, 0, 0)):
+    """
+    gather each window into the channels of one output position, in
+    (row, column, channel) order as `tf.extract_image_patches` does
+    """
+    x = pad_nhwc(x, pad)
+    view = windows(x, size, stride, rate)
+    num, out_h, out_w = view.shape[:3]
+    return view.transpose(0, 1, 2, 4, 5, 3).reshape(num, out_h, out_w, -1)
+
+def space_to_depth(x, index, out_size):
+    """
+    gather the elements of each (N,H,W,C) sample through a space-to-depth
+    `index` over its column-major elements, into an (N,H,W,C) output of
+    (H,W,C) `out_size`
+    """
+    num = x.shape[0]
+    flat = x.transpose(0, 3, 2, 1).reshape(num, -1)
+    y = flat[:, index.astype(np.intp) - 1]
+    return y.reshape([num] + list(out_size[::-1])).transpose(0, 3, 2, 1)
+
+# --------------------------------------------------------------------
+#                                                       mcn executor
+# --------------------------------------------------------------------
+
+def run_layer(layer, inputs):
+    """
+    compute the outputs of an mcn layer from its (NHWC) inputs
+    """
+    value = lambda name: tf_tensor.resolve(layer.param_values[name])
+    if isinstance(layer, tf_mcn.McnConv):
+        bias = value(layer.params[1]) if layer.bias_term else None
+        return conv2d(inputs[0], value(layer.params[0]), bias,
+                      layer.pad, layer.stride)
+    if isinstance(layer, tf_mcn.McnBatchNorm):
+        mean, divisor, gain, bias = [tf_tensor.resolve(x).reshape(-1) for x in
+            [layer.mean, layer.variance, layer.scale_factor, layer.bias_term]]
+        return (inputs[0] - mean) / divisor * gain + bias
+    if isinstance(layer, tf_mcn.McnReLU):
+        x = inputs[0]
+        return np.where(x > 0, x, x * layer.leak)
+    if isinstance(layer, tf_mcn.McnPooling):
+        pool = max_pool if layer.method == 'max' else avg_pool
+        return pool(inputs[0], layer.kernel_size, layer.stride, layer.pad)
+    if isinstance(layer, tf_mcn.McnConcat):
+        return np.concatenate(inputs, axis=mcn2nhwc_axis[layer.axis])
+    if isinstance(layer, tf_mcn.McnSpaceToDepth):
+        height, width, channels = layer.input_size
+        block_y, block_x = [int(b) for b in layer.block_size]
+        return space_to_depth(inputs[0], layer.index,
+                              [height // block_y, width // block_x,
+                               channels * block_y * block_x])
+    if isinstance(layer, tf_mcn.McnExtractImagePatches):
+        return extract_patches(inputs[0], layer.kernel_size, layer.stride,
+                               layer.rate, layer.pad)
+    raise NotImplementedError('no executor for {}'.format(type(layer).__name__))
+
+def run_model(tf_model, feeds, keep=True):
+    """
+    run the layers of `tf_model` in order on `feeds` (a dict of NHWC input
+    arrays by variable name), returning the dict of all variables (or
+    only the final outputs, without `keep`)
+    """
+    values = dict(feeds)
+    for layer in tf_model.layers.values():
+        outputs = run_layer(layer, [values[name] for name in layer.inputs])
+        values[layer.outputs[0]] = outputs
+    if not keep:
+        consumed = {name for layer in tf_model.layers.values()
+                    for name in layer.inputs}
+        values = {name: x for name, x in values.items() if name not in consumed}
+    return values
+
+# --------------------------------------------------------------------
+#                                                 reference executor
+# --------------------------------------------------------------------
+
+def pad_for(node, x, size, stride, rate=(1, 1)):
+    if node.pad_type == 'EXPLICIT':
+        return node.explicit_pad
+    if node.pad_type == 'SAME':
+        return mcn_shapes.same_pad(x.shape[1:3], size, stride, rate)
+    return [0, 0, 0, 0]
+
+def nhwc(x, node):
+    return tf_layout.to_nhwc(x, tf_layout.node_format(node))
+
+def native(x, node):
+    """
+    an NHWC array in the layout of `node`
+    """
+    return tf_layout.from_nhwc(x, tf_layout.node_format(node))
+
+def spatial(values, node):
+    """
+    the (height, width) entries of a per-dimension attribute list
+    """
+    order = getattr(node, 'data_format', mcn2nhwc_axis)
+    return [values[order[0]], values[order[1]]]
+
+def run_node(node, inputs):
+    """
+    compute the output of a frozen graph node from its inputs
+    """
+    op = node.op
+    if op == 'Const':
+        return tf_tensor.resolve(node.value)
+    if op == 'Identity':
+        return inputs[0]
+    if op == 'Pad':
+        x, paddings = inputs
+        return np.pad(x, np.asarray(paddings, dtype=np.int64), mode='constant')
+    if op in ['Add', 'AddV2']:
+        return inputs[0] + inputs[1]
+    if op == 'Sqrt':
+        return np.sqrt(inputs[0])
+    if op == 'Rsqrt':
+        return 1 / np.sqrt(inputs[0])
+    if op == 'Sub':
+        return inputs[0] - inputs[1]
+    if op == 'RealDiv':
+        return inputs[0] / inputs[1]
+    if op == 'Mul':
+        return inputs[0] * inputs[1]
+    if op == 'Maximum':
+        return np.maximum(inputs[0], inputs[1])
+    if op == 'BiasAdd':
+        return native(nhwc(inputs[0], node) + inputs[1], node)
+    if op == 'Conv2D':
+        x, filters = nhwc(inputs[0], node), inputs[1]
+        stride = spatial(node.stride, node)
+        return native(conv2d(x, filters, None,
+                             pad_for(node, x, filters.shape[:2], stride),
+                             stride), node)
+    if op in ['MaxPool', 'AvgPool']:
+        x = nhwc(inputs[0], node)
+        size, stride = spatial(node.ksize, node), spatial(node.stride, node)
+        pool = max_pool if op == 'MaxPool' else avg_pool
+        return native(pool(x, size, stride, pad_for(node, x, size, stride)),
+                      node)
+    if op == 'ExtractImagePatches':
+        x = inputs[0]
+        size, stride = spatial(node.ksize, node), spatial(node.stride, node)
+        rate = spatial(node.rate, node)
+        return extract_patches(x, size, stride, rate,
+                               pad_for(node, x, size, stride, rate))
+    if op == 'SpaceToDepth':
+        block = [node.block_size] * 2
+        return native(extract_patches(nhwc(inputs[0], node), block, block),
+                      node)
+    if op == 'ConcatV2':
+        return np.concatenate(inputs[:-1], axis=int(inputs[-1]))
+    raise NotImplementedError('no reference for op {}'.format(op))
+
+def run_graph(tf_graph, heads, feeds):
+    """
+    run the nodes that `heads` depend on, returning the dict of all node
+    outputs by name. `feeds` gives the values of the placeholders
+    """
+    values = {}
+    for node in tf_graph.post_order(heads):
+        if node.op == 'Placeholder':
+            values[node.name] = feeds[node.name]
+        else:
+            values[node.name] = run_node(node, [values[x.name] for x in node.inputs])
+    return values
+
+# --------------------------------------------------------------------
+#                                                          validation
+# --------------------------------------------------------------------
+
+def compare(ours, ref):
+    ours, ref = np.asarray(ours), np.asarray(ref)
+    if ours.shape != ref.shape:
+        return {'shape': list(ours.shape), 'expected_shape': list(ref.shape),
+                'max_abs_error': None, 'max_rel_error': None}
+    max_error = float(np.abs(ours - ref).max()) if ref.size else 0.0
+    scale = float(np.abs(ref).max()) if ref.size else 0.0
+    return {'shape': list(ours.shape), 'expected_shape': list(ref.shape),
+            'max_abs_error': max_error,
+            'max_rel_error': max_error / scale if scale else max_error}
+
+def validate(tf_graph, tf_model, heads, input_size, batch_size=2, seed=0,
+             isolate=True, tolerance=1e-3):
+    """
+    run the converted model and the frozen graph on the same random batch
+    of `input_size` (H,W,C) inputs, and compare the output of every layer
+    with that of the graph node it was converted from (viewed as NHWC, in
+    whatever layout the graph computes). With `isolate`, each layer is fed
+    the reference values of its inputs, so that an error is reported at
+    the layer that causes it rather than at every layer after it.
+
+    Returns a dict with one record per layer, and `ok` if every layer
+    matches to within `tolerance` (relative to its largest activation)
+    """
+    rng = np.random.RandomState(seed)
+    placeholders = [node for node in tf_graph.nodes if node.op == 'Placeholder']
+    shape = (batch_size,) + tuple(input_size)
+    feeds = {node.name: rng.standard_normal(shape).astype(np.float32)
+             for node in placeholders}
+    ref = run_graph(tf_graph, heads,
+                    {node.name: native(feeds[node.name], node)
+                     for node in placeholders})
+    ref_nhwc = lambda name: nhwc(ref[name], tf_graph[name])
+
+    # the graph node computing each variable of the model
+    var_nodes = {name: name for name in feeds}
+    for layer in tf_model.layers.values():
+        var_nodes[layer.outputs[0]] = layer.tf_name
+
+    values = dict(feeds)
+    records = []
+    for layer in tf_model.layers.values():
+        if isolate:
+            inputs = [ref_nhwc(var_nodes[name]) for name in layer.inputs]
+        else:
+            inputs = [values[name] for name in layer.inputs]
+        try:
+            out = run_layer(layer, inputs)
+            record = compare(out, ref_nhwc(layer.tf_name))
+        except (ValueError, TypeError) as exc: # e.g. after a failed layer
+            out = None
+            record = {'error': str(exc), 'max_abs_error': None,
+                      'max_rel_error': None}
+        record['layer'] = layer.name
+        record['node'] = layer.tf_name
+        record['ok'] = (record['max_rel_error'] is not None
+                        and record['max_rel_error'] <= tolerance)
+        records.append(record)
+        values[layer.outputs[0]] = out
+    return {'ok': all(record['ok'] for record in records),
+            'batch_size': batch_size, 'isolate': isolate,
+            'layers': records}
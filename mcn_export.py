@@ -0,0 +1,374 @@
+# Writers for saving converted networks in formats that can be read by
+# `dagnn.DagNN.loadobj`
+
+import time
+from collections import OrderedDict
+import numpy as np
+import scipy.io
+import tf_mcn
+import tf_tensor
+import tf_profile
+
+# --------------------------------------------------------------------
+#                                                     MAT v5 (scipy)
+# --------------------------------------------------------------------
+
+def save_mat_v5(path, tf_model, mmeta, profile=tf_profile.NULL):
+    """
+    save the model with `scipy.io.savemat`. The layer and param struct
+    arrays are preallocated and filled in place, but the whole network is
+    still held in memory and v5 files are limited to 2GB - prefer
+    `save_mat_v73` for large models
+    """
+    with profile.stage('to_matlab'):
+        mlayers = np.empty(shape=[1, len(tf_model.layers)], dtype=tf_mcn.mlayerdt)
+        for ii, layer in enumerate(tf_model.layers.values()):
+            mlayers[0, ii] = layer.toMatlab()[0]
+
+        mparams = np.empty(shape=[1, len(tf_model.params)], dtype=tf_mcn.mparamdt)
+        for ii, param in enumerate(tf_model.params.values()):
+            mparams[0, ii] = param.toMatlab()[0]
+
+    with profile.stage('write'):
+        mnet = {'layers': mlayers, 'params': mparams, 'meta': mmeta}
+        scipy.io.savemat(str(path), mnet, oned_as='column')
+
+# --------------------------------------------------------------------
+#                                           MAT v7.3 (streaming HDF5)
+# --------------------------------------------------------------------
+
+# MATLAB class names for the numeric types that can be stored natively
+np2mat_class = {
+    np.dtype('float64'): 'double',
+    np.dtype('float32'): 'single',
+    np.dtype('int8'): 'int8',
+    np.dtype('uint8'): 'uint8',
+    np.dtype('int16'): 'int16',
+    np.dtype('uint16'): 'uint16',
+    np.dtype('int32'): 'int32',
+    np.dtype('uint32'): 'uint32',
+    np.dtype('int64'): 'int64',
+    np.dtype('uint64'): 'uint64',
+    np.dtype('bool'): 'logical',
+}
+mat2np_dtype = {mclass: dtype for dtype, mclass in np2mat_class.items()}
+
+# v7.3 files are HDF5 files with a 512 byte MATLAB header in the userblock
+MAT73_USERBLOCK = 512
+
+def mat73_header():
+    text = ('MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: {} '
+            'HDF5 schema 1.00 .').format(time.strftime('%a %b %d %H:%M:%S %Y'))
+    header = text.ljust(116).encode('ascii')
+    header += b'\x00' * 8 + b'\x00\x02' + b'IM' # subsys offset, version, endian
+    return header.ljust(MAT73_USERBLOCK, b'\x00')
+
+class Mat73Writer(object):
+    """
+    Incrementally write a matconvnet network to a MATLAB v7.3 (HDF5) file.
+    `layers` and `params` are stored as 1xN struct arrays whose fields are
+    resizable, chunked datasets of object references, so each record is
+    written as soon as it is passed in and nothing but the current record
+    is held in memory. Param values are written in slabs into chunked,
+    compressed datasets.
+
+    Usage:
+        with Mat73Writer(path) as writer:
+            writer.add_meta(meta_dict)
+            for layer in layers: writer.add_layer(layer)
+            for param in params: writer.add_param(param)
+    """
+
+    def __init__(self, path, compression='gzip', compression_opts=4,
+                 compress_bytes=2 ** 16, slab_bytes=64 * 2 ** 20,
+                 index_chunk=256, profile=tf_profile.NULL):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError('h5py is required to write MAT v7.3 files, '
+                              '(use the v5 format instead to avoid it)')
+        self.h5py = h5py
+        self.path = str(path)
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.compress_bytes = compress_bytes
+        self.slab_bytes = slab_bytes
+        self.index_chunk = index_chunk
+        self.profile = profile
+        self.num_refs = 0
+        self.f = h5py.File(self.path, 'w', userblock_size=MAT73_USERBLOCK,
+                           libver='earliest')
+        self.refs = self.f.create_group('#refs#')
+        self.struct_arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.f is None:
+            return
+        with self.profile.stage('write'):
+            self.f.close()
+            self.f = None
+            with open(self.path, 'r+b') as f:
+                f.write(mat73_header())
+
+    # ---------------------------------------------------------
+    #                                               public API
+    # ---------------------------------------------------------
+
+    def add_meta(self, meta):
+        with self.profile.stage('write'):
+            self.write(self.f, 'meta', meta)
+
+    def add_layer(self, layer):
+        self.add_record('layers', tf_mcn.mlayerdt, layer)
+
+    def add_param(self, param):
+        self.add_record('params', tf_mcn.mparamdt, param)
+
+    def add_record(self, name, dtype, obj):
+        with self.profile.stage('to_matlab'):
+            record = obj.toMatlab()[0]
+        with self.profile.stage('write'):
+            self.append(name, dtype, record)
+
+    # ---------------------------------------------------------
+    #                                             struct arrays
+    # ---------------------------------------------------------
+
+    def append(self, name, dtype, record):
+        """
+        append a record to the 1xN struct array `name`, with one reference
+        dataset per field (stored transposed, as Nx1, following MATLAB's
+        column-major convention). Unlike cell arrays, these datasets carry
+        no `MATLAB_class` attribute - that is how MATLAB tells the fields
+        of a struct array apart from those of a scalar struct
+        """
+        fields = [field for field, _ in dtype]
+        if name not in self.struct_arrays:
+            group = self.f.create_group(name)
+            self.set_struct_attrs(group, fields)
+            for field in fields:
+                group.create_dataset(field, shape=(0, 1), maxshape=(None, 1),
+                                     chunks=(self.index_chunk, 1),
+                                     dtype=self.h5py.ref_dtype)
+            self.struct_arrays[name] = group
+        group = self.struct_arrays[name]
+        for field in fields:
+            dset = group[field]
+            num = dset.shape[0]
+            dset.resize((num + 1, 1))
+            dset[num, 0] = self.write_ref(record[field])
+
+    # ---------------------------------------------------------
+    #                                           value encoding
+    # ---------------------------------------------------------
+
+    def write_ref(self, value):
+        name = str(self.num_refs)
+        self.num_refs += 1
+        return self.write(self.refs, name, value).ref
+
+    def set_struct_attrs(self, group, fields):
+        vlen = self.h5py.vlen_dtype(np.dtype('S1'))
+        mfields = np.empty(len(fields), dtype=vlen)
+        for ii, field in enumerate(fields):
+            mfields[ii] = np.array(list(field), dtype='S1')
+        group.attrs['MATLAB_class'] = np.bytes_('struct')
+        group.attrs.create('MATLAB_fields', mfields, dtype=vlen)
+
+    def write(self, parent, name, value):
+        """
+        write `value` as the MATLAB object `name` under `parent` and return
+        the created HDF5 object
+        """
+        if isinstance(value, dict):
+            return self.write_struct(parent, name, value)
+        if isinstance(value, str):
+            return self.write_char(parent, name, value)
+        if value is None:
+            return self.write_empty(parent, name, 'double', (0, 0))
+        if isinstance(value, (list, tuple)):
+            if value and all(isinstance(x, str) for x in value):
+                value = tf_mcn.rowcell(value)
+            else:
+                value = np.array(value, dtype=float).reshape(1, -1)
+        value = np.asanyarray(value)
+        if value.dtype.names is not None:
+            record = value.reshape(-1)
+            if record.size == 0:
+                return self.write_empty(parent, name, 'double', (0, 0))
+            return self.write_struct(parent, name,
+                        {x: record[x][0] for x in value.dtype.names})
+        if value.dtype == object:
+            return self.write_cell(parent, name, value)
+        if value.dtype.kind in 'US':
+            return self.write_char(parent, name, str(value.reshape(-1)[0]))
+        return self.write_numeric(parent, name, value)
+
+    def write_struct(self, parent, name, fields):
+        group = parent.create_group(name)
+        self.set_struct_attrs(group, list(fields.keys()))
+        for field, value in fields.items():
+            self.write(group, field, value)
+        return group
+
+    def write_cell(self, parent, name, value):
+        value = np.atleast_2d(value) if value.ndim < 2 else value
+        if value.size == 0:
+            return self.write_empty(parent, name, 'cell', value.shape)
+        refs = np.empty(value.shape[::-1], dtype=self.h5py.ref_dtype)
+        for idx, x in np.ndenumerate(value):
+            refs[idx[::-1]] = self.write_ref(x)
+        dset = parent.create_dataset(name, data=refs, dtype=self.h5py.ref_dtype)
+        dset.attrs['MATLAB_class'] = np.bytes_('cell')
+        return dset
+
+    def write_char(self, parent, name, value):
+        if not value:
+            return self.write_empty(parent, name, 'char', (1, 0))
+        codes = np.array([ord(c) for c in value], dtype=np.uint16)
+        dset = parent.create_dataset(name, data=codes.reshape(-1, 1))
+        dset.attrs['MATLAB_class'] = np.bytes_('char')
+        dset.attrs['MATLAB_int_decode'] = np.int32(2)
+        return dset
+
+    def write_empty(self, parent, name, mclass, shape):
+        dset = parent.create_dataset(name, data=np.array(shape, dtype=np.uint64))
+        dset.attrs['MATLAB_class'] = np.bytes_(mclass)
+        dset.attrs['MATLAB_empty'] = np.uint8(1)
+        return dset
+
+    def write_numeric(self, parent, name, value):
+        if value.dtype == np.float16:
+            value = value.astype(np.float32) # no native half type in MATLAB
+        mclass = np2mat_class[value.dtype]
+        if value.ndim == 0:
+            value = value.reshape(1, 1)
+        elif value.ndim == 1:
+            value = value.reshape(-1, 1) # matches savemat(oned_as='column')
+        if value.size == 0:
+            return self.write_empty(parent, name, mclass, value.shape)
+        if mclass == 'logical':
+            value = value.astype(np.uint8)
+
+        # MATLAB arrays are column-major, so the HDF5 dataset holds the
+        # transpose. Arrays above `compress_bytes` go into chunked,
+        # compressed datasets and are written in slabs along their last
+        # axis, so that only one slab is ever copied into C order at a time
+        shape = value.shape[::-1]
+        if value.nbytes < self.compress_bytes:
+            dset = parent.create_dataset(name, data=np.ascontiguousarray(value.T))
+        else:
+            dset = parent.create_dataset(name, shape=shape, dtype=value.dtype,
+                                         chunks=True,
+                                         compression=self.compression,
+                                         compression_opts=self.compression_opts)
+            step = max(1, self.slab_bytes // (value.nbytes // shape[0]))
+            for start in range(0, shape[0], step):
+                stop = min(start + step, shape[0])
+                dset[start:stop] = value[..., start:stop].T
+        dset.attrs['MATLAB_class'] = np.bytes_(mclass)
+        if mclass == 'logical':
+            dset.attrs['MATLAB_int_decode'] = np.int32(1)
+        return dset
+
+def save_mat_v73(path, tf_model, meta, **kwargs):
+    """
+    stream the model to a MAT v7.3 file one layer/param at a time (see
+    `Mat73Writer`). `meta` is a plain dict, converted to a struct
+    """
+    with Mat73Writer(path, **kwargs) as writer:
+        writer.add_meta(meta)
+        for layer in tf_model.layers.values():
+            writer.add_layer(layer)
+        for param in tf_model.params.values():
+            writer.add_param(param)
+
+# --------------------------------------------------------------------
+#                                                  raw binary param blob
+# --------------------------------------------------------------------
+
+# params start at multiples of this many bytes, so that each can be mapped
+# (and read by SIMD code) at a naturally aligned address
+BLOB_ALIGNMENT = 64
+
+def matlab_shape(value):
+    """
+    the shape of `value` once saved to a MAT file (1-D arrays are stored as
+    columns, as with `savemat(oned_as='column')`)
+    """
+    if value.ndim == 0:
+        return (1, 1)
+    if value.ndim == 1:
+        return (value.size, 1)
+    return value.shape
+
+def matlab_bytes(value):
+    """
+    return the MATLAB class and shape of `value`, and its bytes in MATLAB
+    (column-major, little-endian) order as a flat uint8 array
+    """
+    value = np.asarray(tf_tensor.resolve(value))
+    if value.dtype == np.float16:
+        value = value.astype(np.float32) # no native half type in MATLAB
+    shape = matlab_shape(value)
+    # the bytes of the transpose in C order are those of `value` in F order
+    data = np.ascontiguousarray(value.reshape(shape).T,
+                                dtype=value.dtype.newbyteorder('<'))
+    return np2mat_class[value.dtype], shape, data.reshape(-1).view(np.uint8)
+
+def clear_param_values(tf_model):
+    """
+    drop the param values of `tf_model` (e.g. once they are written out
+    elsewhere), leaving empty params to be exported in their place
+    """
+    empty = np.zeros(shape=(0, 0), dtype='float32')
+    for param in tf_model.params.values():
+        param.value = empty
+    for layer in tf_model.layers.values():
+        for name in getattr(layer, 'param_values', {}):
+            layer.param_values[name] = empty
+
+def write_param_blob(path, tf_model, alignment=BLOB_ALIGNMENT,
+                     profile=tf_profile.NULL):
+    """
+    write the values of all params of `tf_model` to a single binary file,
+    one after the other in MATLAB order, each starting at a multiple of
+    `alignment` bytes. Returns the offset table (by param name, the byte
+    offset, MATLAB class and shape of each value) to be stored with the
+    network as `net.meta.blob.params`
+    """
+    table = OrderedDict()
+    with open(str(path), 'wb') as f:
+        for name, param in tf_model.params.items():
+            with profile.stage('to_matlab'):
+                mclass, shape, data = matlab_bytes(param.value)
+            with profile.stage('write'):
+                f.write(b'\x00' * (-f.tell() % alignment))
+                table[name] = OrderedDict([
+                    ('offset', float(f.tell())),
+                    ('dataType', mclass),
+                    ('shape', np.array(shape, dtype=float).reshape(1, -1))])
+                f.write(data)
+    return table
+
+def read_param_blob(path, table):
+    """
+    map the values listed in `table` from the blob at `path`, by name
+    """
+    values = OrderedDict()
+    for name, entry in table.items():
+        dtype = np.dtype(mat2np_dtype[str(entry['dataType'])])
+        shape = tuple(int(x) for x in np.ravel(entry['shape']))
+        if not all(shape):
+            values[name] = np.zeros(shape, dtype=dtype)
+            continue
+        values[name] = np.memmap(str(path), dtype=dtype.newbyteorder('<'),
+                                 mode='r', offset=int(entry['offset']),
+                                 shape=shape, order='F')
+    return values
@@ -0,0 +1,107 @@
+# Reduced precision export of parameters. Conv filters are stored either
+# as float16 or as per-channel int8 with a scale and zero point, which
+# shrinks the exported file to roughly a half or a quarter of its size.
+#
+# MATLAB has no half precision type, so float16 values are stored as their
+# uint16 bit patterns. How each param was stored is recorded under
+# `net.meta.quantization.<param name>`, and `dequantizeParams` (in
+# matlab/) restores single precision values before the network is loaded
+# with `dagnn.DagNN.loadobj`.
+
+from collections import OrderedDict
+import numpy as np
+import tf_mcn
+import tf_tensor
+import tf_spill
+
+formats = ['float32', 'float16', 'int8']
+
+# --------------------------------------------------------------------
+#                                                          quantizers
+# --------------------------------------------------------------------
+
+def quantize_float16(value):
+    """
+    return the float16 bit patterns of `value` (as uint16), the MATLAB side
+    info, and the values they represent
+    """
+    half = value.astype(np.float16)
+    info = OrderedDict([('format', 'float16')])
+    return half.view(np.uint16), info, half.astype(np.float32)
+
+def quantize_int8(value, axis=-1):
+    """
+    affine quantization to int8, with a scale and zero point per slice
+    along `axis` (the output channels of a filter bank), chosen so that
+    the range of each slice maps onto [-128, 127] and zero is exact
+    """
+    axis = axis % value.ndim
+    other = tuple(ii for ii in range(value.ndim) if ii != axis)
+    low = np.minimum(value.min(axis=other, keepdims=True), 0).astype(np.float64)
+    high = np.maximum(value.max(axis=other, keepdims=True), 0).astype(np.float64)
+    scale = (high - low) / 255
+    scale[scale == 0] = 1 # constant zero slices
+    zero_point = np.round(-128 - low / scale)
+    # the float64 intermediates are updated in place, to hold one at a time
+    quantized = value / scale
+    np.round(quantized, out=quantized)
+    quantized += zero_point
+    np.clip(quantized, -128, 127, out=quantized)
+    quantized = quantized.astype(np.int8)
+    restored = quantized - zero_point
+    restored *= scale
+    restored = restored.astype(np.float32)
+    info = OrderedDict([('format', 'int8'),
+                        ('scale', scale.reshape(-1).astype(np.float32)),
+                        ('zeroPoint', zero_point.reshape(-1).astype(np.float32)),
+                        ('dim', float(axis + 1))]) # 1-based MATLAB dimension
+    return quantized, info, restored
+
+# --------------------------------------------------------------------
+#                                                              models
+# --------------------------------------------------------------------
+
+def quantize_model(tf_model, param_format, min_elements=4096,
+                   budget=tf_spill.NO_BUDGET):
+    """
+    store the filters of every conv layer with at least `min_elements`
+    values in `param_format` (biases, batch norm statistics and small
+    filters are left in full precision, since they cost little and are
+    the most sensitive to rounding). Param values are replaced in place,
+    by values handed to `budget` (see `tf_spill`).
+
+    Returns the per param info for `net.meta.quantization` and a report
+    with the size and largest error of each quantized param
+    """
+    if param_format not in formats:
+        raise ValueError('unknown param format {}'.format(param_format))
+    quantization = OrderedDict()
+    report = []
+    if param_format == 'float32':
+        return quantization, report
+
+    for layer in tf_model.layers.values():
+        if not isinstance(layer, tf_mcn.McnConv):
+            continue
+        name = layer.params[0]
+        param = tf_model.params[name]
+        if param.value.size < min_elements:
+            continue
+        value = tf_tensor.resolve(param.value).astype(np.float32)
+        if param_format == 'float16':
+            stored, info, restored = quantize_float16(value)
+        else:
+            stored, info, restored = quantize_int8(value, axis=3)
+
+        error = float(np.abs(restored - value).max())
+        scale = float(np.abs(value).max())
+        report.append(OrderedDict([
+            ('layer', layer.name), ('param', name), ('format', param_format),
+            ('bytes', int(value.nbytes)), ('stored_bytes', int(stored.nbytes)),
+            ('max_abs_error', error),
+            ('max_rel_error', error / scale if scale else error)]))
+        stored = budget.hold(stored)
+        param.value = stored
+        layer.param_values[name] = stored
+        quantization[name] = info
+    return quantization, report
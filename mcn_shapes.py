@@ -0,0 +1,157 @@
+# Shape inference over the layers of a converted network, and an estimate
+# of the activation memory needed to run it. Shapes are propagated from the
+# input size given by the darkflow meta info, which also fixes the padding
+# of layers using TF's `SAME` scheme (that depends on the size of their
+# inputs). Sizes are (H,W,C), as in MatConvNet, for a single sample.
+
+from collections import OrderedDict
+import numpy as np
+import tf_mcn
+
+# --------------------------------------------------------------------
+#                                                              sizes
+# --------------------------------------------------------------------
+
+def same_pad(in_size, size, stride, rate=(1, 1)):
+    """
+    the `[top bottom left right]` padding of TF's `SAME` scheme
+    """
+    pad = []
+    for dim, k, s, r in zip(in_size, size, stride, rate):
+        out = -(-dim // s)
+        total = max((out - 1) * s + (k - 1) * r + 1 - dim, 0)
+        pad += [total // 2, total - total // 2]
+    return pad
+
+def window_out(in_size, size, stride, pad, rate=(1, 1)):
+    """
+    the (H,W) output size of a sliding window over an (H,W) input
+    """
+    out = []
+    for dim, k, s, r, before, after in zip(in_size, size, stride, rate,
+                                           pad[0::2], pad[1::2]):
+        span = (int(k) - 1) * int(r) + 1
+        out.append((int(dim) + int(before) + int(after) - span) // int(s) + 1)
+    return out
+
+def layer_out(layer, in_sizes):
+    """
+    the output size of `layer` given the sizes of its inputs, setting the
+    settings that depend on them on the way
+    """
+    size = in_sizes[0]
+    if isinstance(layer, tf_mcn.McnConv):
+        if layer.pad_type == 'SAME':
+            # computed over the input as padded by a `Pad` node, if any
+            fixed = [int(p) for p in layer.input_pad]
+            padded = [int(dim) + before + after for dim, before, after
+                      in zip(size[:2], fixed[0::2], fixed[1::2])]
+            layer.pad = [a + b for a, b in zip(fixed, same_pad(
+                padded, layer.kernel_size, layer.stride, layer.dilation))]
+        out = window_out(size[:2], layer.kernel_size, layer.stride, layer.pad,
+                         layer.dilation)
+        return out + [int(layer.num_output)]
+    if isinstance(layer, (tf_mcn.McnPooling, tf_mcn.McnExtractImagePatches)):
+        rate = getattr(layer, 'rate', (1, 1))
+        if layer.pad_type == 'SAME':
+            layer.pad = same_pad(size[:2], layer.kernel_size, layer.stride, rate)
+        else:
+            layer.pad = [0, 0, 0, 0]
+        out = window_out(size[:2], layer.kernel_size, layer.stride, layer.pad,
+                         rate)
+        if isinstance(layer, tf_mcn.McnPooling):
+            return out + [size[2]]
+        return out + [size[2] * int(np.prod(layer.kernel_size))]
+    if isinstance(layer, tf_mcn.McnSpaceToDepth):
+        layer.input_size = list(size)
+        layer.index = tf_mcn.space_to_depth_index(size, layer.block_size)
+        return [size[0] // int(layer.block_size[0]),
+                size[1] // int(layer.block_size[1]),
+                size[2] * int(np.prod(layer.block_size))]
+    if isinstance(layer, (tf_mcn.McnBatchNorm, tf_mcn.McnReLU)):
+        return list(size)
+    if isinstance(layer, tf_mcn.McnConcat):
+        out = list(size)
+        if layer.axis < 3: # concatenating batches does not change the size
+            out[layer.axis] = sum(x[layer.axis] for x in in_sizes)
+        return out
+    raise NotImplementedError('no shape inference for {}'.format(
+                              type(layer).__name__))
+
+def model_inputs(tf_model):
+    """
+    the variables that are consumed by layers but produced by none
+    """
+    produced = {name for layer in tf_model.layers.values()
+                for name in layer.outputs}
+    inputs = []
+    for layer in tf_model.layers.values():
+        for name in layer.inputs:
+            if name not in produced and name not in inputs:
+                inputs.append(name)
+    return inputs
+
+def infer_shapes(tf_model, input_size):
+    """
+    propagate the (H,W,C) `input_size` of the network inputs through its
+    layers, returning the size of every variable by name. The padding of
+    windowed layers with `SAME` padding, and the gather index of
+    space-to-depth layers, are set on the way
+    """
+    sizes = OrderedDict((name, [int(x) for x in input_size])
+                        for name in model_inputs(tf_model))
+    for layer in tf_model.layers.values():
+        out = layer_out(layer, [sizes[name] for name in layer.inputs])
+        if min(out) <= 0:
+            raise ValueError('layer {} has an empty output ({}) for inputs '
+                             'of size {}'.format(layer.name, out, input_size))
+        for name in layer.outputs:
+            sizes[name] = out
+    return sizes
+
+# --------------------------------------------------------------------
+#                                                     memory planning
+# --------------------------------------------------------------------
+
+def activation_memory(tf_model, sizes, batch_size=1, bytes_per_value=4):
+    """
+    estimate the activation memory of a forward pass of `batch_size`
+    samples, as run by a DagNN that frees each variable once its last
+    consumer has run (`conserveMemory`). A variable is live from the layer
+    that produces it (or the start, for inputs) to its last consumer (or
+    the end, for outputs); the peak is the largest total size of the
+    variables live while any one layer runs.
+
+    Returns the peak in bytes, the layer it is reached at, the total size
+    of all variables (with nothing freed), and the live bytes at each layer
+    """
+    layers = list(tf_model.layers.values())
+    first = {name: 0 for name in model_inputs(tf_model)}
+    last = {}
+    for idx, layer in enumerate(layers):
+        for name in layer.inputs:
+            last[name] = idx
+        for name in layer.outputs:
+            first.setdefault(name, idx)
+    for name in first:
+        last.setdefault(name, len(layers) - 1) # network outputs
+    num_bytes = {name: int(np.prod(sizes[name])) * batch_size * bytes_per_value
+                 for name in first}
+
+    # sweep over the starts and ends of the live ranges
+    delta = [0] * (len(layers) + 1)
+    for name in first:
+        delta[first[name]] += num_bytes[name]
+        delta[last[name] + 1] -= num_bytes[name]
+    live = []
+    total = 0
+    for idx, layer in enumerate(layers):
+        total += delta[idx]
+        live.append((layer.name, total))
+
+    peak_layer, peak = max(live, key=lambda x: x[1]) if live else (None, 0)
+    return OrderedDict([('batch_size', batch_size),
+                        ('peak_bytes', peak),
+                        ('peak_layer', peak_layer),
+                        ('total_bytes', sum(num_bytes.values())),
+                        ('live_bytes', live)])
@@ -0,0 +1,168 @@
+# A local, content-addressed cache of converted networks. Entries are keyed
+# by a hash of the graph bytes, the meta info, the converter version and
+# the output options, so an unchanged model is never converted twice, and
+# the cache is kept under a size limit by evicting the least recently used
+# entries.
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from pathlib import Path
+import tf_mcn
+
+# default location, overridden by the `MCN_TF_CACHE` environment variable
+DEFAULT_CACHE_DIR = Path('~/.cache/mcnTensorflow').expanduser()
+DEFAULT_MAX_BYTES = 10 * 2 ** 30
+
+def default_cache_dir():
+    return Path(os.environ.get('MCN_TF_CACHE', str(DEFAULT_CACHE_DIR)))
+
+def file_digest(path, chunk_bytes=2 ** 20):
+    digest = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+def atomic_write(path, write):
+    """
+    call `write` on a temporary file next to `path`, then rename it into
+    place, so that readers never see a partially written file
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, str(path))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+# --------------------------------------------------------------------
+#                                                                cache
+# --------------------------------------------------------------------
+
+class ConversionCache(object):
+    """
+    Converted `.mat` files stored under `root` as `<kk>/<key>.mat`, next to
+    a `<key>.json` record of the conversion summary. The modification time
+    of the record is the time the entry was last used, and is what the
+    least recently used eviction is ordered by. Entries are written to a
+    temporary file and renamed into place, so concurrent conversions of
+    the same model (e.g. from a batch) cannot leave a partial entry.
+    """
+
+    def __init__(self, root=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = Path(root) if root is not None else default_cache_dir()
+        self.max_bytes = max_bytes
+
+    def key(self, *paths, **options):
+        """
+        the key of a conversion of the input files at `paths` (the graph,
+        the meta info and any checkpoint files) with `options`
+        """
+        digest = hashlib.sha256()
+        digest.update('mcnTensorflow {}\n'.format(tf_mcn.__version__).encode())
+        digest.update(json.dumps(options, sort_keys=True).encode())
+        for path in paths:
+            digest.update(file_digest(path))
+        return digest.hexdigest()
+
+    def paths(self, key):
+        base = self.root / key[:2] / key
+        return base.with_suffix('.mat'), base.with_suffix('.json')
+
+    def get(self, key, out_path):
+        """
+        copy the cached network for `key` to `out_path` and return its
+        conversion summary, or return None on a miss
+        """
+        mat_path, record_path = self.paths(key)
+        try:
+            with open(str(record_path), 'r') as f:
+                summary = json.load(f)
+            shutil.copyfile(str(mat_path), str(out_path))
+        except (FileNotFoundError, ValueError):
+            return None # missing, or evicted/written concurrently
+        os.utime(str(record_path)) # mark as recently used
+        return summary
+
+    def put(self, key, mat_path, summary):
+        """
+        store a copy of the converted network at `mat_path`, then evict old
+        entries to bring the cache back under `max_bytes`
+        """
+        entry_path, record_path = self.paths(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+
+        def copy_mat(f):
+            with open(str(mat_path), 'rb') as src:
+                shutil.copyfileobj(src, f)
+
+        atomic_write(entry_path, copy_mat)
+        atomic_write(record_path,
+                     lambda f: f.write(json.dumps(summary, indent=2).encode()))
+        self.evict()
+
+    # ---------------------------------------------------------
+    #                                              maintenance
+    # ---------------------------------------------------------
+
+    def entries(self):
+        """
+        return the complete entries as a list of dicts, most recently used
+        first
+        """
+        entries = []
+        for record_path in self.root.glob('??/*.json'):
+            mat_path = record_path.with_suffix('.mat')
+            try:
+                used = record_path.stat().st_mtime
+                size = mat_path.stat().st_size
+                with open(str(record_path), 'r') as f:
+                    summary = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            entries.append({'key': record_path.stem, 'bytes': size,
+                            'used': used, 'graph': summary.get('graph')})
+        entries.sort(key=lambda entry: entry['used'], reverse=True)
+        return entries
+
+    def total_bytes(self):
+        return sum(entry['bytes'] for entry in self.entries())
+
+    def remove(self, key):
+        for path in self.paths(key):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def evict(self, max_bytes=None):
+        """
+        remove the least recently used entries until the cache holds at
+        most `max_bytes` (default: the cache limit), returning the keys of
+        the removed entries
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self.entries()
+        total = sum(entry['bytes'] for entry in entries)
+        removed = []
+        while entries and total > max_bytes:
+            entry = entries.pop()
+            self.remove(entry['key'])
+            total -= entry['bytes']
+            removed.append(entry['key'])
+        return removed
+
+    def clear(self):
+        return self.evict(max_bytes=0)
+
+def describe(entry):
+    age = time.time() - entry['used']
+    return '{key:.12}  {mb:9.1f} MB  {hours:7.1f}h ago  {graph}'.format(
+        mb=entry['bytes'] / 2 ** 20, hours=age / 3600, **entry)
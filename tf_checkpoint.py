@@ -0,0 +1,167 @@
+# A reader for TensorFlow checkpoints in the tensor bundle format, as
+# written by `tf.train.Saver` (V2): a `<prefix>.index` file, which is an
+# SSTable (the LevelDB table format) mapping each tensor name to a
+# `BundleEntryProto`, and `<prefix>.data-<shard>-of-<num shards>` files
+# holding the raw little-endian tensor bytes. Data shards are memory-mapped
+# and tensors returned as lazy `tf_tensor.TensorHandle`s over them, so that
+# weights are only read as they are exported, and TensorFlow is not needed.
+
+import mmap
+import struct
+from pathlib import Path
+import tf_proto
+import tf_tensor
+
+# --------------------------------------------------------------------
+#                                                   SSTable (LevelDB)
+# --------------------------------------------------------------------
+
+TABLE_MAGIC = 0xdb4775248b80fb57
+FOOTER_BYTES = 48     # two block handles, padded to 40 bytes, then the magic
+BLOCK_TRAILER_BYTES = 5 # compression type and crc32c, after each block
+NO_COMPRESSION = 0
+
+def read_block_handle(buf, pos):
+    offset, pos = tf_proto.read_varint(buf, pos)
+    size, pos = tf_proto.read_varint(buf, pos)
+    return (offset, size), pos
+
+def block_span(buf, handle):
+    """
+    the `(start, end)` of the contents of the block at `handle`
+    """
+    offset, size = handle
+    if buf[offset + size] != NO_COMPRESSION:
+        raise ValueError('compressed checkpoint tables are not supported')
+    return offset, offset + size
+
+def iter_block(buf, span):
+    """
+    yield the `(key, value_span)` entries of a block. Keys are prefix
+    compressed against the previous key; the array of restart points at
+    the end of the block is only needed for seeking, and is skipped
+    """
+    start, end = span
+    num_restarts, = struct.unpack_from('<I', buf, end - 4)
+    limit = end - 4 * (num_restarts + 1)
+    pos = start
+    key = b''
+    while pos < limit:
+        shared, pos = tf_proto.read_varint(buf, pos)
+        non_shared, pos = tf_proto.read_varint(buf, pos)
+        value_length, pos = tf_proto.read_varint(buf, pos)
+        key = key[:shared] + bytes(buf[pos:pos + non_shared])
+        pos += non_shared
+        yield key, (pos, value_length)
+        pos += value_length
+
+def iter_table(buf):
+    """
+    yield the `(key, value_span)` entries of an SSTable, in key order
+    """
+    footer = len(buf) - FOOTER_BYTES
+    magic, = struct.unpack_from('<Q', buf, len(buf) - 8)
+    if magic != TABLE_MAGIC:
+        raise ValueError('not a checkpoint index (bad table magic)')
+    _, pos = read_block_handle(buf, footer) # metaindex, unused
+    index_handle, _ = read_block_handle(buf, pos)
+    for _, (offset, length) in iter_block(buf, block_span(buf, index_handle)):
+        handle, _ = read_block_handle(buf, offset)
+        for entry in iter_block(buf, block_span(buf, handle)):
+            yield entry
+
+# --------------------------------------------------------------------
+#                                                     bundle messages
+# --------------------------------------------------------------------
+
+class Extent(tf_proto.Message):
+    fields = {1: ('start', 'int', False),
+              2: ('length', 'int', False)}
+
+class TensorSliceProto(tf_proto.Message):
+    fields = {1: ('extent', Extent, True)}
+
+class BundleHeaderProto(tf_proto.Message):
+    fields = {1: ('num_shards', 'int', False),
+              2: ('endianness', 'uint', False)}
+
+class BundleEntryProto(tf_proto.Message):
+    fields = {1: ('dtype', 'uint', False),
+              2: ('shape', tf_proto.TensorShapeProto, False),
+              3: ('shard_id', 'int', False),
+              4: ('offset', 'int', False),
+              5: ('size', 'int', False),
+              7: ('slices', TensorSliceProto, True)}
+
+LITTLE_ENDIAN = 0
+
+# --------------------------------------------------------------------
+#                                                          checkpoint
+# --------------------------------------------------------------------
+
+def bundle_files(prefix):
+    """
+    the index and data shard files of the checkpoint at `prefix`
+    """
+    prefix = str(prefix)
+    return [Path(prefix + '.index')] + sorted(Path(prefix).parent.glob(
+                                              Path(prefix).name + '.data-*'))
+
+def map_file(path):
+    with open(str(path), 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class Checkpoint(object):
+    """
+    The tensors of the checkpoint at `prefix` (the path given to
+    `Saver.save`, without the `.index` suffix), by name. Entries are read
+    from the index up front; data shards are mapped on first use
+    """
+
+    def __init__(self, prefix):
+        self.prefix = str(prefix)
+        index = map_file(self.prefix + '.index')
+        self.entries = {}
+        header = None
+        for key, span in iter_table(index):
+            if key == b'':
+                header = BundleHeaderProto(index, span)
+            else:
+                self.entries[key.decode('utf-8')] = BundleEntryProto(index, span)
+        if header is None:
+            raise ValueError('checkpoint index has no bundle header')
+        if header.endianness != LITTLE_ENDIAN:
+            raise ValueError('big endian checkpoints are not supported')
+        self.num_shards = header.num_shards
+        self.shards = {}
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def keys(self):
+        return sorted(self.entries)
+
+    def shard(self, shard_id):
+        if shard_id not in self.shards:
+            path = '{}.data-{:05d}-of-{:05d}'.format(self.prefix, shard_id,
+                                                     self.num_shards)
+            self.shards[shard_id] = map_file(path)
+        return self.shards[shard_id]
+
+    def tensor(self, name):
+        """
+        return a lazy handle on the values of the tensor `name`
+        """
+        if name not in self.entries:
+            raise KeyError('no tensor named {} in checkpoint {}'.format(
+                           name, self.prefix))
+        entry = self.entries[name]
+        if entry.slices:
+            raise NotImplementedError('partitioned variable {} is not '
+                                      'supported'.format(name))
+        if entry.dtype not in tf_tensor.tf2np_dtype:
+            raise ValueError('unsupported dtype {} of {}'.format(entry.dtype,
+                                                                name))
+        shape = [dim.size for dim in entry.shape.dim]
+        return tf_tensor.TensorHandle(self.shard(entry.shard_id), entry.offset,
+                                      entry.size, entry.dtype, shape)
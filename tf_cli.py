@@ -0,0 +1,352 @@
+# Command line entry point for the converter, run as
+#
+#   python -m tf_mcn convert a.pb b.pb ... --out-dir models/
+#   python -m tf_mcn convert --manifest jobs.json --workers 8
+#   python -m tf_mcn cache list
+#
+# Each graph is converted in its own worker process, so a batch uses every
+# core and a failing (or memory-hungry) model does not take the rest down.
+
+import sys
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+from pathlib import Path
+import tf_cache
+import mcn_quantize
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+# --------------------------------------------------------------------
+#                                                                 jobs
+# --------------------------------------------------------------------
+
+def jobs_from_graphs(graphs, out_dir, meta=None):
+    """
+    build a job per graph. The meta info is expected next to each graph
+    (same stem, `.meta` suffix) unless given explicitly, and outputs are
+    named after the graph in `out_dir`
+    """
+    jobs = []
+    for graph in graphs:
+        graph = Path(graph)
+        jobs.append({'graph': str(graph),
+                     'meta': str(meta or graph.with_suffix('.meta')),
+                     'out': str(Path(out_dir) / (graph.stem + '.mat'))})
+    return jobs
+
+def jobs_from_manifest(manifest, out_dir):
+    """
+    read jobs from a JSON manifest: a list of objects with `graph` and
+    optionally `meta`, `out`, `checkpoint`, `plan` and `save_plan` keys
+    (resolved relative to the manifest) and `outputs`, the output tensors
+    of the graph to convert
+    """
+    manifest = Path(manifest)
+    with open(str(manifest), 'r') as f:
+        entries = json.load(f)
+    jobs = []
+    for entry in entries:
+        graph = manifest.parent / entry['graph']
+        job, = jobs_from_graphs([graph], out_dir, entry.get('meta')
+                                and manifest.parent / entry['meta'])
+        if 'out' in entry:
+            job['out'] = str(manifest.parent / entry['out'])
+        if 'checkpoint' in entry:
+            job['checkpoint'] = str(manifest.parent / entry['checkpoint'])
+        if 'plan' in entry:
+            job['plan'] = str(manifest.parent / entry['plan'])
+        if 'save_plan' in entry:
+            job['save_plan'] = str(manifest.parent / entry['save_plan'])
+        if 'outputs' in entry:
+            job['outputs'] = entry['outputs']
+        jobs.append(job)
+    return jobs
+
+# --------------------------------------------------------------------
+#                                                              workers
+# --------------------------------------------------------------------
+
+def limit_memory(max_bytes):
+    """
+    worker initializer - cap the data segment of the worker, so that an
+    oversized conversion fails with a MemoryError rather than exhausting
+    the host. RLIMIT_DATA (rather than RLIMIT_AS) is used so that the
+    read-only mappings of the graph files do not count towards the limit
+    """
+    if max_bytes:
+        import resource
+        resource.setrlimit(resource.RLIMIT_DATA, (max_bytes, max_bytes))
+
+def run_job(job, options):
+    """
+    convert a single graph, returning a summary dict. Failures are caught
+    and reported in the summary rather than raised
+    """
+    import import_tf
+    start = time.time()
+    result = dict(job)
+    kwargs = dict(options)
+    if job.get('outputs'):
+        kwargs['outputs'] = job['outputs'] # overrides the batch default
+    if job.get('checkpoint'):
+        kwargs['checkpoint'] = job['checkpoint']
+    if job.get('plan'):
+        kwargs['plan'] = job['plan']
+    if job.get('save_plan'):
+        kwargs['save_plan'] = job['save_plan']
+    try:
+        summary = import_tf.convert(job['graph'], job['meta'], job['out'],
+                                    **kwargs)
+        result.update(summary)
+        result['status'] = 'ok'
+        validation = summary.get('validation')
+        if validation and not validation['ok']:
+            failed = [x['layer'] for x in validation['layers'] if not x['ok']]
+            result['status'] = 'failed'
+            result['error'] = 'validation failed at {} ({} layers)'.format(
+                              failed[0], len(failed))
+    except Exception as exc:
+        result['status'] = 'failed'
+        result['error'] = '{}: {}'.format(type(exc).__name__, exc)
+        result['traceback'] = traceback.format_exc()
+    result['seconds'] = time.time() - start
+    return result
+
+def worker_failure(job, exc):
+    return dict(job, status='failed', seconds=0.0,
+                error='{}: {}'.format(type(exc).__name__, exc))
+
+def make_pool(workers, memory_limit):
+    kwargs = {'max_workers': workers,
+              'initializer': limit_memory,
+              'initargs': (memory_limit,)}
+    if sys.version_info >= (3, 11):
+        # a fresh process per job, so that memory limits and any leaked
+        # state apply to one conversion only
+        kwargs['max_tasks_per_child'] = 1
+        kwargs['mp_context'] = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(**kwargs)
+
+def convert_batch(jobs, options, workers=None, memory_limit=None,
+                  progress=None):
+    """
+    convert `jobs` across a process pool and return their summaries, in
+    job order. If a worker dies outright (e.g. killed by the OS), the pool
+    is broken for every job in flight; those jobs are retried one at a
+    time so that only the culprit is reported as failed
+    """
+    results = [None] * len(jobs)
+    retry = []
+    with make_pool(workers, memory_limit) as pool:
+        futures = {pool.submit(run_job, job, options): idx
+                   for idx, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                results[idx] = future.result()
+            except BrokenProcessPool:
+                retry.append(idx)
+                continue
+            except Exception as exc:
+                # raised in the worker outside of `run_job`, e.g. while
+                # starting up under a tight memory limit
+                results[idx] = worker_failure(jobs[idx], exc)
+            if progress:
+                progress(results[idx])
+
+    for idx in sorted(retry):
+        with make_pool(1, memory_limit) as pool:
+            try:
+                results[idx] = pool.submit(run_job, jobs[idx], options).result()
+            except BrokenProcessPool:
+                results[idx] = dict(jobs[idx], status='failed', seconds=0.0,
+                                    error='worker process died (memory limit?)')
+            except Exception as exc:
+                results[idx] = worker_failure(jobs[idx], exc)
+        if progress:
+            progress(results[idx])
+    return results
+
+# --------------------------------------------------------------------
+#                                                       command line
+# --------------------------------------------------------------------
+
+def print_result(result):
+    if result['status'] == 'ok':
+        print('[ok]     {graph} -> {out} ({layers} layers, {seconds:.1f}s{})'
+              .format(', cached' if result.get('cached') else '', **result))
+    else:
+        print('[failed] {graph}: {error}'.format(**result))
+
+def print_summary(results, seconds):
+    num_ok = sum(result['status'] == 'ok' for result in results)
+    cpu_seconds = sum(result['seconds'] for result in results)
+    print('converted {}/{} graphs in {:.1f}s ({:.1f}s of conversion time)'
+          .format(num_ok, len(results), seconds, cpu_seconds))
+    for result in results:
+        if result['status'] != 'ok':
+            print('  failed: {graph}: {error}'.format(**result))
+
+def add_convert_parser(subparsers):
+    parser = subparsers.add_parser('convert',
+        help='convert one or more frozen graphs into MatConvNet DagNNs')
+    parser.add_argument('graphs', nargs='*',
+                        help='frozen GraphDefs (.pb), with meta info in a '
+                        '.meta file of the same name')
+    parser.add_argument('--manifest',
+                        help='JSON list of {"graph", "meta", "out", ...} jobs '
+                        '(see `jobs_from_manifest`)')
+    parser.add_argument('--meta', help='meta info shared by all graphs')
+    parser.add_argument('-o', '--out-dir', default='.',
+                        help='directory for outputs (default: current)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('--memory-limit', type=float, default=None,
+                        help='per-job memory limit, in GB')
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        metavar='GB',
+                        help='per-job budget for the arrays computed during '
+                        'a conversion, in GB, beyond which they are spilled '
+                        'to memory-mapped files')
+    parser.add_argument('--scratch-dir', metavar='DIR',
+                        help='directory for spilled arrays')
+    parser.add_argument('--mat-version', default='7.3', choices=['5', '7.3'])
+    parser.add_argument('--topology-only', action='store_true')
+    parser.add_argument('--fold-batch-norm', action='store_true',
+                        help='fold batch norm layers into the preceding '
+                        'convolutions')
+    parser.add_argument('--validate', action='store_true',
+                        help='check each conversion against its graph on a '
+                        'random batch, failing jobs whose layers disagree')
+    parser.add_argument('--param-format', default='float32',
+                        choices=mcn_quantize.formats,
+                        help='storage format of the conv filters')
+    parser.add_argument('--param-blob', action='store_true',
+                        help='write the weights of each graph to a raw binary '
+                        'file next to its output')
+    parser.add_argument('--weight-store', metavar='DIR',
+                        help='write the weights of all graphs to a shared, '
+                        'content-addressed store in DIR')
+    parser.add_argument('--output', action='append', dest='outputs',
+                        metavar='TENSOR',
+                        help='output tensor to convert, for every graph '
+                        'without `outputs` in the manifest (repeat for '
+                        'several heads, default: output)')
+    parser.add_argument('--no-simplify', action='store_false', dest='simplify',
+                        help='match the layers on the graphs as read, without '
+                        'simplifying them first')
+    parser.add_argument('--check-tf', action='store_true',
+                        help='cross-check the graph reader against '
+                        'TensorFlow (which must be installed)')
+    parser.add_argument('--checkpoint', metavar='PREFIX',
+                        help='read variables from this checkpoint, for every '
+                        'graph without `checkpoint` in the manifest')
+    parser.add_argument('--plan', metavar='PLAN',
+                        help='convert from this layer plan, for every graph '
+                        'without `plan` in the manifest')
+    parser.add_argument('--save-plan', action='store_true',
+                        help='save the layer plan of each conversion next to '
+                        'its output (model.plan for model.mat), for every '
+                        'graph without `save_plan` in the manifest')
+    parser.add_argument('--summary',
+                        help='write the per-job results to this JSON file')
+    parser.add_argument('--cache', nargs='?', metavar='DIR', default=None,
+                        const=str(tf_cache.default_cache_dir()),
+                        help='reuse previous conversions of unchanged graphs '
+                        'from a cache in DIR (default: $MCN_TF_CACHE or '
+                        '~/.cache/mcnTensorflow)')
+    parser.add_argument('--cache-size', type=float, default=None,
+                        help='cache size limit, in GB (default: 10)')
+    parser.set_defaults(func=run_convert)
+
+def run_convert(args):
+    jobs = jobs_from_graphs(args.graphs, args.out_dir, args.meta)
+    if args.manifest:
+        jobs += jobs_from_manifest(args.manifest, args.out_dir)
+    if not jobs:
+        raise SystemExit('no graphs to convert')
+    Path(args.out_dir).mkdir(parents=True, exist_ok=True)
+    if args.save_plan:
+        for job in jobs:
+            plan_path = Path(job['out']).with_suffix('.plan')
+            job.setdefault('save_plan', str(plan_path))
+
+    options = {'mat_version': args.mat_version,
+               'topology_only': args.topology_only,
+               'fold_batch_norm': args.fold_batch_norm,
+               'outputs': args.outputs,
+               'validate': args.validate,
+               'param_format': args.param_format,
+               'weight_store': args.weight_store,
+               'param_blob': args.param_blob,
+               'simplify': args.simplify,
+               'check_tf': args.check_tf,
+               'checkpoint': args.checkpoint,
+               'plan': args.plan,
+               'scratch_dir': args.scratch_dir,
+               'cache_dir': args.cache}
+    if args.cache_size:
+        options['cache_size'] = int(args.cache_size * 2 ** 30)
+    if args.memory_budget is not None:
+        options['memory_budget'] = int(args.memory_budget * 2 ** 30)
+    memory_limit = None
+    if args.memory_limit:
+        memory_limit = int(args.memory_limit * 2 ** 30)
+
+    start = time.time()
+    results = convert_batch(jobs, options, workers=args.workers,
+                            memory_limit=memory_limit, progress=print_result)
+    print_summary(results, time.time() - start)
+
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if all(result['status'] == 'ok' for result in results) else 1
+
+def add_cache_parser(subparsers):
+    parser = subparsers.add_parser('cache',
+        help='inspect or prune the conversion cache')
+    parser.add_argument('action', choices=['list', 'prune', 'clear'],
+                        help='list entries (most recently used first), evict '
+                        'the least recently used down to --max-size, or '
+                        'remove every entry')
+    parser.add_argument('--dir', default=None,
+                        help='cache directory (default: $MCN_TF_CACHE or '
+                        '~/.cache/mcnTensorflow)')
+    parser.add_argument('--max-size', type=float, default=None,
+                        help='size to prune down to, in GB (default: 10)')
+    parser.set_defaults(func=run_cache)
+
+def run_cache(args):
+    cache = tf_cache.ConversionCache(args.dir)
+    if args.action == 'list':
+        entries = cache.entries()
+        for entry in entries:
+            print(tf_cache.describe(entry))
+        print('{} entries, {:.1f} MB in {}'.format(len(entries),
+              sum(entry['bytes'] for entry in entries) / 2 ** 20, cache.root))
+        return 0
+    if args.action == 'prune':
+        max_bytes = None
+        if args.max_size is not None:
+            max_bytes = int(args.max_size * 2 ** 30)
+        removed = cache.evict(max_bytes)
+    else:
+        removed = cache.clear()
+    print('removed {} entries from {}'.format(len(removed), cache.root))
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m tf_mcn',
+        description='TensorFlow to MatConvNet conversion tools')
+    subparsers = parser.add_subparsers(dest='command')
+    add_convert_parser(subparsers)
+    add_cache_parser(subparsers)
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_help()
+        return 1
+    return args.func(args)
@@ -0,0 +1,123 @@
+# Memory layouts of the tensors of a graph, and the axis permutations that
+# take them into MatConvNet's, where activations are (H,W,C,N) and conv
+# filters (H,W,in,out). Each layout is described once, by the axis holding
+# each mcn axis, and tensors are only ever permuted as views: arrays are
+# transposed by their strides, and lazy `tf_tensor.TensorHandle`s carry
+# the permutation until they are resolved, so that the copy into MATLAB
+# order is left to the exporter, which writes each param a slab at a time.
+#
+# TF graphs are NHWC or (for GPU-trained networks) NCHW; their filters are
+# HWIO in either case. Darknet (and most other frameworks) store OIHW
+# filters.
+
+import numpy as np
+import tf_tensor
+
+# the activation axes holding mcn's (H,W,C,N), by TF `data_format`
+ACTIVATION_LAYOUTS = {
+    'NHWC': [1, 2, 3, 0],
+    'NCHW': [2, 3, 1, 0],
+}
+
+# the filter axes holding mcn's (H,W,in,out), by filter layout
+FILTER_LAYOUTS = {
+    'HWIO': [0, 1, 2, 3],
+    'OIHW': [2, 3, 1, 0],
+}
+
+NHWC = ACTIVATION_LAYOUTS['NHWC']
+
+# ops that have no layout of their own, but compute in that of their inputs
+layout_free_ops = ['Placeholder', 'Identity', 'Pad', 'ConcatV2', 'Add',
+                   'AddV2', 'Sub', 'RealDiv', 'Mul', 'Maximum', 'Sqrt',
+                   'Rsqrt']
+
+# --------------------------------------------------------------------
+#                                                        permutations
+# --------------------------------------------------------------------
+
+def data_format(name):
+    """
+    the mcn axis order of a TF `data_format` attribute
+    """
+    try:
+        return list(ACTIVATION_LAYOUTS[name])
+    except KeyError:
+        raise NotImplementedError('{} data format is not supported'
+                                  .format(name))
+
+def permute(value, order):
+    """
+    `value` with its axes permuted by `order`, without copying it. The
+    identity permutation returns `value` itself, so that the weights of
+    layers stay the values of the nodes they were read from (which plans
+    rely on, see `tf_plan.make_plan`)
+    """
+    order = list(order)
+    if order == list(range(len(order))):
+        return value
+    if isinstance(value, tf_tensor.TensorHandle):
+        stored = (value.order if value.order is not None
+                  else range(value.ndim))
+        return tf_tensor.TensorHandle(value.buf, value.offset, value.length,
+                                      value.tf_dtype, value.stored_shape,
+                                      [stored[i] for i in order])
+    return tf_tensor.finish(np.asarray(value), order)
+
+def mcn_filters(value, layout='HWIO'):
+    """
+    conv filters stored in `layout`, as an (H,W,in,out) view
+    """
+    return permute(value, FILTER_LAYOUTS[layout])
+
+def mcn_axis(axis, order):
+    """
+    the mcn axis of a (possibly negative) axis of a tensor in `order`
+    """
+    return list(order).index(axis % len(order))
+
+def to_nhwc(x, order):
+    """
+    the view of an activation array in `order` as NHWC
+    """
+    return permute(x, [order[3], order[0], order[1], order[2]])
+
+def from_nhwc(x, order):
+    """
+    the view of an NHWC activation array in `order`
+    """
+    return permute(x, np.argsort([order[3], order[0], order[1], order[2]]))
+
+# --------------------------------------------------------------------
+#                                                       graph layouts
+# --------------------------------------------------------------------
+
+def assign_formats(tf_graph, heads):
+    """
+    set the `data_format` of the nodes that `heads` depend on which do not
+    have one of their own (placeholders, pads, concats and elementwise
+    ops) to that of the ops they feed or are fed by, so that the axes of
+    every activation are known. A layout is first passed up from each op
+    that sets one to the inputs it consumes, then down to whatever those
+    feed. Activations with no layout-setting op nearby are taken as NHWC.
+    Constants are left alone, since they broadcast as they are
+    """
+    nodes = [node for node in tf_graph.post_order(heads) if node.op != 'Const']
+    formats = {id(node): node.data_format for node in nodes
+               if getattr(node, 'data_format', None) is not None}
+    for node in reversed(nodes):
+        if id(node) in formats:
+            for x in node.inputs:
+                if x.op in layout_free_ops and id(x) not in formats:
+                    formats[id(x)] = formats[id(node)]
+    for node in nodes:
+        if id(node) not in formats:
+            known = [formats[id(x)] for x in node.inputs if id(x) in formats]
+            formats[id(node)] = known[0] if known else list(NHWC)
+        node.data_format = formats[id(node)]
+
+def node_format(node):
+    """
+    the mcn axis order of the output of `node` (NHWC unless set)
+    """
+    return getattr(node, 'data_format', None) or NHWC
@@ -3,17 +3,12 @@
 # # author: Samuel Albanie 
 
 from collections import OrderedDict
-from math import floor, ceil
-from operator import mul
 import numpy as np
-from numpy import array
-import pdb
-import scipy
-import scipy.io
-import scipy.misc
-import ipdb
-import copy
 import collections
+import tf_tensor
+import tf_layout
+
+__version__ = '0.3.2' # part of the conversion cache key, see `tf_cache`
 
 # --------------------------------------------------------------------
 #                  MatConvNet in NumPy (A.V magic from caffe importer)
@@ -69,6 +64,7 @@ class TFNode(object):
         for key in kwargs:
             setattr(self, key, kwargs[key])
         self.inputs = [] # used later for graph construction
+        self.control_inputs = []
 
     def summary_str(self, obj_type):
         summary = """TF {} object:
@@ -80,15 +76,23 @@ class TFNode(object):
                               self.input_types, self.op)
 
 class TfValue(object):
+    """
+    A named value. `value` may be a numpy array or a lazy
+    `tf_tensor.TensorHandle`, which is only read when the value is
+    converted for export
+    """
     def __init__(self, name):
         self.name = name
         self.shape = None
         self.value = np.zeros(shape=(0,0), dtype='float32')
 
+    def resolve(self):
+        return tf_tensor.resolve(self.value)
+
     def toMatlab(self):
         mparam = np.empty(shape=[1,], dtype=mparamdt)
         mparam['name'][0] = self.name
-        mparam['value'][0] = self.value
+        mparam['value'][0] = self.resolve()
         return mparam
 
 class TFModel(object):
@@ -97,12 +101,19 @@ class TFModel(object):
         self.vars = OrderedDict()
         self.params = OrderedDict()
 
+        self.suffixes = {} # number of 'x' suffixes issued per clashing name
+
     def addLayer(self, layer):
         ename = layer.name
-        while ename in self.layers.keys():
-            ename = ename + 'x'
-        if layer.name != ename:
-            print('Warning: a layer with name {} was already found, using ',
+        if ename in self.layers:
+            # resume from the last suffix issued for this name rather than
+            # re-probing every previous clash
+            num_x = self.suffixes.get(layer.name, 0)
+            while ename in self.layers:
+                num_x += 1
+                ename = layer.name + 'x' * num_x
+            self.suffixes[layer.name] = num_x
+            print('Warning: a layer with name {} was already found, using '
                   '{} instead'.format(layer.name, ename))
             layer.name = ename
 
@@ -120,13 +131,14 @@ class TFModel(object):
         self.layers[layer.name] = layer
 
     def addVar(self, name):
-        if name not in self.vars.keys():
+        if name not in self.vars:
             self.vars[name] = TfValue(name)
 
     def addParam(self, name, layer):
-        if name not in self.params.keys():
+        if name not in self.params:
             self.params[name] = TfValue(name)
             self.params[name].value = layer.param_values[name]
+            self.params[name].shape = layer.param_values[name].shape
 
 class ParseException(Exception):
     pass
@@ -135,29 +147,32 @@ def parse_inputs(input_nodes, ops):
     """
     parse a list of input nodes and return them in the order 
     given by `ops`. `Any` can be specified as a special argument 
-    to match any op - it must be supplied as the last argument
+    to match any op - it must be supplied as the last argument.
+    Recognising which subgraphs form a layer is left to `tf_patterns`;
+    this only orders the inputs of an expression that is known to match
     """
     if len(input_nodes) != len(ops):
         raise ParseException('number of inputs did not match ops')
 
-    wildcard = False
-
-    if 'Any' in ops:
-        if ops.index('Any') != len(ops) - 1:
-            raise ParseException('`Any` must be last arg')
-        wildcard = True
-        ops.pop()
+    wildcard = ops[-1] == 'Any' if ops else False
+    if 'Any' in ops[:-1]:
+        raise ParseException('`Any` must be last arg')
+    if wildcard:
+        ops = ops[:-1] # leave the caller's list untouched
 
     out_nodes = []
+    matched = set()
     for op in ops:
         for node in input_nodes:
-            if node not in out_nodes and node.op == op:
+            if id(node) not in matched and node.op == op:
                 out_nodes.append(node)
+                matched.add(id(node))
 
     if wildcard:
         for node in input_nodes:
-            if node not in out_nodes:
+            if id(node) not in matched:
                 out_nodes.append(node)
+                matched.add(id(node))
 
     if len(out_nodes) != len(ops) + wildcard:
         raise ParseException('not enough nodes were matched')
@@ -167,13 +182,97 @@ def parse_inputs(input_nodes, ops):
 #                                                             TF Graph
 # --------------------------------------------------------------------
 
+def parse_input_name(input_name):
+    """
+    split a NodeDef input string into `(node_name, output_index, is_control)`.
+    TF marks control dependencies as `^name` and refers to the N-th output
+    of a multi-output op as `name:N` (`name` alone is output 0)
+    """
+    if input_name.startswith('^'):
+        return input_name[1:], -1, True
+    node_name, sep, port = input_name.rpartition(':')
+    if sep and port.isdigit():
+        return node_name, int(port), False
+    return input_name, 0, False
+
 class TFGraph(object):
     def __init__(self, node_list):
         self.nodes = node_list
 
+        # name -> node, so that resolving an edge is a single lookup rather
+        # than a scan over every node name. If a name is repeated, the first
+        # occurrence in `node_list` wins. Nothing is set on the nodes
+        # themselves, which may be shared with other graphs (see
+        # `tf_optimize.simplify_graph`)
+        self.index = {}
+        for node in node_list:
+            self.index.setdefault(node.name, node)
+
+    def __getitem__(self, input_name):
+        node_name, _, _ = parse_input_name(input_name)
+        try:
+            return self.index[node_name]
+        except KeyError:
+            raise KeyError('no node named {} in graph'.format(node_name))
+
+    def __contains__(self, input_name):
+        return parse_input_name(input_name)[0] in self.index
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def link(self):
+        """
+        set references from each node to the nodes named by its inputs.
+        Control dependencies are kept separately in `control_inputs`, since
+        they carry no data and should not take part in pattern matching (or
+        in deciding which nodes are needed, see `import_tf.find_reachable`)
+        """
+        for node in self.nodes:
+            for input_name in node.input_names:
+                node_name, _, is_control = parse_input_name(input_name)
+                if is_control:
+                    # control dependencies on pruned nodes are dropped
+                    if node_name in self:
+                        node.control_inputs.append(self[node_name])
+                else:
+                    node.inputs.append(self[node_name])
+
     def print(self):
         for node in self.nodes:
-            print(self.node)
+            print(node)
+
+    def post_order(self, heads):
+        """
+        iterate over the nodes that `heads` depend on in post-order, i.e.
+        every node is yielded after all of its inputs (which are visited in
+        the order they are listed, as a recursive walk would). An explicit
+        stack and a per-node state (by node identity) replace recursion, so
+        the walk is linear in the size of the graph and works at any depth
+        """
+        OPEN, DONE = 1, 2
+        state = {}
+        for head in heads:
+            if state.get(id(head)) == DONE:
+                continue
+            state[id(head)] = OPEN
+            stack = [(head, 0)]
+            while stack:
+                node, pos = stack[-1]
+                if pos < len(node.inputs):
+                    stack[-1] = (node, pos + 1)
+                    in_node = node.inputs[pos]
+                    in_state = state.get(id(in_node))
+                    if in_state is None:
+                        state[id(in_node)] = OPEN
+                        stack.append((in_node, 0))
+                    elif in_state == OPEN:
+                        raise ValueError('graph contains a cycle through '
+                                         '{}'.format(in_node.name))
+                else:
+                    stack.pop()
+                    state[id(node)] = DONE
+                    yield node
 
     def __repr__(self):
         return 'TensorFlow graph object with {} nodes'.format(len(self.nodes))
@@ -182,13 +281,18 @@ class TFGraph(object):
 #                                                   Matconvnet objects
 # --------------------------------------------------------------------
 
-def buildMcnLayerName(op, layerNames):
-    """ 
-    construct matconvnet layer name
-    """ 
-    num_prev_ops = sum([op in x for x in layerNames])
-    name = '{}_{}'.format(op, num_prev_ops + 1)
-    return name
+class LayerNames(object):
+    """
+    construct matconvnet layer names of the form `<op>_<k>`, where k counts
+    the layers built so far for that op. A counter is kept per op so that
+    each name costs O(1), independently of the number of layers issued
+    """
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def build(self, op):
+        self.counts[op] += 1
+        return '{}_{}'.format(op, self.counts[op])
 
 class McnNode(object):
     def __init__(self, name, value, op, input_nodes=None):
@@ -204,6 +308,7 @@ class McnLayer(object):
         self.outputs = outputs
         self.params = []
         self.model = None
+        self.tf_name = None # the tf node computing the output, if any
 
     def toMatlab(self):
         mlayer = np.empty(shape=[1,],dtype=mlayerdt)
@@ -221,26 +326,43 @@ class McnConv(McnLayer):
         # parse the expression formed by input nodes
         assert len(input_nodes) == 2, 'conv layer expects two nodes as inputs'
 
-        [pad_node, filter_node] = parse_inputs(input_nodes, ['Pad', 'Const'])
+        [filter_node, in_node] = parse_inputs(input_nodes, ['Const', 'Any'])
 
         # define input and output variable names
-        inputs = [pad_node.name]
+        inputs = [in_node.name]
         outputs = [name]
         super().__init__(name, inputs, outputs)
 
-        # determine filter dimensions
-        self.kernel_size = filter_node.value.shape[:2]
-        self.num_out = filter_node.value.shape[3]
+        # determine filter dimensions (TF filters are HWIO in any layout)
+        filters = tf_layout.mcn_filters(filter_node.value, 'HWIO')
+        self.kernel_size = filters.shape[:2]
+        self.num_out = filters.shape[3]
 
         # a bias is often not used in conjuction with batch norm
         self.bias_term = 0 
 
-        # reformat padding to match mcn
-        tf_pad = pad_node.value
+        # reformat padding to match mcn. The padding of a `Pad` node in
+        # front of the conv (`input_pad`) adds to that of the conv itself,
+        # which is `EXPLICIT` when the two were merged (see
+        # `tf_optimize.simplify_graph`). `SAME` padding is only known once
+        # shapes have been propagated (see `mcn_shapes.layer_out`)
         param_format = tf_node.data_format
-        pad_top_bottom = tf_pad[param_format[0],:]
-        pad_left_right = tf_pad[param_format[1],:]
-        self.pad = np.hstack((pad_top_bottom, pad_left_right))
+        self.input_pad = np.zeros(4, dtype=int)
+        if in_node.op == 'Pad':
+            tf_pad = tf_tensor.resolve(in_node.value)
+            for dim in set(range(len(tf_pad))) - set(param_format[:2]):
+                if tf_pad[dim].any():
+                    raise NotImplementedError('the input of {} is padded '
+                        'along its batch or channel dim'.format(tf_node.name))
+            pad_top_bottom = tf_pad[param_format[0],:]
+            pad_left_right = tf_pad[param_format[1],:]
+            self.input_pad = np.hstack((pad_top_bottom, pad_left_right))
+        self.pad = self.input_pad
+        self.pad_type = tf_node.pad_type
+        if tf_node.pad_type == 'EXPLICIT':
+            self.pad = self.input_pad + np.array(tf_node.explicit_pad)
+        elif in_node.op == 'Pad' and tf_node.pad_type == 'VALID':
+            self.pad_type = 'EXPLICIT'
 
         # reformat stride to match mcn
         stride_x = tf_node.stride[param_format[0]]
@@ -261,14 +383,14 @@ class McnConv(McnLayer):
         # TODO(sam) - handle dilated convs properly
         self.dilation = dilation
 
-        self.filter_depth = filter_node.value.shape[2]
-        self.num_output = filter_node.value.shape[3]
+        self.filter_depth = filters.shape[2]
+        self.num_output = filters.shape[3]
 
         # set param names and store weights on the layer - note that
         # biases may be set later
         filter_name = name + '_filter'
         self.params = [filter_name,]
-        self.param_values = {filter_name: filter_node.value}
+        self.param_values = {filter_name: filters}
 
     def toMatlab(self):
         size = list(self.kernel_size) + [self.filter_depth, self.num_output]
@@ -296,23 +418,9 @@ class McnReLU(McnLayer):
         super().__init__(name, inputs, outputs)
 
         # check for leak
-        self.leak = leak_node.value
+        self.leak = tf_tensor.resolve(leak_node.value)
         self.op = 'relu'
 
-    @staticmethod
-    def is_leaky_relu_expression(tf_node, input_nodes):
-        """ 
-        pattern match to check for leaky relu
-        """
-        try :
-            [mul_node, raw_node] = parse_inputs(input_nodes, ['Mul', 'Any'])
-        except ParseException:
-            return False 
-
-        #TODO(sam): add in more robust checks
-        is_leaky_relu = id(raw_node) in [id(node) for node in mul_node.input_nodes]
-        return is_leaky_relu
-
     def toMatlab(self):
         mlayer = super().toMatlab()
         mlayer['type'][0] = u'dagnn.ReLU'
@@ -329,7 +437,9 @@ class McnConcat(McnLayer):
  
         super().__init__(name, inputs, outputs)
 
-        self.axis = tf_node.axis
+        # the axis is given by the last input, in the layout of the inputs
+        axis = int(tf_tensor.resolve(tf_node.inputs[-1].value))
+        self.axis = tf_layout.mcn_axis(axis, tf_node.data_format)
         self.op = 'concat'
 
     def toMatlab(self):
@@ -344,7 +454,7 @@ class McnExtractImagePatches(McnLayer):
 
         # parse inputs
         src_node = input_nodes[0]
-        param_format = [1,2,3,0] # this is currently the form of the TF layer, but may change
+        param_format = tf_node.data_format
 
         inputs = src_node.outputs
         outputs = [name]
@@ -352,19 +462,26 @@ class McnExtractImagePatches(McnLayer):
         super().__init__(name, inputs, outputs)
 
         # reformat kernel size to match mcn
+        tf_kernel_size = tf_node.ksize
+        kernel_size_y = tf_kernel_size[param_format[0]]
+        kernel_size_x = tf_kernel_size[param_format[1]]
+        self.kernel_size = np.hstack((kernel_size_y, kernel_size_x))
+
+        # reformat stride to match mcn
         tf_stride = tf_node.stride
         stride_y = tf_stride[param_format[0]]
         stride_x = tf_stride[param_format[1]]
         self.stride = np.hstack((stride_y, stride_x))
 
-        # reformat kernel size to match mcn
+        # reformat rate to match mcn
         tf_rate = tf_node.rate
         rate_y = tf_rate[param_format[0]]
         rate_x = tf_rate[param_format[1]]
         self.rate = np.hstack((rate_y, rate_x))
 
-        #TODO(sam) fix properly on the first pass
-        self.pad = [1, 1, 1, 1]
+        # `SAME` padding depends on the input size, and is only known once
+        # shapes have been propagated (see `mcn_shapes.infer_shapes`)
+        self.pad = [0, 0, 0, 0]
         self.pad_type = tf_node.pad_type
 
     def toMatlab(self):
@@ -376,6 +493,60 @@ class McnExtractImagePatches(McnLayer):
              'pad': row(self.pad)})
         return mlayer
 
+def space_to_depth_index(in_size, block_size):
+    """
+    the gather index of a space-to-depth rearrangement of an (H,W,C) input
+    into blocks of `block_size` pixels: entry k is the (1-based,
+    column-major) input element copied to the k-th output element. Output
+    channels are in (block row, block column, channel) order, as with TF's
+    `SpaceToDepth` (and `ExtractImagePatches` over non-overlapping
+    windows); rows and columns beyond the last full block are dropped
+    """
+    height, width, channels = [int(x) for x in in_size]
+    block_y, block_x = [int(x) for x in block_size]
+    oh = np.arange(height // block_y).reshape(-1, 1, 1)
+    ow = np.arange(width // block_x).reshape(1, -1, 1)
+    oc = np.arange(block_y * block_x * channels).reshape(1, 1, -1)
+    by, bx, c = oc // (block_x * channels), (oc // channels) % block_x, oc % channels
+    src = (oh * block_y + by) + height * ((ow * block_x + bx) + width * c)
+    return (src.ravel(order='F') + 1).astype(np.uint32)
+
+class McnSpaceToDepth(McnLayer):
+    """
+    moves each block of `block_size` pixels into the channels of one output
+    position, as YOLOv2's `reorg` layer does (which darkflow exports as
+    `ExtractImagePatches` over non-overlapping windows). The rearrangement
+    is a single gather through `index` (see `space_to_depth_index`), which
+    depends on the input size and is set once shapes have been propagated
+    (see `mcn_shapes.infer_shapes`)
+    """
+    def __init__(self, name, tf_node, input_nodes):
+        assert len(input_nodes) == 1, 'space to depth layer expects one node as input'
+
+        src_node = input_nodes[0]
+        inputs = src_node.outputs
+        outputs = [name]
+        super().__init__(name, inputs, outputs)
+
+        if tf_node.op == 'SpaceToDepth':
+            self.block_size = np.hstack((tf_node.block_size, tf_node.block_size))
+        else:
+            param_format = tf_node.data_format
+            self.block_size = np.hstack((tf_node.ksize[param_format[0]],
+                                         tf_node.ksize[param_format[1]]))
+        self.input_size = [0, 0, 0]
+        self.index = np.zeros(0, dtype=np.uint32)
+        self.op = 'space_to_depth'
+
+    def toMatlab(self):
+        mlayer = super().toMatlab()
+        mlayer['type'][0] = u'dagnn.SpaceToDepth'
+        mlayer['block'][0] = dictToMatlabStruct(
+            {'blockSize': row(self.block_size),
+             'inputSize': row(self.input_size),
+             'index': self.index.reshape(-1, 1)})
+        return mlayer
+
 class McnBatchNorm(McnLayer):
 
     def __init__(self, name, tf_node, input_nodes, eps=1e-5):
@@ -410,36 +581,6 @@ class McnBatchNorm(McnLayer):
                              variance_name: self.variance, 
                              scale_factor_name: self.scale_factor}
 
-    @staticmethod
-    def is_batch_norm_expression(tf_node, input_nodes):
-        """ 
-        in order to extract batch normalization layers from a tensor flow
-        computational graph, we need to be able to match against the set
-        of operations which constitute batch norm.  This method performs
-        that pattern matching
-        """
-
-        try :
-            [bias_node, mul_node] = parse_inputs(input_nodes, ['Const', 'Mul'])
-        except ParseException:
-            return False # unexpected format from batch norm
-
-        # check for required sequence of ops
-        expected_div_ops = {'Const', 'RealDiv'}
-        div_ops = set([node.op for node in mul_node.input_nodes])
-
-        try :
-            [var_node, div_node] = parse_inputs(mul_node.input_nodes, ['Const', 'RealDiv'])
-        except ParseException:
-            return False # unexpected format from batch norm
-
-        expected_sub_ops = {'Const', 'Sub'}
-        sub_ops = set([node.op for node in div_node.input_nodes])
-        is_bn = (sub_ops == expected_sub_ops) and (div_ops == expected_div_ops)
-
-        #TODO(sam): add in more robust checks
-        return is_bn
-
     def toMatlab(self):
         mlayer = super().toMatlab()
         mlayer['type'][0] = u'dagnn.BatchNorm'
@@ -469,8 +610,10 @@ class McnPooling(McnLayer):
         stride_x = tf_stride[param_format[1]]
         self.stride = np.hstack((stride_y, stride_x))
 
-        #TODO(sam) fix properly on the first pass
-        self.pad = [1, 1, 1, 1]
+        # `SAME` padding depends on the input size, and is only known once
+        # shapes have been propagated (see `mcn_shapes.infer_shapes`)
+        self.pad = [0, 0, 0, 0]
+        self.pad_type = tf_node.pad_type
 
         # define input and output variable names
         inputs = pool_node.outputs
@@ -490,3 +633,12 @@ class McnPooling(McnLayer):
              'stride': row(self.stride),
              'pad': row(self.pad)})
         return mlayer
+
+# --------------------------------------------------------------------
+#                                                        Command line
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import sys
+    import tf_cli
+    sys.exit(tf_cli.main())
@@ -0,0 +1,267 @@
+# Optimization passes that make the resulting MatConvNet network cheaper to
+# run: a simplification of the TF graph, applied before the layer patterns
+# are matched, and passes over the converted `TFModel`, applied before
+# export.
+
+import copy
+from collections import OrderedDict
+import numpy as np
+import tf_mcn
+import tf_tensor
+import mcn_exec
+import tf_spill
+
+# --------------------------------------------------------------------
+#                                                         model helpers
+# --------------------------------------------------------------------
+
+def consumers(tf_model):
+    """
+    map each variable name to the layers that take it as an input
+    """
+    var_consumers = {}
+    for layer in tf_model.layers.values():
+        for name in layer.inputs:
+            var_consumers.setdefault(name, []).append(layer)
+    return var_consumers
+
+def producers(tf_model):
+    """
+    map each variable name to the layer that outputs it
+    """
+    return {name: layer for layer in tf_model.layers.values()
+            for name in layer.outputs}
+
+def remove_layer(tf_model, layer):
+    del tf_model.layers[layer.name]
+    for name in layer.params:
+        tf_model.params.pop(name, None)
+
+def set_param(tf_model, layer, name, value):
+    """
+    set a param value on both the layer and the model, adding it to the
+    model after the existing params of the layer if it is new
+    """
+    layer.param_values[name] = value
+    if name not in layer.params:
+        layer.params.append(name)
+    if name in tf_model.params:
+        tf_model.params[name].value = value
+        tf_model.params[name].shape = value.shape
+        return
+    param = tf_mcn.TfValue(name)
+    param.value = value
+    param.shape = value.shape
+
+    # keep the params of each layer together, in layer order
+    previous = layer.params[-2] if len(layer.params) > 1 else None
+    if previous not in tf_model.params:
+        tf_model.params[name] = param
+        return
+    params = OrderedDict()
+    for key, other in tf_model.params.items():
+        params[key] = other
+        if key == previous:
+            params[name] = param
+    tf_model.params.clear()
+    tf_model.params.update(params)
+
+# --------------------------------------------------------------------
+#                                                  batch norm folding
+# --------------------------------------------------------------------
+
+def fold_batch_norm(tf_model, probe_samples=32, seed=0,
+                    budget=tf_spill.NO_BUDGET):
+    """
+    fold every batch norm layer that directly follows a convolution (and is
+    the only consumer of its output) into that convolution. Darkflow
+    computes batch norm as `(x - mean) / divisor * gain + bias` per output
+    channel, so the folded filters are `w * gain / divisor` and the bias
+    `(b - mean) * gain / divisor + bias`, computed in float64 and cast back
+    to the filter type. The conv takes over the output variable of the
+    batch norm layer, which is removed along with its params. The folded
+    values are handed to `budget` (see `tf_spill`).
+
+    Returns a list with one record per folded layer, giving the largest
+    difference between the outputs of the original and the folded layers
+    on random inputs (`probe_samples` receptive fields per layer), both
+    absolute and relative to the largest output
+    """
+    var_consumers = consumers(tf_model)
+    var_producers = producers(tf_model)
+    rng = np.random.RandomState(seed)
+    report = []
+
+    for bn in list(tf_model.layers.values()):
+        if not isinstance(bn, tf_mcn.McnBatchNorm):
+            continue
+        conv = var_producers.get(bn.inputs[0])
+        if not isinstance(conv, tf_mcn.McnConv):
+            continue
+        if len(var_consumers.get(conv.outputs[0], [])) != 1:
+            continue # the unnormalized activations are used elsewhere
+
+        filter_name = conv.params[0]
+        filters = tf_tensor.resolve(conv.param_values[filter_name])
+        bias_name = conv.name + '_bias'
+        conv_bias = 0
+        if conv.bias_term:
+            conv_bias = tf_tensor.resolve(conv.param_values[bias_name])
+
+        mean, divisor, gain, bias = [
+            tf_tensor.resolve(x).astype(np.float64).reshape(-1)
+            for x in [bn.mean, bn.variance, bn.scale_factor, bn.bias_term]]
+        scale = gain / divisor
+        folded_filters = filters.astype(np.float64)
+        folded_filters *= scale # in place, so as to hold one float64 copy
+        folded_filters = folded_filters.astype(filters.dtype)
+        folded_bias = ((np.asarray(conv_bias, dtype=np.float64) - mean) * scale
+                       + bias).astype(filters.dtype)
+
+        error = probe_error(rng, probe_samples, filters, conv_bias, mean,
+                            divisor, gain, bias, folded_filters, folded_bias)
+        report.append(OrderedDict([('conv', conv.name), ('batch_norm', bn.name)],
+                                  **error))
+
+        # rewire: the conv now produces the batch norm output
+        del tf_model.vars[conv.outputs[0]]
+        conv.outputs = list(bn.outputs)
+        conv.tf_name = bn.tf_name
+        var_producers[conv.outputs[0]] = conv
+        remove_layer(tf_model, bn)
+
+        conv.bias_term = 1
+        set_param(tf_model, conv, filter_name, budget.hold(folded_filters))
+        set_param(tf_model, conv, bias_name, budget.hold(folded_bias))
+    return report
+
+def probe_error(rng, num_samples, filters, conv_bias, mean, divisor, gain,
+                bias, folded_filters, folded_bias):
+    """
+    evaluate the original and folded layers at single output positions,
+    treating each as a product of random receptive fields with the filters
+    """
+    dtype = filters.dtype
+    fields = rng.standard_normal((num_samples, int(np.prod(filters.shape[:3]))))
+    fields = fields.astype(dtype)
+    num_out = filters.shape[3]
+    x = fields @ filters.reshape(-1, num_out) + np.asarray(conv_bias, dtype=dtype)
+    original = ((x - mean.astype(dtype)) / divisor.astype(dtype)
+                * gain.astype(dtype) + bias.astype(dtype))
+    folded = fields @ folded_filters.reshape(-1, num_out) + folded_bias
+    max_error = float(np.abs(folded - original).max())
+    scale = max(float(np.abs(original).max()), np.finfo(dtype).tiny)
+    return {'max_abs_error': max_error, 'max_rel_error': max_error / scale}
+
+# --------------------------------------------------------------------
+#                                                graph simplification
+# --------------------------------------------------------------------
+
+# ops that are evaluated (with `mcn_exec.run_node`) when all of their
+# inputs are constant
+foldable_ops = ['Pad', 'Add', 'AddV2', 'Sub', 'RealDiv', 'Mul', 'Sqrt',
+                'Rsqrt', 'Maximum', 'BiasAdd', 'Conv2D', 'MaxPool', 'AvgPool',
+                'ExtractImagePatches', 'SpaceToDepth', 'ConcatV2']
+
+def spatial_pad(pad_node, data_format):
+    """
+    the `[top bottom left right]` padding of a `Pad` node with constant
+    paddings that only pad the spatial dims of its input, or None
+    """
+    paddings = [x for x in pad_node.inputs if x.op == 'Const']
+    if len(paddings) != 1:
+        return None
+    paddings = tf_tensor.resolve(paddings[0].value)
+    if paddings.shape != (4, 2):
+        return None
+    for dim in set(range(4)) - set(data_format[:2]):
+        if paddings[dim].any():
+            return None
+    return [int(p) for dim in data_format[:2] for p in paddings[dim]]
+
+def fold_value(node, values, budget=tf_spill.NO_BUDGET):
+    """
+    the (read-only) output of `node` given the `values` of its inputs, held
+    by `budget`
+    """
+    value = np.asarray(mcn_exec.run_node(node, [tf_tensor.resolve(x)
+                                                for x in values]))
+    value.setflags(write=False)
+    return budget.hold(value)
+
+def rewire(node, inputs):
+    """
+    a copy of `node` taking `inputs`, leaving `node` as it is
+    """
+    node = copy.copy(node)
+    node.inputs = list(inputs)
+    return node
+
+def simplify_graph(tf_graph, heads, budget=tf_spill.NO_BUDGET):
+    """
+    rewrite the part of the graph that `heads` depend on so that there is
+    less left to match: nodes whose inputs are all constant are replaced by
+    `Const` nodes holding their values, chains of `Identity` nodes are
+    bypassed, and a `Pad` in front of a `VALID` conv is merged into it as
+    `EXPLICIT` padding. Pads are not merged into pooling, since MatConvNet
+    leaves the padding out of both max and average pooling, while a `Pad`
+    node pads with zeros. The heads themselves are kept as they are. There
+    are no `NoOp`s left to remove, since they are only ever control inputs,
+    which are not followed when the graph is pruned (see
+    `import_tf.find_reachable`).
+
+    The nodes of `tf_graph` are left as they are: those that change are
+    replaced by copies (so the heads should be looked up again by name).
+    Each folded `Const` keeps the node it was computed by as
+    `folded_from`, so that plans can compute it again (see `tf_plan`). The
+    folded values are computed in full, and handed to `budget` (see
+    `tf_spill`). Returns the graph of the nodes still needed, and counts of
+    each rewrite
+    """
+    nodes = list(tf_graph.post_order(heads))
+    stats = OrderedDict([('nodes', len(nodes)), ('folded', 0),
+                         ('identities', 0), ('pads', 0)])
+    keep = {id(head) for head in heads}
+    replaced = {} # id of a removed node -> the node standing in for it
+    order = [] # the rewritten nodes, inputs first
+    for source in nodes:
+        node = source
+        inputs = [replaced.get(id(x), x) for x in node.inputs]
+        if any(x is not y for x, y in zip(inputs, node.inputs)):
+            node = replaced[id(source)] = rewire(node, inputs)
+        order.append(node)
+        if id(source) in keep:
+            keep.add(id(node))
+            continue
+
+        if node.op == 'Identity':
+            replaced[id(source)] = node.inputs[0]
+            order.pop()
+            stats['identities'] += 1
+        elif (node.op in foldable_ops
+                and all(x.op == 'Const' for x in node.inputs)):
+            value = fold_value(node, [x.value for x in node.inputs], budget)
+            order[-1] = tf_mcn.TFNode(node.name, [], 'Const',
+                                      shape=list(value.shape), value=value,
+                                      folded_from=node)
+            replaced[id(source)] = order[-1]
+            stats['folded'] += 1
+        elif (node.op == 'Conv2D' and node.pad_type == 'VALID'
+                and node.inputs[0].op == 'Pad'):
+            pad = spatial_pad(node.inputs[0], node.data_format)
+            if pad is not None:
+                src = [x for x in node.inputs[0].inputs if x.op != 'Const']
+                node = order[-1] = replaced[id(source)] = rewire(
+                    node, src[:1] + node.inputs[1:])
+                node.pad_type = 'EXPLICIT'
+                node.explicit_pad = pad
+                stats['pads'] += 1
+
+    # drop the nodes that are no longer needed, such as folded inputs
+    needed = set(keep)
+    for node in reversed(order):
+        if id(node) in needed:
+            needed.update(id(x) for x in node.inputs)
+    tf_graph = tf_mcn.TFGraph([x for x in order if id(x) in needed])
+    stats['simplified_nodes'] = len(tf_graph)
+    return tf_graph, stats
@@ -0,0 +1,242 @@
+# Declarative pattern matching of TensorFlow subgraphs onto MatConvNet
+# layers.
+#
+# Matconvnet works at the 'layer' abstraction, while TensorFlow works at
+# the `op` level of abstraction. To reconcile this difference, the graph
+# of tf nodes is converted into a set of mcn nodes by pattern matching
+# common operations and clustering them into layers. Each pattern is
+# declared once below as a tree of `Op`s rooted at the node that produces
+# its output, together with the function that builds the mcn object for
+# it. The patterns are indexed by the op of their root, so that converting
+# a node only tries the patterns that could possibly match it, and every
+# node is converted exactly once in a single post-order pass.
+
+import itertools
+from collections import OrderedDict
+import tf_mcn
+
+ANY = 'Any'
+
+# --------------------------------------------------------------------
+#                                                            patterns
+# --------------------------------------------------------------------
+
+class Op(object):
+    """
+    A node of a pattern. Matches a tf node with the given `op` (or any op,
+    for `ANY`) whose inputs match `inputs`, in any order (as with
+    `tf_mcn.parse_inputs`). If `inputs` is None the inputs are not
+    constrained. A node matched by an Op with a `bind` name is captured
+    under that name; if the name is used more than once in a pattern, all
+    uses must match the same node.
+    """
+    def __init__(self, op, inputs=None, bind=None):
+        self.op = op
+        self.inputs = inputs
+        self.bind = bind
+
+    def match(self, node, bound):
+        """
+        return the bindings extended with this match, or None
+        """
+        if self.op != ANY and node.op != self.op:
+            return None
+        if self.bind is not None:
+            if self.bind in bound and bound[self.bind] is not node:
+                return None
+            bound = dict(bound)
+            bound[self.bind] = node
+        if self.inputs is None:
+            return bound
+        if len(node.inputs) != len(self.inputs):
+            return None
+        for in_nodes in itertools.permutations(node.inputs):
+            result = bound
+            for sub_op, in_node in zip(self.inputs, in_nodes):
+                result = sub_op.match(in_node, result)
+                if result is None:
+                    break
+            if result is not None:
+                return result
+        return None
+
+class Pattern(object):
+    """
+    A named pattern, with the function `build(node, bound, overlay)` that
+    creates the mcn object for a tf node matching `root`
+    """
+    def __init__(self, name, root, build):
+        self.name = name
+        self.root = root
+        self.build = build
+
+class PatternSet(object):
+    """
+    A set of patterns compiled into an index from root op to the patterns
+    rooted at that op (tried in declaration order). Counts of the attempted
+    and successful matches of each pattern are kept in `stats`.
+    """
+    def __init__(self, patterns=None):
+        self.patterns = patterns if patterns is not None else PATTERNS
+        self.index = {}
+        self.wildcards = []
+        for pattern in self.patterns:
+            if pattern.root.op == ANY:
+                self.wildcards.append(pattern)
+            else:
+                self.index.setdefault(pattern.root.op, []).append(pattern)
+        self.stats = OrderedDict((pattern.name, {'tried': 0, 'matched': 0})
+                                 for pattern in self.patterns)
+
+    def match(self, node):
+        """
+        return `(pattern, bindings)` for the first pattern matching `node`,
+        or None
+        """
+        for pattern in self.index.get(node.op, []) + self.wildcards:
+            self.stats[pattern.name]['tried'] += 1
+            bound = pattern.root.match(node, {})
+            if bound is not None:
+                self.stats[pattern.name]['matched'] += 1
+                return pattern, bound
+        return None
+
+    def convert(self, node, overlay):
+        """
+        set `node.mcn` from the first matching pattern. The inputs of the
+        node must already have been converted
+        """
+        match = self.match(node)
+        if match is None:
+            if node.op in self.index:
+                raise NotImplementedError('no pattern for {} node {} with '
+                    'inputs {}'.format(node.op, node.name,
+                                       [x.op for x in node.inputs]))
+            raise ValueError('node op {} not recognised'.format(node.op))
+        pattern, bound = match
+        node.mcn = pattern.build(node, bound, overlay)
+        return node.mcn
+
+# --------------------------------------------------------------------
+#                                                            builders
+# --------------------------------------------------------------------
+
+class Overlay(object):
+    """
+    The mcn layers built so far, with unique names for each new layer
+    """
+    def __init__(self):
+        self.layers = []
+        self.layer_names = tf_mcn.LayerNames()
+
+    def add_layer(self, node, layer_type, *args, prefix=None):
+        name = self.layer_names.build(prefix or node.op)
+        layer = layer_type(name, node, mcn_inputs(node), *args)
+        layer.tf_name = node.name
+        self.layers.append(layer)
+        return layer
+
+def mcn_inputs(node):
+    return [in_node.mcn for in_node in node.inputs]
+
+def build_source(node, bound, overlay):
+    value = node.value if node.op == 'Const' else []
+    return tf_mcn.McnNode(name=node.name, value=value, op=node.op)
+
+def build_expression(node, bound, overlay):
+    return tf_mcn.McnNode(name=node.name, value=[], op=node.op,
+                          input_nodes=mcn_inputs(node))
+
+def build_identity(node, bound, overlay):
+    src_node = bound['src'].mcn
+    return tf_mcn.McnNode(name=src_node.name, value=[], op=node.op,
+                          input_nodes=mcn_inputs(node))
+
+def build_pad(node, bound, overlay):
+    src_node = bound['src'].mcn
+    return tf_mcn.McnNode(name=src_node.name, value=bound['pad'].value,
+                          op=node.op, input_nodes=mcn_inputs(node))
+
+def build_patches(node, bound, overlay):
+    """
+    patches over non-overlapping windows are a rearrangement of the input
+    into channels, which is built (and named) as a space-to-depth layer
+    """
+    if (list(node.ksize) == list(node.stride) and set(node.rate) == {1}
+            and node.pad_type == 'VALID'):
+        return overlay.add_layer(node, tf_mcn.McnSpaceToDepth,
+                                 prefix='SpaceToDepth')
+    return overlay.add_layer(node, tf_mcn.McnExtractImagePatches)
+
+def layer_builder(layer_type, *args):
+    def build(node, bound, overlay):
+        return overlay.add_layer(node, layer_type, *args)
+    return build
+
+def merge_conv_bias(node, bound, overlay):
+    """
+    if batch norm is not used, then we merge the bias with the preceeding
+    convolutional layer, which then also stands for the output of the bias
+    """
+    conv_layer = bound['conv'].mcn
+    conv_layer.bias_term = 1 # bias is now used
+    bias_name = conv_layer.name + '_bias'
+    conv_layer.params.append(bias_name)
+    conv_layer.param_values[bias_name] = bound['bias'].value
+    conv_layer.tf_name = node.name
+    return conv_layer
+
+# --------------------------------------------------------------------
+#                                                 pattern declarations
+# --------------------------------------------------------------------
+
+PATTERNS = [
+    # graph inputs
+    Pattern('placeholder', Op('Placeholder', []), build_source),
+    Pattern('const', Op('Const', []), build_source),
+
+    # expressions that only take part in larger patterns
+    Pattern('sub', Op('Sub'), build_expression),
+    Pattern('real_div', Op('RealDiv'), build_expression),
+    Pattern('mul', Op('Mul'), build_expression),
+    Pattern('identity', Op('Identity', [Op(ANY, bind='src')]), build_identity),
+    Pattern('pad', Op('Pad', [Op('Const', bind='pad'), Op(ANY, bind='src')]),
+            build_pad),
+
+    # layers
+    Pattern('conv', Op('Conv2D', [Op(ANY), Op('Const')]),
+            layer_builder(tf_mcn.McnConv)),
+    Pattern('max_pool', Op('MaxPool', [Op(ANY)]),
+            layer_builder(tf_mcn.McnPooling, 'max')),
+    Pattern('avg_pool', Op('AvgPool', [Op(ANY)]),
+            layer_builder(tf_mcn.McnPooling, 'avg')),
+    Pattern('concat', Op('ConcatV2'), layer_builder(tf_mcn.McnConcat)),
+    Pattern('extract_image_patches', Op('ExtractImagePatches', [Op(ANY)]),
+            build_patches),
+    Pattern('space_to_depth', Op('SpaceToDepth', [Op(ANY)]),
+            layer_builder(tf_mcn.McnSpaceToDepth)),
+
+    # batch norm, as folded into the graph by darkflow:
+    #   ((conv - mean) / var) * gain + bias
+    Pattern('batch_norm',
+            Op('BiasAdd', [
+                Op('Mul', [
+                    Op('RealDiv', [
+                        Op('Sub', [Op('Conv2D'), Op('Const')]),
+                        Op('Const')]),
+                    Op('Const')]),
+                Op('Const')]),
+            layer_builder(tf_mcn.McnBatchNorm)),
+
+    # a bias without batch norm, merged into its convolution
+    Pattern('conv_bias',
+            Op('BiasAdd', [Op('Conv2D', bind='conv'), Op('Const', bind='bias')]),
+            merge_conv_bias),
+
+    # leaky relu, expressed as max(leak * x, x)
+    Pattern('leaky_relu',
+            Op('Maximum', [
+                Op('Mul', [Op('Const'), Op(ANY, bind='x')]),
+                Op(ANY, bind='x')]),
+            layer_builder(tf_mcn.McnReLU)),
+]
@@ -0,0 +1,205 @@
+# Layer plans, for converting successive snapshots of the same network
+# without redoing the work that only depends on its topology. A plan holds
+# the mcn layers of a conversion (as built by the patterns, before any
+# optimization pass) with their weights taken out, a record of which
+# `Const` node each weight came from, and a fingerprint of the graph. A
+# later snapshot is converted by checking that its graph has the same
+# fingerprint, decoding only the `Const` nodes that hold weights, and
+# binding their values into a copy of the planned layers - so that the
+# cost of a refresh grows with the weights rather than with the graph.
+#
+# The fingerprint covers the raw bytes of every node the outputs depend on,
+# except for the weights themselves, whose dtype and shape are checked
+# instead: any change to the structure, the attributes or the small
+# constants baked into the layers (paddings, leaks, ...) rejects the plan.
+# Weights computed from constants when the graph was simplified (see
+# `tf_optimize.simplify_graph`) are planned as a `FoldRecipe` over the
+# constants they were computed from, and computed again on each refresh.
+
+import copy
+import pickle
+import hashlib
+from pathlib import Path
+import numpy as np
+import tf_mcn
+import tf_proto
+import tf_optimize
+import tf_spill
+
+# layer attributes holding references into the conversion, not settings
+transient_attrs = ['input_nodes', 'model']
+
+class PlanMismatch(ValueError):
+    pass
+
+class LayerPlan(object):
+    def __init__(self, outputs, layers, bindings, sources, fingerprint):
+        self.version = tf_mcn.__version__
+        self.outputs = outputs
+        self.layers = layers         # pickled layers, without their weights
+        self.bindings = bindings     # (layer, attribute, key, source node)
+        self.sources = sources       # source node -> (dtype, shape)
+        self.fingerprint = fingerprint
+
+class FoldRecipe(object):
+    """
+    How a folded constant is computed: by `node` (a copy without its
+    inputs or graph references), from the values of `inputs`, which are
+    the names of source nodes or recipes themselves
+    """
+    def __init__(self, node, inputs):
+        self.node = node
+        self.inputs = inputs
+
+# node attributes that refer into the graph, rather than describe the op
+graph_attrs = ['name', 'input_names', 'op', 'inputs', 'control_inputs',
+               'mcn', 'value', 'folded_from']
+
+# --------------------------------------------------------------------
+#                                                            planning
+# --------------------------------------------------------------------
+
+def graph_fingerprint(graph_buf, spans, sources):
+    """
+    hash the nodes at `spans`, leaving out the values of the `sources`.
+    Returns the digest and the spans of the source nodes, by name
+    """
+    digest = hashlib.sha256()
+    source_spans = {}
+    view = memoryview(graph_buf)
+    for offset, length in spans:
+        node = tf_proto.NodeDef(graph_buf, (offset, length))
+        if node.name in sources:
+            source_spans[node.name] = (offset, length)
+            digest.update('{} {}\n'.format(node.name, node.op).encode())
+        else:
+            digest.update(view[offset:offset + length])
+    return digest.hexdigest(), source_spans
+
+def make_plan(tf_model, tf_nodes, outputs, graph_buf, spans):
+    """
+    record the layers of `tf_model`, as converted from `tf_nodes` (the
+    nodes read from `graph_buf` at `spans`, followed by those of the
+    simplified graph, if any), and where their weights came from. This
+    must be done before any optimization pass changes the layers
+    """
+    # the node holding each value. Reads of a variable are given copies of
+    # its value, so the variable itself is preferred as the source
+    value_nodes = {}
+    for node in tf_nodes:
+        if node.op != 'Const':
+            continue
+        if (id(node.value) not in value_nodes
+                or getattr(node, 'variable', None) == node.name):
+            value_nodes[id(node.value)] = node
+
+    layers = []
+    bindings = []
+    sources = {}
+    recipes = {} # id of a folded node -> its recipe, shared by its uses
+    def source(node):
+        node = value_nodes.get(id(node.value), node)
+        folded_from = getattr(node, 'folded_from', None)
+        if folded_from is None:
+            sources[node.name] = (str(np.dtype(node.value.dtype)),
+                                  tuple(node.value.shape))
+            return node.name
+        if id(node) not in recipes:
+            op = tf_mcn.TFNode(folded_from.name, [], folded_from.op,
+                **{key: value for key, value in vars(folded_from).items()
+                   if key not in graph_attrs})
+            recipes[id(node)] = FoldRecipe(
+                op, [source(x) for x in folded_from.inputs])
+        return recipes[id(node)]
+
+    def bind(layer, attr, key, value):
+        node = value_nodes.get(id(value))
+        if node is None:
+            return value
+        bindings.append((layer.name, attr, key, source(node)))
+        return None
+
+    for layer in tf_model.layers.values():
+        planned = copy.copy(layer)
+        for attr, value in vars(layer).items():
+            if attr in transient_attrs:
+                setattr(planned, attr, None)
+            elif attr == 'param_values':
+                planned.param_values = {key: bind(layer, attr, key, x)
+                                        for key, x in value.items()}
+            else:
+                setattr(planned, attr, bind(layer, attr, None, value))
+        layers.append(planned)
+
+    fingerprint, _ = graph_fingerprint(graph_buf, spans, sources)
+    layers = pickle.dumps(layers, protocol=pickle.HIGHEST_PROTOCOL)
+    return LayerPlan(list(outputs), layers, bindings, sources, fingerprint)
+
+# --------------------------------------------------------------------
+#                                                              reuse
+# --------------------------------------------------------------------
+
+def check_graph(plan, graph_buf, spans):
+    """
+    check that the nodes at `spans` match the plan, returning the spans of
+    the nodes holding the weights
+    """
+    fingerprint, source_spans = graph_fingerprint(graph_buf, spans,
+                                                  plan.sources)
+    if fingerprint != plan.fingerprint or len(source_spans) != len(plan.sources):
+        raise PlanMismatch('the graph structure differs from that of the plan')
+    return [source_spans[name] for name in sorted(source_spans,
+                                                   key=source_spans.get)]
+
+def fold(recipe, values, folded, budget):
+    """
+    the value of a planned weight: that of a source node, or that computed
+    by a recipe (once, keeping it in `folded`)
+    """
+    if not isinstance(recipe, FoldRecipe):
+        return values[recipe]
+    if id(recipe) not in folded:
+        folded[id(recipe)] = tf_optimize.fold_value(
+            recipe.node, [fold(x, values, folded, budget)
+                          for x in recipe.inputs], budget)
+    return folded[id(recipe)]
+
+def build_model(plan, values, budget=tf_spill.NO_BUDGET):
+    """
+    a `TFModel` of the planned layers, with the weights bound to `values`
+    (the values of the source nodes, by name). Folded weights are computed
+    again from them, and handed to `budget`
+    """
+    for name, (dtype, shape) in plan.sources.items():
+        value = values[name]
+        if (str(np.dtype(value.dtype)), tuple(value.shape)) != (dtype, shape):
+            raise PlanMismatch('{} is a {}{} array, the plan expects {}{}'
+                               .format(name, value.dtype, tuple(value.shape),
+                                       dtype, shape))
+    layers = pickle.loads(plan.layers)
+    by_name = {layer.name: layer for layer in layers}
+    folded = {}
+    for layer_name, attr, key, source in plan.bindings:
+        layer = by_name[layer_name]
+        value = fold(source, values, folded, budget)
+        if key is None:
+            setattr(layer, attr, value)
+        else:
+            getattr(layer, attr)[key] = value
+
+    tf_model = tf_mcn.TFModel()
+    for layer in layers:
+        tf_model.addLayer(layer)
+    return tf_model
+
+def save_plan(plan, path):
+    with open(str(path), 'wb') as f:
+        pickle.dump(plan, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_plan(path):
+    with open(str(path), 'rb') as f:
+        plan = pickle.load(f)
+    if plan.version != tf_mcn.__version__:
+        raise PlanMismatch('plan {} was made by version {} of the converter'
+                           .format(Path(path).name, plan.version))
+    return plan
@@ -0,0 +1,187 @@
+# Instrumentation for conversions: wall time, CPU time and memory use of
+# each stage of the pipeline, and the number and size of the nodes of each
+# op, gathered into a JSON report (optionally alongside a cProfile dump).
+#
+# Usage:
+#   profile = Profiler(cprofile_path='convert.prof')
+#   with profile:
+#       with profile.stage('link'):
+#           ...
+#   profile.write('convert.json')
+
+import sys
+import json
+import time
+import cProfile
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # not available on windows
+    resource = None
+
+def peak_rss_bytes():
+    """
+    the peak resident set size of the process so far (or None if unknown)
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # linux: kB
+
+# --------------------------------------------------------------------
+#                                                             profiler
+# --------------------------------------------------------------------
+
+class Stage(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_rss = None
+        self.traced_peak = None
+
+    def to_dict(self):
+        return OrderedDict([('name', self.name),
+                            ('calls', self.calls),
+                            ('wall_seconds', self.wall),
+                            ('cpu_seconds', self.cpu),
+                            ('peak_rss_bytes', self.peak_rss),
+                            ('traced_peak_bytes', self.traced_peak)])
+
+class Profiler(object):
+    """
+    Record the cost of each named stage of a conversion. A stage may be
+    entered any number of times (e.g. once per node) and its costs are
+    accumulated; stages should not be nested. For each stage the report
+    gives the total wall and CPU time, the process peak RSS when it last
+    finished, and (with `trace_memory`) the largest increase in memory
+    allocated by Python during a single call, as seen by `tracemalloc`.
+    Tracing memory slows the conversion down considerably, so timings
+    are best taken with it off.
+    """
+
+    def __init__(self, trace_memory=False, cprofile_path=None):
+        self.trace_memory = trace_memory
+        self.cprofile_path = cprofile_path
+        self.stages = OrderedDict()
+        self.ops = OrderedDict()
+        self.info = OrderedDict()
+        self.cprofile = None
+        self.start_wall = self.start_cpu = None
+        self.wall = self.cpu = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.cprofile_path:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    def stop(self):
+        self.wall = time.perf_counter() - self.start_wall
+        self.cpu = time.process_time() - self.start_cpu
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_path)
+            self.cprofile = None
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage(name)
+        if self.trace_memory:
+            traced_start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield stage
+        finally:
+            stage.calls += 1
+            stage.wall += time.perf_counter() - start_wall
+            stage.cpu += time.process_time() - start_cpu
+            stage.peak_rss = peak_rss_bytes()
+            if self.trace_memory:
+                traced_peak = tracemalloc.get_traced_memory()[1] - traced_start
+                stage.traced_peak = max(stage.traced_peak or 0, traced_peak)
+
+    def iterate(self, name, iterable):
+        """
+        iterate over `iterable`, timing each step under stage `name` (but
+        not the work done by the caller between steps)
+        """
+        items = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    def count_op(self, op, num_bytes=0, value_bytes=0):
+        """
+        count a node of type `op`, occupying `num_bytes` of the serialized
+        graph and holding `value_bytes` of tensor data
+        """
+        counts = self.ops.get(op)
+        if counts is None:
+            counts = self.ops[op] = OrderedDict([('count', 0), ('bytes', 0),
+                                                 ('value_bytes', 0)])
+        counts['count'] += 1
+        counts['bytes'] += num_bytes
+        counts['value_bytes'] += value_bytes
+
+    def report(self):
+        return OrderedDict([
+            ('info', self.info),
+            ('wall_seconds', self.wall),
+            ('cpu_seconds', self.cpu),
+            ('peak_rss_bytes', peak_rss_bytes()),
+            ('stages', [stage.to_dict() for stage in self.stages.values()]),
+            ('ops', self.ops)])
+
+    def write(self, path):
+        with open(str(path), 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def summary_str(self):
+        lines = ['{:<12} {:>6} {:>9} {:>9} {:>10}'.format(
+                 'stage', 'calls', 'wall (s)', 'cpu (s)', 'rss (MB)')]
+        for stage in self.stages.values():
+            rss = stage.peak_rss / 2 ** 20 if stage.peak_rss else float('nan')
+            lines.append('{:<12} {:>6} {:>9.3f} {:>9.3f} {:>10.1f}'.format(
+                         stage.name, stage.calls, stage.wall, stage.cpu, rss))
+        return '\n'.join(lines)
+
+class NullProfiler(object):
+    """
+    A profiler that records nothing, used when profiling is off
+    """
+    @contextmanager
+    def stage(self, name):
+        yield None
+
+    def iterate(self, name, iterable):
+        return iter(iterable)
+
+    def count_op(self, op, num_bytes=0, value_bytes=0):
+        pass
+
+NULL = NullProfiler()
@@ -0,0 +1,457 @@
+# A minimal reader for the protobuf wire format and the handful of
+# TensorFlow messages needed to convert a frozen graph (`GraphDef`,
+# `NodeDef`, `AttrValue`, `TensorProto`), so that TensorFlow itself is not
+# needed at conversion time. The message objects mirror the attribute names
+# of the generated protobuf classes, and packed tensor data is referenced
+# by its span in the buffer rather than copied
+
+import collections.abc
+import numpy as np
+
+# --------------------------------------------------------------------
+#                                                         wire format
+# --------------------------------------------------------------------
+
+WIRE_VARINT = 0
+WIRE_I64 = 1
+WIRE_LEN = 2
+WIRE_I32 = 5
+
+def read_varint(buf, pos):
+    """
+    decode the base 128 varint starting at `pos`, returning the value and
+    the position of the following byte
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def iter_fields(buf, start, end):
+    """
+    iterate over the fields of the message occupying `buf[start:end]`,
+    yielding `(field_number, wire_type, value)`. For length-delimited
+    fields `value` is the `(offset, length)` span of the payload within
+    `buf`, so that nested messages and bytes can be visited or referenced
+    without being copied
+    """
+    pos = start
+    while pos < end:
+        # keys, small values and lengths fit in a single byte
+        key = buf[pos]
+        if key < 0x80:
+            pos += 1
+        else:
+            key, pos = read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x7
+        if wire_type == WIRE_VARINT:
+            value = buf[pos]
+            if value < 0x80:
+                pos += 1
+            else:
+                value, pos = read_varint(buf, pos)
+        elif wire_type == WIRE_LEN:
+            length = buf[pos]
+            if length < 0x80:
+                pos += 1
+            else:
+                length, pos = read_varint(buf, pos)
+            value = (pos, length)
+            pos += length
+        elif wire_type == WIRE_I64:
+            value = (pos, 8)
+            pos += 8
+        elif wire_type == WIRE_I32:
+            value = (pos, 4)
+            pos += 4
+        else:
+            raise ValueError('unsupported wire type {} at byte {}'.format(
+                              wire_type, pos))
+        yield field, wire_type, value
+    if pos != end:
+        raise ValueError('message overran its declared length')
+
+def skip_field(buf, pos, wire_type):
+    """
+    the position following the payload of a field (other than a
+    length-delimited one) whose key ends at `pos`
+    """
+    if wire_type == WIRE_VARINT:
+        return read_varint(buf, pos)[1]
+    if wire_type == WIRE_I64:
+        return pos + 8
+    if wire_type == WIRE_I32:
+        return pos + 4
+    raise ValueError('unsupported wire type {} at byte {}'.format(
+                      wire_type, pos))
+
+def read_bytes(buf, span):
+    offset, length = span
+    return bytes(buf[offset:offset + length])
+
+def read_str(buf, span):
+    return read_bytes(buf, span).decode('utf-8')
+
+def to_signed(value):
+    """
+    reinterpret a 64 bit varint as two's complement (negative int32 and
+    int64 values are both sign extended to 64 bits on the wire)
+    """
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+def read_varints(buf, span):
+    offset, length = span
+    pos, end = offset, offset + length
+    values = []
+    while pos < end:
+        value, pos = read_varint(buf, pos)
+        values.append(value)
+    return values
+
+# numpy dtypes of the fixed width scalar kinds
+fixed_kinds = {'float': '<f4', 'double': '<f8'}
+
+def read_scalars(buf, kind, wire_type, value):
+    """
+    decode one occurrence of a scalar field of the given kind, returning
+    a list of values - repeated numeric fields may arrive packed into a
+    single length-delimited run, or as one field per value
+    """
+    if kind in fixed_kinds:
+        dtype = np.dtype(fixed_kinds[kind])
+        offset, length = value
+        return np.frombuffer(buf, dtype=dtype, count=length // dtype.itemsize,
+                             offset=offset).tolist()
+    if wire_type == WIRE_LEN:
+        values = read_varints(buf, value)
+    else:
+        values = [value]
+    if kind == 'int':
+        return [to_signed(x) for x in values]
+    if kind == 'bool':
+        return [bool(x) for x in values]
+    return values
+
+# --------------------------------------------------------------------
+#                                                  GraphDef messages
+# --------------------------------------------------------------------
+
+# defaults of unset scalar fields, as returned by the protobuf classes
+kind_defaults = {'int': 0, 'uint': 0, 'bool': False, 'float': 0.0,
+                 'double': 0.0, 'string': '', 'bytes': b''}
+
+class Message(object):
+    """
+    A protobuf message read from the wire. Each subclass lists its fields
+    as `{number: (attribute, kind, repeated)}`, where kind is a scalar kind
+    (see `kind_defaults`), a Message subclass or 'span' (bytes that are
+    referenced as an `(offset, length)` span of the buffer instead of being
+    copied). Unset fields read as their protobuf defaults; unknown fields
+    are skipped.
+    """
+    fields = {}
+
+    def __init__(self, buf=None, span=None):
+        if buf is not None:
+            offset, length = span
+            self.parse(buf, offset, offset + length)
+
+    def parse(self, buf, start, end):
+        for number, wire_type, value in iter_fields(buf, start, end):
+            spec = self.fields.get(number)
+            if spec is None:
+                continue
+            attr, kind, repeated = spec
+            if isinstance(kind, type):
+                value = kind(buf, value)
+            elif kind == 'span':
+                pass
+            elif kind == 'string':
+                value = read_str(buf, value)
+            elif kind == 'bytes':
+                value = read_bytes(buf, value)
+            elif wire_type == WIRE_VARINT and kind in ('int', 'uint'):
+                if kind == 'int':
+                    value = to_signed(value)
+            else:
+                values = read_scalars(buf, kind, wire_type, value)
+                if repeated:
+                    self.__dict__.setdefault(attr, []).extend(values)
+                    continue
+                value = values[-1]
+            if repeated:
+                self.__dict__.setdefault(attr, []).append(value)
+            else:
+                setattr(self, attr, value)
+
+    def __getattr__(self, attr):
+        # only reached for fields that were not present on the wire
+        for name, kind, repeated in self.fields.values():
+            if name == attr:
+                if repeated:
+                    value = []
+                elif isinstance(kind, type):
+                    value = kind()
+                else:
+                    value = kind_defaults.get(kind)
+                setattr(self, attr, value)
+                return value
+        raise AttributeError(attr)
+
+class Dim(Message):
+    fields = {1: ('size', 'int', False),
+              2: ('name', 'string', False)}
+
+class TensorShapeProto(Message):
+    fields = {2: ('dim', Dim, True),
+              3: ('unknown_rank', 'bool', False)}
+
+class TensorProto(Message):
+    """
+    `tensor_content` is a zero-copy view into the buffer the message was
+    read from, whose location is kept in `content_span`
+    """
+    fields = {1: ('dtype', 'uint', False),
+              2: ('tensor_shape', TensorShapeProto, False),
+              3: ('version_number', 'int', False),
+              4: ('content_span', 'span', False),
+              5: ('float_val', 'float', True),
+              6: ('double_val', 'double', True),
+              7: ('int_val', 'int', True),
+              8: ('string_val', 'bytes', True),
+              10: ('int64_val', 'int', True),
+              11: ('bool_val', 'bool', True),
+              13: ('half_val', 'int', True),
+              16: ('uint32_val', 'uint', True),
+              17: ('uint64_val', 'uint', True)}
+
+    def __init__(self, buf=None, span=None):
+        self.buf = buf
+        self.content_span = None
+        super().__init__(buf, span)
+
+    @property
+    def tensor_content(self):
+        if self.content_span is None:
+            return b''
+        offset, length = self.content_span
+        return memoryview(self.buf)[offset:offset + length]
+
+class ListValue(Message):
+    fields = {2: ('s', 'bytes', True),
+              3: ('i', 'int', True),
+              4: ('f', 'float', True),
+              5: ('b', 'bool', True),
+              6: ('type', 'uint', True),
+              7: ('shape', TensorShapeProto, True),
+              8: ('tensor', TensorProto, True)}
+
+class AttrValue(Message):
+    fields = {1: ('list', ListValue, False),
+              2: ('s', 'bytes', False),
+              3: ('i', 'int', False),
+              4: ('f', 'float', False),
+              5: ('b', 'bool', False),
+              6: ('type', 'uint', False),
+              7: ('shape', TensorShapeProto, False),
+              8: ('tensor', TensorProto, False),
+              9: ('placeholder', 'string', False)}
+
+class AttrEntry(Message):
+    fields = {1: ('key', 'string', False),
+              2: ('value', AttrValue, False)}
+
+class AttrMap(collections.abc.Mapping):
+    """
+    `map<string, AttrValue>` - like the protobuf map, looking up a missing
+    key gives an empty AttrValue. The entries are only read when the map
+    is first used, and each value is decoded the first time it is looked up
+    """
+    def __init__(self, buf=None, entry_spans=()):
+        self.buf = buf
+        self.entry_spans = entry_spans
+        self.value_spans = None
+        self.decoded = {}
+
+    @property
+    def spans(self):
+        """
+        the span of the value of each key
+        """
+        if self.value_spans is None:
+            self.value_spans = {}
+            for offset, length in self.entry_spans:
+                key, span = '', (offset, 0)
+                for field, _, value in iter_fields(self.buf, offset,
+                                                   offset + length):
+                    if field == 1:
+                        key = read_str(self.buf, value)
+                    elif field == 2:
+                        span = value
+                self.value_spans[key] = span
+        return self.value_spans
+
+    def __getitem__(self, key):
+        if key not in self.spans:
+            return AttrValue()
+        if key not in self.decoded:
+            self.decoded[key] = AttrValue(self.buf, self.spans[key])
+        return self.decoded[key]
+
+    def __contains__(self, key):
+        return key in self.spans
+
+    def __iter__(self):
+        return iter(self.spans)
+
+    def __len__(self):
+        return len(self.spans)
+
+    def get(self, key, default=None):
+        return self[key] if key in self.spans else default
+
+class NodeDef(object):
+    """
+    A `NodeDef`, whose name, op, inputs and device are read in a single
+    pass over its fields, while its attributes are only skipped over by
+    length (most nodes of a graph, and all of those outside the part being
+    converted, never need them). Each use of `attr` gives a new map that
+    decodes them as they are looked up, so that nothing decoded is kept
+    alive by the node
+    """
+    def __init__(self, buf=None, span=None):
+        self.buf = buf
+        self.span = span # location in the serialized graph
+        self.name = ''
+        self.op = ''
+        self.input = []
+        self.device = ''
+        self.attr_spans = []
+        if buf is not None:
+            self.scan(buf, span)
+
+    def scan(self, buf, span):
+        offset, length = span
+        pos, end = offset, offset + length
+        while pos < end:
+            # keys and lengths nearly always fit in one byte
+            key = buf[pos]
+            if key < 0x80:
+                pos += 1
+            else:
+                key, pos = read_varint(buf, pos)
+            if key & 0x7 != WIRE_LEN:
+                pos = skip_field(buf, pos, key & 0x7)
+                continue
+            size = buf[pos]
+            if size < 0x80:
+                pos += 1
+            else:
+                size, pos = read_varint(buf, pos)
+            field = key >> 3
+            if field == 3:
+                self.input.append(str(buf[pos:pos + size], 'utf-8'))
+            elif field == 5:
+                self.attr_spans.append((pos, size))
+            elif field == 1:
+                self.name = str(buf[pos:pos + size], 'utf-8')
+            elif field == 2:
+                self.op = str(buf[pos:pos + size], 'utf-8')
+            elif field == 4:
+                self.device = str(buf[pos:pos + size], 'utf-8')
+            pos += size
+        if pos != end:
+            raise ValueError('message overran its declared length')
+
+    @property
+    def attr(self):
+        return AttrMap(self.buf, self.attr_spans)
+
+GRAPH_NODE = 1
+
+def iter_node_spans(buf):
+    """
+    yield the `(offset, length)` span of each serialized `NodeDef`
+    """
+    for field, wire_type, span in iter_fields(buf, 0, len(buf)):
+        if field == GRAPH_NODE and wire_type == WIRE_LEN:
+            yield span
+
+def iter_nodes(buf, spans=None):
+    """
+    yield the `NodeDef`s of a serialized `GraphDef` one at a time, so that
+    processing can start before the whole graph has been read. If `spans`
+    is given, only the nodes at those spans are decoded
+    """
+    for span in (iter_node_spans(buf) if spans is None else spans):
+        yield NodeDef(buf, span)
+
+class GraphDef(object):
+    """
+    The nodes of a serialized `GraphDef` (versions and the function
+    library are not needed for conversion, and are skipped)
+    """
+    def __init__(self, buf):
+        self.node = list(iter_nodes(buf))
+
+# --------------------------------------------------------------------
+#                                              TensorFlow cross-check
+# --------------------------------------------------------------------
+
+def cross_check(buf):
+    """
+    parse `buf` with both this reader and TensorFlow's generated protobuf
+    classes and return a list of human readable differences (empty if the
+    two agree). TensorFlow is only imported here, and is not otherwise
+    needed by the converter
+    """
+    import tf_tensor
+    from tensorflow.core.framework import graph_pb2
+    reference = graph_pb2.GraphDef()
+    reference.ParseFromString(memoryview(buf))
+    ours = GraphDef(buf)
+
+    diffs = []
+    if len(ours.node) != len(reference.node):
+        diffs.append('node count {} != {}'.format(len(ours.node),
+                                                  len(reference.node)))
+    for node, ref in zip(ours.node, reference.node):
+        where = 'node {}'.format(ref.name)
+        if (node.name, node.op, node.input) != (ref.name, ref.op, list(ref.input)):
+            diffs.append('{}: name/op/inputs differ'.format(where))
+        attrs = node.attr
+        if set(attrs) != set(ref.attr):
+            diffs.append('{}: attr keys differ'.format(where))
+            continue
+        for key, ref_attr in ref.attr.items():
+            attr = attrs[key]
+            kind = ref_attr.WhichOneof('value')
+            if kind == 'tensor' and ref_attr.tensor.dtype not in tf_tensor.tf2np_dtype:
+                same = (attr.tensor.dtype == ref_attr.tensor.dtype and
+                        attr.tensor.string_val == list(ref_attr.tensor.string_val))
+            elif kind == 'tensor':
+                ours_value = tf_tensor.decode_tensor(attr.tensor)
+                ref_value = tf_tensor.decode_tensor(ref_attr.tensor)
+                same = (ours_value.shape == ref_value.shape
+                        and np.array_equal(ours_value, ref_value))
+            elif kind == 'list':
+                same = all(list(getattr(attr.list, x)) == list(getattr(ref_attr.list, x))
+                           for x in ['s', 'i', 'f', 'b', 'type'])
+            elif kind == 'shape':
+                same = ([d.size for d in attr.shape.dim]
+                        == [d.size for d in ref_attr.shape.dim])
+            elif kind is None:
+                same = True
+            else:
+                same = getattr(attr, kind) == getattr(ref_attr, kind)
+            if not same:
+                diffs.append('{}: attr {} differs'.format(where, key))
+    return diffs
+
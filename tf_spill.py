@@ -0,0 +1,83 @@
+# Spilling of computed tensors to disk, so that a conversion stays within a
+# memory budget. The weights read from a graph or a checkpoint are already
+# lazy handles onto memory-mapped files (see `tf_tensor.TensorHandle`),
+# whose pages the OS can drop at will; what stays resident are the arrays
+# computed during the conversion - folded constants, batch norm folded
+# filters and quantized params. Each pass hands such arrays to a
+# `SpillBudget`, which keeps them in memory while the total stays within
+# the budget, and otherwise appends them to a scratch file and returns a
+# read-only `np.memmap` of them instead, which the exporter only reads back
+# as it writes each param out.
+
+import os
+import shutil
+import weakref
+import tempfile
+import numpy as np
+
+ALIGNMENT = 64 # byte alignment of each spilled array in the scratch file
+
+class SpillBudget(object):
+    """
+    Keep at most `max_bytes` of computed arrays in memory, spilling the rest
+    to a file in a temporary directory under `scratch_dir` (default: the
+    system temporary directory), which is removed by `close` (or when the
+    budget is garbage collected). Arrays are spilled as they are handed
+    over, once the budget is used up, rather than evicted later, since the
+    layers and nodes holding the arrays kept earlier are not tracked; arrays
+    that are later replaced still count against the budget. `stats` counts
+    the arrays and bytes kept and spilled.
+    """
+
+    def __init__(self, max_bytes, scratch_dir=None):
+        self.max_bytes = int(max_bytes)
+        self.dir = tempfile.mkdtemp(prefix='mcn-spill-', dir=scratch_dir)
+        self.path = os.path.join(self.dir, 'spill.bin')
+        self.file = open(self.path, 'wb')
+        self.cleanup = weakref.finalize(self, shutil.rmtree, self.dir,
+                                        ignore_errors=True)
+        self.stats = {'kept': 0, 'kept_bytes': 0,
+                      'spilled': 0, 'spilled_bytes': 0}
+
+    def hold(self, value):
+        """
+        return `value` (a numpy array), or a memory-mapped copy of it if it
+        does not fit in what is left of the budget
+        """
+        value = np.asarray(value)
+        if (value.nbytes == 0
+                or self.stats['kept_bytes'] + value.nbytes <= self.max_bytes):
+            self.stats['kept'] += 1
+            self.stats['kept_bytes'] += value.nbytes
+            return value
+        return self.spill(value)
+
+    def spill(self, value):
+        offset = -(-self.file.tell() // ALIGNMENT) * ALIGNMENT
+        self.file.write(b'\0' * (offset - self.file.tell()))
+        self.file.write(np.ascontiguousarray(value).data)
+        self.file.flush()
+        self.stats['spilled'] += 1
+        self.stats['spilled_bytes'] += value.nbytes
+        return np.memmap(self.path, dtype=value.dtype, mode='r', offset=offset,
+                         shape=value.shape)
+
+    def close(self):
+        """
+        remove the scratch file. Arrays spilled to it stay readable for as
+        long as they are referenced, where the OS allows it
+        """
+        self.file.close()
+        self.cleanup()
+
+class NoBudget(object):
+    """
+    A budget that keeps everything in memory, used when none is set
+    """
+    def hold(self, value):
+        return value
+
+    def close(self):
+        pass
+
+NO_BUDGET = NoBudget()
@@ -0,0 +1,111 @@
+# A content-addressed store of parameter values, shared by the networks
+# exported into it. Each value is split into fixed size chunks of raw
+# bytes, stored once under the sha256 of their contents, so that a tensor
+# used by several layers, or a layer left unchanged between fine-tuned
+# variants of the same backbone, is only ever written (and kept) once.
+#
+# The exported `.mat` file then holds empty params, and a descriptor of
+# each value under `net.meta.weights.<param name>`, giving its MATLAB
+# class, its shape and the hashes of its chunks. Values are stored in
+# MATLAB (column-major) order, so that each chunk can be read (or
+# memory-mapped) and reshaped without reordering, by `loadWeights` (see
+# matlab/) or `WeightStore.get`.
+
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import tf_mcn
+import tf_cache
+import mcn_export
+
+DEFAULT_CHUNK_BYTES = 4 * 2 ** 20
+
+# --------------------------------------------------------------------
+#                                                               store
+# --------------------------------------------------------------------
+
+class WeightStore(object):
+    """
+    Chunks stored under `root` as `chunks/<kk>/<hash>`. Chunks are written
+    to a temporary file and renamed into place, so several conversions
+    can share a store concurrently. `stats` counts the chunks and bytes
+    passed to `put`, and those that were new to the store.
+    """
+
+    def __init__(self, root, chunk_bytes=DEFAULT_CHUNK_BYTES):
+        self.root = Path(root)
+        self.chunk_bytes = chunk_bytes
+        self.stats = {'chunks': 0, 'new_chunks': 0, 'bytes': 0, 'new_bytes': 0}
+
+    def chunk_path(self, digest):
+        return self.root / 'chunks' / digest[:2] / digest
+
+    def put_chunk(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        self.stats['chunks'] += 1
+        self.stats['bytes'] += len(data)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tf_cache.atomic_write(path, lambda f: f.write(data))
+            self.stats['new_chunks'] += 1
+            self.stats['new_bytes'] += len(data)
+        return digest
+
+    def put(self, value):
+        """
+        store `value` and return its descriptor
+        """
+        mclass, shape, data = mcn_export.matlab_bytes(value)
+        chunks = [self.put_chunk(data[start:start + self.chunk_bytes])
+                  for start in range(0, len(data), self.chunk_bytes)]
+
+        digest = hashlib.sha256()
+        digest.update('{} {}\n'.format(mclass, shape).encode())
+        for chunk in chunks:
+            digest.update(chunk.encode())
+        return OrderedDict([
+            ('hash', digest.hexdigest()),
+            ('dataType', mclass),
+            ('shape', np.array(shape, dtype=float).reshape(1, -1)),
+            ('chunks', tf_mcn.rowcell(chunks))])
+
+    def get(self, descriptor):
+        """
+        read the value described by `descriptor`. Values held in a single
+        chunk are memory-mapped rather than read
+        """
+        dtype = mcn_export.mat2np_dtype[str(descriptor['dataType'])]
+        shape = tuple(int(x) for x in np.ravel(descriptor['shape']))
+        paths = [self.chunk_path(str(chunk))
+                 for chunk in np.ravel(descriptor['chunks'])]
+        if not paths:
+            return np.zeros(shape, dtype=dtype)
+        if len(paths) == 1:
+            return np.memmap(str(paths[0]), dtype=dtype, mode='r',
+                             shape=shape, order='F')
+        data = np.concatenate([np.fromfile(str(path), dtype=np.uint8)
+                               for path in paths])
+        return data.view(dtype).reshape(shape, order='F')
+
+    def total_bytes(self):
+        return sum(path.stat().st_size
+                   for path in self.root.glob('chunks/??/*')
+                   if not path.name.endswith('.tmp'))
+
+# --------------------------------------------------------------------
+#                                                              models
+# --------------------------------------------------------------------
+
+def store_params(tf_model, store):
+    """
+    move the param values of `tf_model` into `store`, leaving empty values
+    in their place, and return the descriptors of the stored values (the
+    contents of `net.meta.weights`)
+    """
+    descriptors = OrderedDict()
+    for name, param in tf_model.params.items():
+        descriptors[name] = store.put(param.value)
+    mcn_export.clear_param_values(tf_model)
+    return descriptors
@@ -0,0 +1,214 @@
+# Decoding of TensorFlow `TensorProto` messages into numpy arrays
+
+import math
+import numpy as np
+
+# --------------------------------------------------------------------
+#                                                          data types
+# --------------------------------------------------------------------
+
+# `DataType` enum values, from tensorflow/core/framework/types.proto
+DT_FLOAT = 1
+DT_DOUBLE = 2
+DT_INT32 = 3
+DT_UINT8 = 4
+DT_INT16 = 5
+DT_INT8 = 6
+DT_INT64 = 9
+DT_BOOL = 10
+DT_BFLOAT16 = 14
+DT_UINT16 = 17
+DT_HALF = 19
+DT_UINT32 = 22
+DT_UINT64 = 23
+
+# convert tf data types into numpy data types. numpy has no bfloat16, so
+# it is read as raw 16 bit words and widened to float32 after decoding
+tf2np_dtype = {
+    DT_FLOAT: np.float32,
+    DT_DOUBLE: np.float64,
+    DT_INT32: np.int32,
+    DT_UINT8: np.uint8,
+    DT_INT16: np.int16,
+    DT_INT8: np.int8,
+    DT_INT64: np.int64,
+    DT_BOOL: np.bool_,
+    DT_BFLOAT16: np.uint16,
+    DT_UINT16: np.uint16,
+    DT_HALF: np.float16,
+    DT_UINT32: np.uint32,
+    DT_UINT64: np.uint64,
+}
+
+# the repeated `TensorProto` field used to store values of each type when
+# they are not packed into `tensor_content`. Note that half precision
+# values are stored as their bit patterns, widened to int32
+tf_val_field = {
+    DT_FLOAT: 'float_val',
+    DT_DOUBLE: 'double_val',
+    DT_INT32: 'int_val',
+    DT_UINT8: 'int_val',
+    DT_INT16: 'int_val',
+    DT_INT8: 'int_val',
+    DT_INT64: 'int64_val',
+    DT_BOOL: 'bool_val',
+    DT_BFLOAT16: 'half_val',
+    DT_UINT16: 'int_val',
+    DT_HALF: 'half_val',
+    DT_UINT32: 'uint32_val',
+    DT_UINT64: 'uint64_val',
+}
+
+def bfloat16_to_float32(raw):
+    """
+    widen raw bfloat16 words (the upper half of a float32) to float32
+    """
+    return (raw.astype(np.uint32) << 16).view(np.float32)
+
+def typed_vals_to_array(vals, dtype):
+    """
+    convert the contents of a typed repeated field to a flat array
+    """
+    if dtype in (DT_HALF, DT_BFLOAT16):
+        bits = np.array(vals, dtype=np.int32).astype(np.uint16)
+        return bits.view(tf2np_dtype[dtype])
+    return np.array(vals).astype(tf2np_dtype[dtype])
+
+# --------------------------------------------------------------------
+#                                                            decoding
+# --------------------------------------------------------------------
+
+def tensor_shape(tensor):
+    return tuple(x.size for x in tensor.tensor_shape.dim)
+
+def decode_tensor(tensor, order=None):
+    """
+    decode a `TensorProto` into a read-only numpy array.
+
+    Packed values (`tensor_content`) are returned as a `np.frombuffer` view
+    of the message bytes, so no copy is made. Values stored in the typed
+    repeated fields are converted once; a single value filling the whole
+    tensor (a "splat", e.g. `tf.zeros`) is expanded lazily with
+    `np.broadcast_to` rather than materialized. If `order` is given, the
+    axes are permuted with a strided view - the copy into the new layout is
+    left to whoever finally writes the array out.
+    """
+    dtype = tensor.dtype
+    if dtype not in tf2np_dtype:
+        raise ValueError('Unsupported tensor dtype: {}'.format(dtype))
+    np_dtype = tf2np_dtype[dtype]
+
+    shape = tensor_shape(tensor)
+    num_elements = int(np.prod(shape))
+
+    content = tensor.tensor_content
+    if len(content) > 0:
+        value = np.frombuffer(content, dtype=np_dtype).reshape(shape)
+        if dtype == DT_BFLOAT16:
+            value = bfloat16_to_float32(value)
+    else:
+        vals = typed_vals_to_array(getattr(tensor, tf_val_field[dtype]), dtype)
+        if dtype == DT_BFLOAT16:
+            vals = bfloat16_to_float32(vals)
+        if vals.size == 0:
+            if num_elements > 0:
+                raise ValueError('Unrecognised tensor values')
+            value = vals.reshape(shape)
+        elif vals.size == 1:
+            value = np.broadcast_to(vals.reshape(()), shape)
+        else:
+            if vals.size < num_elements:
+                # TF repeats the last value to fill out the tensor
+                pad = np.full(num_elements - vals.size, vals[-1])
+                vals = np.concatenate((vals, pad))
+            value = vals.reshape(shape)
+
+    return finish(value, order)
+
+def finish(value, order=None):
+    """
+    apply an optional axis permutation (as a view) and mark read-only
+    """
+    if order is not None and list(order) != list(range(value.ndim)):
+        value = np.transpose(value, order)
+
+    if value.flags.writeable:
+        value.flags.writeable = False
+    return value
+
+# --------------------------------------------------------------------
+#                                                        lazy handles
+# --------------------------------------------------------------------
+
+class TensorHandle(object):
+    """
+    A lazy reference to the packed values of a tensor, given by the byte
+    span of its `tensor_content` within a serialized graph (typically a
+    memory-mapped `.pb` file). Shape, dtype and size are available without
+    touching the data; the values are only read by `resolve`, which
+    returns a fresh read-only view each time rather than caching it, so
+    that pages of the mapping can be dropped again once written out.
+    Numpy functions accept handles directly (via `__array__`).
+    """
+
+    def __init__(self, buf, offset, length, dtype, shape, order=None):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+        self.tf_dtype = dtype
+        self.stored_shape = tuple(shape)
+        self.order = order
+
+    @property
+    def dtype(self):
+        if self.tf_dtype == DT_BFLOAT16:
+            return np.dtype(np.float32)
+        return np.dtype(tf2np_dtype[self.tf_dtype])
+
+    @property
+    def shape(self):
+        if self.order is None:
+            return self.stored_shape
+        return tuple(self.stored_shape[i] for i in self.order)
+
+    @property
+    def ndim(self):
+        return len(self.stored_shape)
+
+    @property
+    def size(self):
+        return int(math.prod(self.stored_shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def resolve(self):
+        np_dtype = np.dtype(tf2np_dtype[self.tf_dtype])
+        count = self.length // np_dtype.itemsize
+        if count != self.size:
+            raise ValueError('tensor content holds {} values, expected {}'
+                             .format(count, self.size))
+        value = np.frombuffer(self.buf, dtype=np_dtype, count=count,
+                              offset=self.offset).reshape(self.stored_shape)
+        if self.tf_dtype == DT_BFLOAT16:
+            value = bfloat16_to_float32(value)
+        return finish(value, self.order)
+
+    def __array__(self, dtype=None, copy=None):
+        value = self.resolve()
+        if dtype is not None:
+            value = value.astype(dtype)
+        return value
+
+    def __repr__(self):
+        return 'TensorHandle({}, shape={}, offset={})'.format(
+                self.dtype, self.shape, self.offset)
+
+def resolve(value):
+    """
+    return `value` as a numpy array, reading it through its handle if lazy
+    """
+    if isinstance(value, TensorHandle):
+        return value.resolve()
+    return np.asarray(value)